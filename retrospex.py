@@ -0,0 +1,1179 @@
+#! /usr/bin/python
+#
+# RETROSPEX - serial link helpers for the RetroSPEX controller
+#
+# LICENSE:
+# This work is licensed under the Creative Commons Zero License
+# Creative Commons CC0.
+# To view a copy of this license, visit
+# http://directory.fsf.org/wiki/License:CC0
+# or send a letter to:
+# Creative Commons, PO Box 1866, Mountain View, CA 94042, USA.
+#
+# Author: James Luscher, jluscher@gmail.com
+#
+#  NOTE:  nothing in here may import tkinter, so these routines can be used
+#         by SCANIT, by the benchmarks and by headless (scripted) scans.
+#
+import asyncio, threading, time, os, struct, json, select, math
+from fractions import Fraction
+from collections import deque, namedtuple
+#
+import numpy
+import serial
+
+
+#=====================================================================
+## Serial input  -  bytes => lines
+#
+# RetroSPEX sends 7-bit ASCII.  The 8th bit is masked off for every byte
+# with one 'translate' (instead of chr( ord(c)%128 ) per character).
+MASK7 = bytes.maketrans(bytes(range(256)), bytes(x % 128 for x in range(256)))
+
+#----
+def splitLines(pending, chunk):
+    '''Add 'chunk' (bytes just read) to 'pending' (bytearray of any partial
+    line) and return the list of complete lines as 7-bit 'str' lines.
+    The "newline" is removed, carriage returns are discarded and the
+    (incomplete) remainder is left in 'pending' for the next call.'''
+    pending += chunk.translate(MASK7)   # 7-bit, the whole chunk at once
+    end = pending.rfind(b'\n')
+    if end < 0:
+        return []               # no complete line yet
+    block = pending[:end].translate(None, b'\r')
+    del pending[:end+1]         # keep only the partial line
+    return block.decode('ascii').split('\n')
+
+
+#=====================================================================
+## Serial output  -  ring buffer
+#
+class TxRing():
+    '''Transmit ring buffer (bytearray) for the serial port.
+    put() appends bytes, peek() returns a memoryview of the next
+    contiguous bytes to send and consume(n) drops 'n' sent bytes,
+    so a partial write never copies (or shifts) what is left over.
+    The buffer doubles in size if ever it is too small.'''
+    def __init__(self, size=4096):
+        self.buf   = bytearray(size)
+        self.view  = memoryview(self.buf)
+        self.head  = 0              # where the next byte goes in
+        self.tail  = 0              # next byte to be sent
+        self.count = 0              # bytes waiting to be sent
+    #
+    def __len__(self):
+        return self.count
+    #
+    def put(self, data):
+        n = len(data)
+        if self.count + n > len(self.buf):
+            self.grow(self.count + n)
+        size  = len(self.buf)
+        first = min(n, size - self.head)    # up to the end of the buffer
+        self.view[self.head:self.head+first] = data[:first]
+        if first < n:                       # ... the rest wraps around
+            self.view[0:n-first] = data[first:]
+        self.head = (self.head + n) % size
+        self.count += n
+    #
+    def peek(self):
+        end = min(self.tail + self.count, len(self.buf))
+        return self.view[self.tail:end]
+    #
+    def consume(self, n):
+        self.count -= n
+        if self.count == 0:
+            self.head = self.tail = 0       # keep the next write contiguous
+        else:
+            self.tail = (self.tail + n) % len(self.buf)
+    #
+    def grow(self, need):
+        size = len(self.buf)
+        while size < need:
+            size *= 2
+        buf = bytearray(size)
+        first = self.peek()                 # 'tail' up to the end ...
+        buf[:len(first)] = first
+        rest = self.count - len(first)      # ... and what wrapped around
+        buf[len(first):self.count] = self.view[:rest]
+        self.buf, self.view = buf, memoryview(buf)
+        self.tail, self.head = 0, self.count
+
+
+#=====================================================================
+## Serial I/O thread  -  owns serial.Serial
+#
+# Only this thread touches the port.  Input lines are posted to 'rxLines'
+# and output bytes are taken from 'txData'; both are collections.deque,
+# whose append() and popleft() are atomic, so neither side takes a lock.
+#
+class SerialIO(threading.Thread):
+    '''Background serial reader/writer for the RetroSPEX link.
+    'notify' (optional) is called from the I/O thread after new lines
+    have been posted, e.g. to wake up the GUI.
+    Bytes are written only when the port can take them (select() says
+    writable and, with rtscts, CTS is asserted); until then the thread
+    sleeps in select(), waking up for input, new output or a backoff.'''
+    backoffMin = 0.001          # (s) CTS poll interval, doubling ...
+    backoffMax = 0.050          # ... up to this
+    drainSec   = 1.0            # (s) stop(): longest wait to send what is left
+    def __init__(self, port, notify=None, readTimeout=0.05):
+        threading.Thread.__init__(self, name='SerialIO', daemon=True)
+        self.port    = port
+        self.notify  = notify
+        self.rxBuf   = bytearray()  # partial input line
+        self.rxLines = deque()      # complete input lines  (I/O => user)
+        self.txData  = deque()      # bytes to be sent      (user => I/O)
+        self.txRing  = TxRing()     # ... waiting for the port (I/O only)
+        self.txBytes = 0            # bytes sent
+        self.txWrites = 0           # port write() calls
+        self.txBusy  = 0.0          # (s) time spent with bytes waiting
+        self.txSince = None         # ... since this time
+        self.error   = None         # exception that stopped the thread
+        self.log     = None         # TrafficLog recording TX/RX (optional)
+        self.running = True
+        port.timeout = readTimeout  # block (briefly) on reads
+        try:                        # select() on the port where possible
+            self.fd = port.fileno()
+        except (AttributeError, OSError, serial.SerialException):
+            self.fd = None
+        self.ctsKnown = bool(getattr(port, 'rtscts', False))
+        self.backoff = self.backoffMin
+        self.txStalls = 0           # times the port was not ready
+        self.txStalled = 0.0        # (s) ... total time not ready
+        self.txStallSince = None
+        self.txDepthMax = 0         # most bytes waiting in the ring
+        self.txDropAsk = False      # discard() asked, not yet done
+        self.txDropped = 0          # ... bytes it dropped
+        self.txUnsent = 0           # bytes stop() could not send in time
+    #
+    def write(self, data):
+        '''Queue 'data' (bytes) for sending; safe from any thread.'''
+        self.txData.append(data)
+        try:
+            self.port.cancel_read()     # wake up a blocked read()
+        except (AttributeError, NotImplementedError):
+            pass                        # ... else sent after 'readTimeout'
+    #
+    def takeLines(self):
+        '''Remove and return (as a list) every line received so far.'''
+        lines = self.rxLines
+        return [lines.popleft() for i in range(len(lines))]
+    #
+    def stop(self):
+        '''End the thread once everything queued has been written (or
+        'drainSec' has passed); join() to wait for it.'''
+        self.running = False
+        self.write(b'')
+    #
+    def discard(self):
+        '''Drop every byte not yet written to the port; safe from any
+        thread.  The I/O thread does it: 'txDropAsk' is False again once
+        done, 'txDropped' then says how many bytes never went out.'''
+        self.txDropAsk = True
+        self.write(b'')                 # wake up the I/O thread
+    #
+    def drop(self):
+        '''discard(), in the I/O thread.'''
+        n = self.txRing.count
+        self.txRing.consume(n)
+        while self.txData:
+            n += len(self.txData.popleft())
+        if self.txSince is not None:
+            self.txBusy += time.perf_counter() - self.txSince
+            self.txSince = None
+        self.txDropped = n
+        self.txDropAsk = False
+    #
+    def ctsReady(self):
+        '''False while hardware flow control (CTS) holds us off.'''
+        if not self.ctsKnown:
+            return True
+        try:
+            return self.port.cts
+        except (serial.SerialException, OSError, AttributeError):
+            self.ctsKnown = False       # i.e. a pty: no modem lines
+            return True
+    #
+    def ready(self):
+        '''True if a write() now would take some bytes.'''
+        if not self.ctsReady():
+            return False
+        if self.fd is None:
+            return True                 # (no select: write() tells)
+        r,w,x = select.select([], [self.fd], [], 0)
+        return bool(w)
+    #
+    def stall(self, stalled):
+        '''Keep track of when (and how long) the port was not ready.'''
+        now = time.perf_counter()
+        if stalled and self.txStallSince is None:
+            self.txStalls += 1
+            self.txStallSince = now
+        elif not stalled and self.txStallSince is not None:
+            self.txStalled += now - self.txStallSince
+            self.txStallSince = None
+            self.backoff = self.backoffMin
+    #
+    def send(self):
+        '''Write out whatever is queued: as many bytes per write()
+        as the port takes, the rest stays in the ring.'''
+        ring = self.txRing
+        while self.txData:
+            ring.put(self.txData.popleft())
+        self.txDepthMax = max(self.txDepthMax, ring.count)
+        if ring.count and self.txSince is None:
+            self.txSince = time.perf_counter()
+        while ring.count:
+            if not self.ready():        # not now: run() waits for room
+                self.stall(True)
+                return
+            data = ring.peek()
+            n = self.port.write(data)
+            if n is None:               # older pyserial: all sent
+                n = len(data)
+            self.txWrites += 1
+            if n == 0:                  # port not ready, try again later
+                self.stall(True)
+                return
+            self.stall(False)
+            if self.log:
+                self.log.record(TX, data[:n])
+            ring.consume(n)
+            self.txBytes += n
+        now = time.perf_counter()
+        self.txBusy += now - self.txSince
+        self.txSince = None
+    #
+    def waitWritable(self):
+        '''Sleep until the port has room, input arrives, more output is
+        queued (cancel_read) or the backoff (CTS) / read timeout is up.'''
+        cts = self.ctsReady()
+        wait = self.port.timeout if cts else self.backoff
+        if not cts:
+            self.backoff = min(self.backoff * 2, self.backoffMax)
+        if self.fd is None:
+            time.sleep(wait)
+            return
+        wake = getattr(self.port, 'pipe_abort_read_r', None)
+        rd = [self.fd] + ([wake] if wake is not None else [])
+        r,w,x = select.select(rd, [self.fd] if cts else [], [], wait)
+        if wake is not None and wake in r:
+            os.read(wake, 1000)         # (cancel_read() wake up)
+    #
+    def txDepth(self):
+        '''Bytes waiting to be sent.'''
+        return self.txRing.count + sum(len(d) for d in list(self.txData))
+    #
+    def txRate(self):
+        '''Bytes sent per second (while there was something to send).'''
+        busy = self.txBusy
+        if self.txSince is not None:
+            busy += time.perf_counter() - self.txSince
+        return self.txBytes / busy if busy > 0 else 0.0
+    #
+    def txReport(self):
+        stalled = self.txStalled
+        if self.txStallSince is not None:
+            stalled += time.perf_counter() - self.txStallSince
+        return ('tx: {} bytes in {} writes, {:.0f} bytes/s, queue {} (max {})'
+                ', {} stalls {:.1f} ms'.format(self.txBytes, self.txWrites
+                ,self.txRate(), self.txDepth(), self.txDepthMax, self.txStalls
+                ,stalled*1000))
+    #
+    def run(self):
+        port = self.port
+        try:
+            while self.running:
+                if self.txDropAsk:
+                    self.drop()
+                if self.txData or self.txRing.count:
+                    self.send()
+                if self.txRing.count:           # port full / CTS off
+                    self.waitWritable()
+                    waiting = port.in_waiting
+                    if not waiting:
+                        continue
+                    chunk = port.read(waiting)
+                else:
+                    chunk = port.read(1)        # wait (up to readTimeout)
+                    if not chunk:
+                        continue
+                    waiting = port.in_waiting
+                    if waiting:
+                        chunk += port.read(waiting) # ... and all that followed
+                if self.log:
+                    self.log.record(RX, chunk)
+                lines = splitLines(self.rxBuf, chunk)
+                if lines:
+                    self.rxLines.extend(lines)
+                    if self.notify:
+                        self.notify()
+            self.drain()
+        except (serial.SerialException, OSError) as e:
+            self.error = e
+            self.running = False
+            if self.notify:
+                self.notify()
+        if self.log:
+            self.log.close()
+    #
+    def drain(self):
+        '''stop(): write out what is still queued, for up to 'drainSec'
+        ('txUnsent' says what was left).'''
+        end = time.perf_counter() + self.drainSec
+        while self.txData or self.txRing.count:
+            self.send()
+            if not self.txRing.count:
+                continue
+            if time.perf_counter() >= end:
+                self.txUnsent = self.txDepth()
+                return
+            self.waitWritable()
+            waiting = self.port.in_waiting
+            if waiting:                 # (input is for no one now)
+                chunk = self.port.read(waiting)
+                if self.log:
+                    self.log.record(RX, chunk)
+
+
+#=====================================================================
+## Traffic log  -  TX/RX frames as they crossed the link
+#
+# File:  b'RSPXLOG1', <uint32 n>, <n bytes json: port, firmware, start>
+# then frames:  <uint64 us since start> <uint8 TX/RX> <uint16 n> <n bytes>
+# Frames are kept in memory and written out in 64 KB pieces, from the
+# I/O thread (which both reads and writes the port), so no lock.
+#
+LOGmagic = b'RSPXLOG1'
+FRAME = struct.Struct('<QBH')
+TX, RX = 0, 1
+
+#----
+class TrafficLog():
+    '''Records TX/RX frames to file 'fName'.'''
+    flushSize = 65536
+    #
+    def __init__(self, fName, **meta):
+        meta.setdefault('start', time.time())
+        self.t0   = time.perf_counter()
+        self.fo   = open(fName, 'wb')
+        head = json.dumps(meta).encode()
+        self.fo.write(LOGmagic + struct.pack('<I', len(head)) + head)
+        self.buf  = bytearray()
+        self.frames = 0
+    #
+    def record(self, direction, data):
+        us = int((time.perf_counter() - self.t0) * 1e6)
+        for i in range(0, len(data), 0xFFFF):   # uint16 length
+            part = data[i:i+0xFFFF]
+            self.buf += FRAME.pack(us, direction, len(part))
+            self.buf += part
+            self.frames += 1
+        if len(self.buf) >= self.flushSize:
+            self.fo.write(self.buf)
+            self.buf = bytearray()
+    #
+    def close(self):
+        if self.fo:
+            self.fo.write(self.buf)
+            self.fo.close()
+            self.fo = None
+
+#----
+def readTrafficLog(fName):
+    '''Returns (meta, frames) from a TrafficLog file; frames is a list of
+    (seconds, TX/RX, bytes).'''
+    data = open(fName, 'rb').read()
+    if data[:8] != LOGmagic:
+        raise ValueError('{}: not a RetroSPEX traffic log'.format(fName))
+    n = struct.unpack_from('<I', data, 8)[0]
+    meta = json.loads(data[12:12+n].decode())
+    frames = []
+    pos = 12 + n
+    while pos + FRAME.size <= len(data):
+        us, direction, size = FRAME.unpack_from(data, pos)
+        pos += FRAME.size
+        frames.append((us / 1e6, direction, data[pos:pos+size]))
+        pos += size
+    return meta, frames
+
+#----
+class ReplayPort():
+    '''serial.Serial look-alike that plays back the RX frames of a traffic
+    log, at the recorded times ('speed' 1.0), faster, or as fast as they
+    are read (speed 0).  Bytes written are checked against the recorded
+    TX ('txMismatch' counts differences).'''
+    def __init__(self, fName, speed=1.0):
+        self.meta, frames = readTrafficLog(fName)
+        self.rx = deque((t, d) for t,dr,d in frames if dr == RX)
+        self.txExpect = b''.join(d for t,dr,d in frames if dr == TX)
+        self.txPos  = 0
+        self.txMismatch = 0
+        self.speed  = speed
+        self.timeout = 0
+        self.pending = bytearray()
+        self.t0     = None          # playback starts with the first read
+        self.cancel = threading.Event()
+    #
+    def due(self):
+        '''Move the RX frames whose time has come into 'pending'.'''
+        now = time.perf_counter()
+        if self.t0 is None:
+            self.t0 = now
+        while self.rx and (self.speed <= 0 or
+                           self.rx[0][0] / self.speed <= now - self.t0):
+            self.pending += self.rx.popleft()[1]
+    #
+    @property
+    def in_waiting(self):
+        self.due()
+        return len(self.pending)
+    #
+    def done(self):
+        '''True when every RX frame has been read.'''
+        return not self.rx and not self.pending
+    #
+    def read(self, n=1):
+        self.due()
+        if not self.pending and self.timeout:
+            wait = self.timeout             # (played out: just idle)
+            if self.rx:
+                wait = self.rx[0][0] / self.speed - (time.perf_counter() - self.t0)
+            self.cancel.wait(min(self.timeout, max(0.0, wait)))
+            self.cancel.clear()
+            self.due()
+        b = bytes(self.pending[:n])
+        del self.pending[:n]
+        return b
+    #
+    def write(self, data):
+        data = bytes(data)
+        expect = self.txExpect[self.txPos:self.txPos+len(data)]
+        if data != expect:
+            self.txMismatch += 1
+        self.txPos += len(data)
+        return len(data)
+    #
+    def cancel_read(self):
+        self.cancel.set()
+    #
+    def close(self):
+        pass
+
+
+#=====================================================================
+## Port discovery
+#
+# RetroSPEX repeats its "RetroSPEX_Rev-8" banner until it is answered
+# with a newline.  Every candidate port is opened and watched at once
+# (a thread each), so a silent or missing device costs no extra time
+# and the search always ends by its deadline.
+#
+BYID = '/dev/serial/by-id'
+
+#----
+def serialById():
+    '''USB serial devices listed (by name) in /dev/serial/by-id (linux),
+    as device paths: ['/dev/ttyACM0', ...]'''
+    try:
+        names = sorted(os.listdir(BYID))
+    except OSError:
+        return []
+    return [os.path.realpath(os.path.join(BYID, n)) for n in names]
+
+#----
+def probePort(name, deadline, stop):
+    '''Open port 'name' and watch for the banner until 'deadline'
+    (time.monotonic()) or until 'stop' (threading.Event) is set.
+    Returns (port, banner) with the port left open, or None.'''
+    try:
+        port = serial.Serial(port=name, baudrate=115200, timeout=0.05
+                            ,rtscts=1, dsrdtr=True, write_timeout=0)
+    except (serial.SerialException, OSError, ValueError):
+        return None
+    pending = bytearray()
+    try:
+        while time.monotonic() < deadline and not stop.is_set():
+            chunk = port.read(max(1, port.in_waiting))
+            for line in splitLines(pending, chunk):
+                if line.startswith('RetroSPEX'):
+                    return port, line
+    except (serial.SerialException, OSError, UnicodeDecodeError):
+        pass
+    port.close()
+    return None
+
+#----
+def probePorts(names, timeout=3.0):
+    '''Probe every port in 'names' at the same time.  Returns
+    (name, port, banner) for the first RetroSPEX heard, or None once
+    'timeout' (s) has passed.  The other ports are closed.'''
+    deadline = time.monotonic() + timeout
+    stop = threading.Event()
+    lock = threading.Lock()
+    found = []
+    def probe(name):
+        r = probePort(name, deadline, stop)
+        if r:
+            with lock:
+                if not stop.is_set():
+                    found.append((name,) + r)
+                    stop.set()
+                    return
+            r[0].close()            # too late, another port answered
+    threads = [threading.Thread(target=probe, args=(name,), daemon=True
+                               ,name='probe '+name) for name in names]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join(max(0.0, deadline - time.monotonic()) + 1.0)
+    with lock:
+        stop.set()
+        return found[0] if found else None
+
+
+#=====================================================================
+## RetroSPEX commands and responses
+#
+# '!' alerts (bits) as used by these routines:
+#     ! 01   HV A/D conversion done          (after 'H')
+#     ! 02   Integration time done           (after '>')
+#     ! 04   Motion done                     (unsolicited)
+#  'X' and 'M' are echoed once the move has been made.
+#
+ALERThv    = '! 01'
+ALERTtimer = '! 02'
+ALERTmove  = '! 04'
+
+#----
+def rspMatch(pattern, txt):
+    '''True if response line 'txt' fits 'pattern'.
+    A '#' token in the pattern matches any one token: "A # #".'''
+    if pattern == txt:
+        return True
+    if '#' not in pattern:
+        return False
+    p = pattern.split()
+    t = txt.split()
+    if len(p) != len(t):
+        return False
+    for a,b in zip(p,t):
+        if a != '#' and a != b:
+            return False
+    return True
+
+#
+# Every line from RetroSPEX is decoded by a function looked up (dict) by
+# its first character, so the cost per line does not grow as more reply
+# types are added.  Decoders return a tuple of typed fields.
+#
+Reply = namedtuple('Reply', 'code args txt')
+#       code = first character ('A','P','!','#','e',... '' => empty line)
+#       args = tuple of decoded fields  (None => malformed line)
+#       txt  = the line itself
+RSPdecode = {}          # first character => decoder function(txt)
+
+#----
+def rspDecoder(chars):
+    '''Register the decorated function as decoder for replies
+    starting with any one of 'chars'.'''
+    def register(fn):
+        for c in chars:
+            RSPdecode[c] = fn
+        return fn
+    return register
+
+#----
+def decodeLine(txt):
+    '''Decode one RetroSPEX line into a Reply.'''
+    code = txt[:1]
+    fn = RSPdecode.get(code)
+    if fn is None:
+        return Reply(code, (), txt)     # text only (help, header, ...)
+    try:
+        return Reply(code, fn(txt), txt)
+    except (ValueError, IndexError):
+        return Reply(code, None, txt)   # malformed
+
+#----
+@rspDecoder('!Aprsw')
+def rspHex(txt):
+    '''"! 01", "A BCD4 0000", "p FF", "r AA DD", ... => hex fields'''
+    return tuple(int(t,16) for t in txt[2:].split())
+
+#----
+@rspDecoder('#BLEGnvb')
+def rspFlag(txt):
+    '''"# 1", "B 0", "L 1", "E 0", "G 2", "n 0", ... => (n,)'''
+    return (int(txt[2:]),)
+
+#----
+@rspDecoder('D')
+def rspDAC(txt):
+    '''"D 1 E666" => (1, 0xE666)'''
+    t = txt.split()
+    return (int(t[1]), int(t[2],16))
+
+#----
+@rspDecoder('P')
+def rspCount(txt):
+    '''"P 0 FFFEFFFEFFFF" => (0, count)   ("P 0" echo => (0,))'''
+    t = txt.split()
+    if len(t) == 2:
+        return (int(t[1]),)
+    if len(t[2]) != 12:
+        raise ValueError('count is not 12 hex digits')
+    return (int(t[1]), int(t[2],16))
+
+#----
+@rspDecoder('T')
+def rspTimer(txt):
+    '''"T 000003E8" => (1000,)  ms'''
+    return (int(txt[2:],16),)
+
+#----
+@rspDecoder('XM')
+def rspMove(txt):
+    '''"M -00000032" => (-50,)  steps'''
+    return (int(txt[2:].replace(' ',''),16),)
+
+#----
+@rspDecoder('R')
+def rspBanner(txt):
+    '''"RetroSPEX_Rev-8" => ('RetroSPEX_Rev-8',)  firmware version'''
+    return (txt,)
+
+#----
+@rspDecoder('eicf>*')
+def rspBare(txt):
+    '''"e", "i", "f", ">" ... => ()'''
+    return ()
+
+#----
+def cmdMove(axis, steps):
+    '''"X +0000012C" / "M -00000032"  (axis 'X' or 'M', signed steps)'''
+    return '{} {}{:08X}'.format(axis, '-' if steps < 0 else '+', abs(steps))
+
+#----
+def cmdTimer(ms):
+    '''"T 000003E8"  (integration time, ms)'''
+    return 'T {:08X}'.format(int(ms))
+
+
+#=====================================================================
+## Monochrometer step tables  -  scan positions in exact arithmetic
+#
+# Point i is at start + i*inc nm, converted to motor steps once (from the
+# origin, rounded half up), never by adding up rounded increments: with
+# 12.5 steps/nm a 1 nm increment is not 12 or 13 steps, it alternates.
+#
+#----
+def stepTable(start, end, inc, stepsNm, origin):
+    '''Wavelengths 'start'..'end' by 'inc' (nm) and the motor position of
+    each, in steps from 'origin' (nm).  Any argument may be a decimal
+    string ('12.5').  Returns (nm-list, steps-list).'''
+    start, end, inc, origin = (Fraction(str(v)) for v in (start, end, inc, origin))
+    stepsNm = Fraction(str(stepsNm))
+    if inc <= 0 or stepsNm <= 0:
+        raise ValueError('stepTable(): inc and stepsNm must be > 0')
+    nms = [start + i*inc for i in range(int((end - start) // inc) + 1)]
+    steps = [math.floor((nm - origin) * stepsNm + Fraction(1,2)) for nm in nms]
+    return [int(nm) if nm.denominator == 1 else float(nm) for nm in nms], steps
+
+#----
+def stepMoves(steps, at=0):
+    '''Relative moves through the positions 'steps', starting 'at'.'''
+    return [b - a for a,b in zip([at] + steps[:-1], steps)]
+
+#----
+def featureIntervals(ys, sigma=None, level=0.05):
+    '''Intervals of a coarse scan 'ys' worth a closer look:  interval i
+    (between points i and i+1) where the data rises or falls, bends, or
+    peaks by more than 'level' of its whole range - and by more than 3
+    standard deviations ('sigma', per point) so noise is not refined.
+    Returns the interval numbers, sorted.'''
+    n = len(ys)
+    if n < 2:
+        return []
+    span = max(ys) - min(ys)
+    sigma = sigma or [0.0] * n
+    def big(change, *pts):
+        noise = 3 * math.sqrt(sum(sigma[j]**2 for j in pts))
+        return abs(change) > max(level * span, noise, 0)
+    picks = set()
+    for i in range(n - 1):                      # gradient
+        if big(ys[i+1] - ys[i], i, i+1):
+            picks.add(i)
+    for j in range(1, n - 1):                   # curvature, peaks
+        bend = ys[j-1] - 2*ys[j] + ys[j+1]
+        peak = ys[j] - max(ys[j-1], ys[j+1])
+        if big(bend, j-1, j, j, j+1) or (peak > 0 and big(peak, j, j+1)):
+            picks.update((j-1, j))
+    return sorted(picks)
+
+
+#=====================================================================
+## Scan programs  -  a whole EX/EM scan compiled before it starts
+#
+# Every command of the scan, in order, already encoded for the wire, with
+# the response it waits for; the scan engine only hands them to its queue.
+# 'op' says what a step is for:  'T' (timer), 'park' (EM, for an EX scan),
+# 'move', 'clear', 'count', 'dump0', 'dump1'  (counter 0: signal, 1: ref.)
+Step = namedtuple('Step', 'cmd wire rsp op')
+
+class ScanProgram():
+    '''A compiled scan:  'head' (Steps before the first point), 'pre[i]'
+    (move, clear, count of point i) and 'post[i]' (its dumps); 'xs' (the
+    wavelength of each point), 'limit[i]' (s, counting + motion of point
+    i), 'seconds' (estimated duration), 'size' (bytes sent) and
+    'compileSec'.'''
+    def __init__(self, xs):
+        self.xs     = xs
+        self.head   = []
+        self.pre    = []
+        self.post   = []
+        self.limit  = []
+        self.seconds = 0.0
+        self.size   = 0
+        self.compileSec = 0.0
+    #
+    def steps(self):
+        '''All the Steps, in the order they are sent.'''
+        yield from self.head
+        for pre,post in zip(self.pre, self.post):
+            yield from pre
+            yield from post
+    #
+    def __len__(self):
+        return len(self.head) + sum(len(p) for p in self.pre) \
+                              + sum(len(p) for p in self.post)
+    #
+    def extend(self, prog):
+        '''Continue with the points of 'prog', compiled to start where this
+        one ends (its head, the timer, is not needed again).'''
+        self.xs     = self.xs + prog.xs
+        self.pre   += prog.pre
+        self.post  += prog.post
+        self.limit += prog.limit
+        self.seconds += prog.seconds
+        self.size   += prog.size - sum(len(s.wire) for s in prog.head)
+        self.compileSec += prog.compileSec
+
+#----
+def compileScan(axis, xs, steps, intMs, ref=False, park=0, stepsPerSec=1000
+               ,linkSec=0.002, eol=b'\n', at=0, backlash=0, floor=None):
+    '''Compile a scan of monochrometer 'axis' ('X'/'M') through the motor
+    positions 'steps' (see stepTable; 'xs' their wavelengths), counting
+    'intMs' at each, with the reference counter too if 'ref'.  'park':
+    steps to move the EM monochrometer first.  'at': motor position before
+    the first point.  A move down goes 'backlash' steps past the point and
+    comes back up, so every point is approached in the positive direction;
+    never below motor position 'floor' (the overshoot is cut short there).
+    The estimate allows 'linkSec' per point for the round trips.  Returns
+    a ScanProgram.'''
+    t0 = time.perf_counter()
+    prog = ScanProgram(xs)
+    def step(cmd, op, rsp=None):
+        return Step(cmd, cmd.encode() + eol, rsp or cmd, op)
+    counters = (0, 1) if ref else (0,)
+    clears = [step('E {}'.format(n), 'clear') for n in counters]
+    count  = step('>', 'count', ALERTtimer)
+    dumps  = [step('P {}'.format(n), 'dump{}'.format(n), 'P {} #'.format(n))
+              for n in counters]
+    prog.head.append(step(cmdTimer(intMs), 'T'))
+    if park:
+        prog.head.append(step(cmdMove('M', park), 'park'))
+        prog.seconds += abs(park) / stepsPerSec
+    for pos,move in zip(steps, stepMoves(steps, at)):
+        over = backlash if floor is None else min(backlash, pos - floor)
+        moves = [move - over, over] if move < 0 < over else [move]
+        pre = [step(cmdMove(axis, m), 'move') for m in moves if m]
+        prog.pre.append(pre + clears + [count])
+        prog.post.append(dumps)
+        prog.limit.append(intMs / 1000 + sum(map(abs, moves)) / stepsPerSec)
+    prog.seconds += sum(prog.limit) + linkSec * len(steps)
+    prog.size = sum(len(s.wire) for s in prog.steps())
+    prog.compileSec = time.perf_counter() - t0
+    return prog
+
+
+#=====================================================================
+## Counter dumps  -  'P n' lines decoded a block at a time (numpy)
+#
+# "P 0 FFFEFFFEFFFF" is 16 characters: the lines are kept back to back in
+# one bytearray and decoded together, 12 hex digits => uint64 per line.
+#
+COUNTlen  = 16                  # len('P 0 FFFEFFFEFFFF')
+COUNTmax  = (1 << 48) - 1       # 48-bit counter: saturated (or wrapped)
+HEXVAL = numpy.full(256, 255, dtype=numpy.uint8)   # hex digit values
+HEXVAL[numpy.frombuffer(b'0123456789', numpy.uint8)] = numpy.arange(10)
+HEXVAL[numpy.frombuffer(b'ABCDEF', numpy.uint8)] = numpy.arange(10,16)
+HEXVAL[numpy.frombuffer(b'abcdef', numpy.uint8)] = numpy.arange(10,16)
+
+#----
+class CountBlock():
+    '''Collects 'P n' counter dump lines, decode() converts them all.'''
+    def __init__(self):
+        self.buf = bytearray()
+    #
+    def __len__(self):
+        return len(self.buf) // COUNTlen
+    #
+    def add(self, txt):
+        '''Keep dump line 'txt' (str); returns its index.  A line of the
+        wrong length is kept as an invalid record.'''
+        b = txt.encode('ascii', 'replace')
+        if len(b) != COUNTlen:
+            b = b'?' * COUNTlen
+        self.buf += b
+        return len(self) - 1
+    #
+    def extend(self, lines):
+        '''add() for a list of dump lines, in one piece if possible.'''
+        if all(len(t) == COUNTlen for t in lines):
+            self.buf += ''.join(lines).encode('ascii', 'replace')
+        else:
+            for t in lines:
+                self.add(t)
+    #
+    def clear(self):
+        self.buf = bytearray()
+    #
+    def decode(self, first=0):
+        '''Returns (channel, count, valid) numpy arrays, one per line from
+        line 'first' on:  channel (uint8), count (uint64) and valid (bool)
+        - lines that are not "P n <12 hex digits>" are invalid (count 0).'''
+        rec = numpy.frombuffer(self.buf, numpy.uint8)[first*COUNTlen:]
+        rec = rec.reshape(-1, COUNTlen)
+        val = HEXVAL[rec]               # every byte => its hex value (or 255)
+        hi, lo = val[:,4::2], val[:,5::2]
+        word = numpy.zeros((len(rec), 8), numpy.uint8)
+        word[:,2:] = (hi << 4) | lo     # 6 bytes, big-endian 48 bits
+        count = word.view('>u8').ravel().astype(numpy.uint64)
+        word[:,2:] = hi | lo            # high nibble set => not a hex digit
+        hexOK = (word.view(numpy.uint64).ravel()
+                 & numpy.uint64(0xF0F0F0F0F0F0F0F0)) == 0
+        chan = rec[:,2] - ord('0')
+        valid = ( (rec[:,0] == ord('P')) & (rec[:,1] == ord(' '))
+                & (rec[:,3] == ord(' ')) & (chan <= 7) & hexOK )
+        count[~valid] = 0
+        return chan, count, valid
+
+#----
+def saturated(count):
+    '''Mask of counts at the 48-bit limit (counter overflowed).'''
+    return count == numpy.uint64(COUNTmax)
+
+#----
+def unwrap48(count):
+    '''Running (never cleared) 48-bit counter readings => int64 totals,
+    adding 2**48 wherever a reading is less than the one before.'''
+    c = count.astype(numpy.int64)
+    wraps = numpy.cumsum(numpy.diff(c, prepend=c[:1]) < 0)
+    return c + wraps.astype(numpy.int64) * (1 << 48)
+
+
+#=====================================================================
+## Timer wheel  -  many deadlines, one timer
+#
+# Deadlines fall into slots of 'tick' seconds around a wheel; advance()
+# looks only at the slots passed since the last call.  Deadlines further
+# out than one turn wait in their slot for the turns still to go.
+#
+class TimerWheel():
+    '''Hashed timer wheel: add() deadlines (time.perf_counter() seconds),
+    advance() returns the items whose deadline has passed.'''
+    def __init__(self, tick=0.010, slots=256):
+        self.tick  = tick
+        self.slots = [[] for i in range(slots)]
+        self.count = 0                  # timers pending
+        self.now   = int(time.perf_counter() / tick)   # last tick advanced
+    #
+    def add(self, deadline, item):
+        '''Returns a handle for cancel().'''
+        t = max(int(deadline / self.tick) + 1, self.now + 1)
+        handle = [t, item, True]        # [tick due, item, alive]
+        self.slots[t % len(self.slots)].append(handle)
+        self.count += 1
+        return handle
+    #
+    def cancel(self, handle):
+        if handle and handle[2]:
+            handle[2] = False
+            self.count -= 1
+    #
+    def advance(self, now=None):
+        '''Items due by 'now' (default: the current time), oldest first.'''
+        target = int((time.perf_counter() if now is None else now) / self.tick)
+        expired = []
+        n = len(self.slots)
+        first = self.now + 1
+        if target - self.now > n:       # more than a turn: visit each slot once
+            first = target - n + 1
+        for t in range(first, target + 1):
+            slot = self.slots[t % n]
+            if not slot:
+                continue
+            keep = []
+            for h in slot:
+                if not h[2]:
+                    continue            # cancelled: drop it
+                if h[0] <= target:
+                    h[2] = False
+                    self.count -= 1
+                    expired.append(h)
+                else:
+                    keep.append(h)      # a later turn
+            slot[:] = keep
+        self.now = max(self.now, target)
+        expired.sort(key=lambda h: h[0])
+        return [h[1] for h in expired]
+
+
+#=====================================================================
+## Latency histograms
+#
+# HDR style buckets: exact below 128 us, then 64 buckets per power of two
+# (within 1.6 % of the value) without limit; counts kept sparse (dict).
+#
+class LatencyHistogram():
+    '''Histogram of times (recorded in seconds, kept in microseconds).'''
+    subBits = 7                 # 128 exact buckets, then 64 per octave
+    #
+    def __init__(self):
+        self.reset()
+    #
+    def reset(self):
+        self.counts = {}        # bucket index => count
+        self.count  = 0
+        self.total  = 0         # (us) sum of all values
+        self.min    = None      # (us)
+        self.max    = 0         # (us)
+    #
+    def bucket(self, us):
+        '''Bucket index for 'us' (int >= 0).'''
+        sub = 1 << self.subBits
+        if us < sub:
+            return us
+        shift = us.bit_length() - self.subBits
+        return sub + (shift-1) * (sub//2) + (us >> shift) - sub//2
+    #
+    def low(self, i):
+        '''Lowest value (us) in bucket 'i'.'''
+        sub = 1 << self.subBits
+        if i < sub:
+            return i
+        shift = (i - sub) // (sub//2) + 1
+        return ((i - sub) % (sub//2) + sub//2) << shift
+    #
+    def record(self, sec):
+        us = max(0, int(sec * 1e6 + 0.5))
+        i = self.bucket(us)
+        self.counts[i] = self.counts.get(i, 0) + 1
+        self.count += 1
+        self.total += us
+        self.max = max(self.max, us)
+        self.min = us if self.min is None else min(self.min, us)
+    #
+    def mean(self):
+        '''(s) average value'''
+        return self.total / self.count / 1e6 if self.count else 0.0
+    #
+    def percentile(self, pct):
+        '''(s) value below which 'pct' % of the values fall.'''
+        if not self.count:
+            return 0.0
+        want = max(1, int(self.count * pct / 100 + 0.5))
+        seen = 0
+        for i in sorted(self.counts):
+            seen += self.counts[i]
+            if seen >= want:
+                return min(self.max, max(self.min, self.low(i))) / 1e6
+        return self.max / 1e6
+    #
+    def toDict(self):
+        '''Machine readable (json) summary; times in microseconds.'''
+        return { 'count' : self.count
+               , 'min_us': self.min or 0
+               , 'max_us': self.max
+               , 'mean_us': self.total / self.count if self.count else 0
+               , 'p50_us': self.percentile(50) * 1e6
+               , 'p90_us': self.percentile(90) * 1e6
+               , 'p99_us': self.percentile(99) * 1e6
+               , 'buckets': [[self.low(i), self.counts[i]]
+                             for i in sorted(self.counts)]
+               }
+
+
+#=====================================================================
+## asyncio client  -  one awaitable per RetroSPEX command
+#
+class RetroSPEXError(Exception):
+    '''RetroSPEX answered a command with 'e' (error).'''
+    pass
+
+#
+class RetroSPEX():
+    '''asyncio RetroSPEX client for scripts (no GUI):
+
+        async def main():
+            spex = await RetroSPEX.open('/dev/ttyACM0')
+            await spex.setTimer(100)
+            await spex.moveEM(+500)
+            em, ref = await spex.readHV()
+            ...
+            spex.close()
+        asyncio.run(main())
+
+    Every command is a coroutine returning the decoded response.  Commands
+    are written as soon as they are called, and each response is matched
+    to the oldest waiting command it fits, so independent commands may be
+    awaited together, i.e.  asyncio.gather(spex.moveEM(500), spex.readHV())
+    Each wait is limited by 'timeout' (s), or by the integration time and
+    the number of steps for '>' and 'X'/'M'.'''
+    #
+    timeout     = 2.0       # (s) default response timeout
+    stepsPerSec = 1000      # stepper speed, for 'X'/'M' timeouts
+    #
+    def __init__(self, port, loop=None):
+        self.loop    = loop or asyncio.get_running_loop()
+        self.pending = []       # [pattern, future] awaiting responses
+        self.intMs   = 0        # integration time set by setTimer()
+        self.onButton = None    # function(state) for '# n' button alerts
+        self.onLine   = None    # function(line) for unexpected lines
+        self.io = SerialIO(port, notify=self._wake)
+        self.io.start()
+    #
+    @classmethod
+    async def open(cls, name, timeout=5.0, **kw):
+        '''Open port 'name', wait for the "RetroSPEX..." banner (firmware
+        version is kept as '.firmware') and return the connected client.'''
+        port = serial.Serial(port=name, baudrate=115200, timeout=0
+                            ,rtscts=1, dsrdtr=True, write_timeout=0, **kw)
+        spex = cls(port)
+        spex.firmware = await spex.wait('RetroSPEX*', timeout)
+        spex.io.write(b'\n')
+        return spex
+    #
+    def close(self):
+        self.io.stop()
+        self.io.join(1.0)
+        self.io.port.close()
+    #
+    def _wake(self):                    # called in the I/O thread
+        self.loop.call_soon_threadsafe(self._lines)
+    #
+    def _lines(self):
+        for txt in self.io.takeLines():
+            self._line(txt.strip())
+        if self.io.error:
+            for p in self.pending:
+                if not p[1].done():
+                    p[1].set_exception(self.io.error)
+            self.pending = []
+    #
+    def _line(self, txt):
+        if txt.startswith('# '):        # front panel button (unsolicited)
+            if self.onButton:
+                self.onButton(txt[2:])
+            return
+        for i,p in enumerate(self.pending):
+            pattern = p[0]
+            if pattern.endswith('*'):
+                hit = txt.startswith(pattern[:-1])
+            else:
+                hit = rspMatch(pattern, txt)
+            if hit:
+                del self.pending[i]
+                if not p[1].done():
+                    p[1].set_result(txt)
+                return
+        if txt == 'e' and self.pending:     # error: oldest command failed
+            p = self.pending.pop(0)
+            if not p[1].done():
+                p[1].set_exception(RetroSPEXError(p[0]))
+            return
+        if self.onLine:
+            self.onLine(txt)
+    #
+    async def wait(self, pattern, timeout=None):
+        '''Wait for a line fitting 'pattern' ('text*' = starts with).'''
+        entry = [pattern, self.loop.create_future()]
+        self.pending.append(entry)
+        try:
+            return await asyncio.wait_for(entry[1], timeout or self.timeout)
+        finally:
+            if entry in self.pending:
+                self.pending.remove(entry)
+    #
+    async def command(self, cmd, rsp=None, timeout=None):
+        '''Send 'cmd', return the response line (default: the echo).'''
+        entry = [rsp or cmd, self.loop.create_future()]
+        self.pending.append(entry)
+        self.io.write((cmd + '\n').encode())
+        try:
+            return await asyncio.wait_for(entry[1], timeout or self.timeout)
+        finally:
+            if entry in self.pending:
+                self.pending.remove(entry)
+    #
+    #-------- RetroSPEX commands (see COMmands in scanit)
+    #
+    async def sync(self):
+        '''"*" => "e" : clears RetroSPEX's input, shows synchronization.'''
+        await self.command('*', 'e')
+    #
+    async def led(self, n):
+        '''"L n" : LED off/on'''
+        await self.command('L {}'.format(int(n)))
+    #
+    async def setDAC(self, n, value):
+        '''"D n FFFF" : HV supply #n DAC value (0~65535)'''
+        await self.command('D {} {:04X}'.format(n, value))
+    #
+    async def convertHV(self):
+        '''"H" => "! 01" : A/D conversion of the HV levels'''
+        await self.command('H', ALERThv)
+    #
+    async def readHV(self):
+        '''"A" => "A EEEE RRRR" : returns (EM, REF) raw ADC values'''
+        txt = await self.command('A', 'A # #')
+        t = txt.split()
+        return int(t[1],16), int(t[2],16)
+    #
+    async def enable(self, n):
+        '''"E n" : enable (and clear) PMT counter #n'''
+        await self.command('E {}'.format(n))
+    #
+    async def setTimer(self, ms):
+        '''"T 000003E8" : integration time (ms)'''
+        await self.command(cmdTimer(ms))
+        self.intMs = int(ms)
+    #
+    async def integrate(self):
+        '''">" => "! 02" : count for the integration time'''
+        await self.command('>', ALERTtimer, self.intMs/1000 + self.timeout)
+    #
+    async def dump(self, n):
+        '''"P n" => "P n FFFEFFFEFFFF" : returns PMT counter #n'''
+        txt = await self.command('P {}'.format(n), 'P {} #'.format(n))
+        return int(txt.split()[2], 16)
+    #
+    async def moveEX(self, steps):
+        '''"X s7FFFFFFF" : move EXcitation monochrometer (steps)'''
+        await self.command(cmdMove('X', steps), None
+                          ,abs(steps)/self.stepsPerSec + self.timeout)
+    #
+    async def moveEM(self, steps):
+        '''"M s7FFFFFFF" : move EMission monochrometer (steps)'''
+        await self.command(cmdMove('M', steps), None
+                          ,abs(steps)/self.stepsPerSec + self.timeout)
+    #
+    async def refGain(self, n):
+        '''"G n" : reference channel gain (0~3)'''
+        await self.command('G {}'.format(n))
+    #
+    async def inversion(self, n):
+        '''"n n" : photon pulse signal inversion mode (0~3)'''
+        await self.command('n {}'.format(n))
@@ -0,0 +1,366 @@
+#! /usr/bin/python
+#
+# RETROSPEX_SIM - RetroSPEX controller simulator on a pseudo-terminal
+#
+# LICENSE:
+# This work is licensed under the Creative Commons Zero License
+# Creative Commons CC0.
+# To view a copy of this license, visit
+# http://directory.fsf.org/wiki/License:CC0
+# or send a letter to:
+# Creative Commons, PO Box 1866, Mountain View, CA 94042, USA.
+#
+# Author: James Luscher, jluscher@gmail.com
+#
+#  usage:   python3 retrospex_sim.py [--spectrum SCANS/1P153_12.TXT] ...
+#           python3 scanit_v037.py /dev/pts/N       (the port printed)
+#
+#  Speaks the RetroSPEX protocol (see COMmands in scanit) on a linux pty:
+#  banner handshake, echoes, 'A' HV readback, 'T' integration time, '>'
+#  counting ('! 02' when done), 'P' counter dumps and 'X'/'M' moves at
+#  the stepper speed.  Photon counts come from a spectrum file (EMission
+#  wavelength), with Poisson noise.  'kill -USR1' pushes the front panel
+#  button ('# 1' then '# 0').
+#
+import sys, os, time, select, signal, random, heapq, argparse, math
+import tty
+
+
+#=====================================================================
+## Spectrum  (photon counts vs. wavelength)
+#
+def readSpectrum(fName):
+    '''Read a scan data file ('...' ends the header, tab seperated data).
+    Returns (x-list, counts-per-second-list, excitation nm).'''
+    intTime = 1.0       # seconds (per point)
+    perSec = False      # data already counts per second
+    exNm = 0.0
+    xs, ys = [], []
+    header = True
+    for line in open(fName).read().splitlines():
+        if header:
+            if line.startswith('...'):
+                header = False
+            elif line.startswith('Increment '):     # "... Integration Time 1.0e-001"
+                intTime = float(line.split(',')[1].split()[2])
+            elif line.startswith('Counts Per Second'):  # adaptive integration
+                perSec = True
+            elif line.startswith('Excit Mono') and 'Slits' not in line:
+                exNm = float(line.split()[2])
+        elif line.startswith('___'):
+            break
+        elif line.strip():
+            x,y = line.split('\t')
+            xs.append(float(x))
+            ys.append(float(y) if perSec else float(y) / intTime)
+    return xs, ys, exNm
+
+#----
+def interpolate(xs, ys, x):
+    '''Linear interpolation of ys at x (ends held flat).'''
+    if x <= xs[0]:
+        return ys[0]
+    if x >= xs[-1]:
+        return ys[-1]
+    lo, hi = 0, len(xs) - 1
+    while hi - lo > 1:
+        mid = (lo + hi) // 2
+        if xs[mid] <= x:
+            lo = mid
+        else:
+            hi = mid
+    f = (x - xs[lo]) / (xs[hi] - xs[lo])
+    return ys[lo] + f * (ys[hi] - ys[lo])
+
+#----
+def poisson(mean):
+    '''Poisson distributed count (normal approximation for large means).'''
+    if mean <= 0:
+        return 0
+    if mean > 30:
+        return max(0, int(random.gauss(mean, math.sqrt(mean)) + 0.5))
+    L = math.exp(-mean)
+    k, p = 0, 1.0
+    while True:
+        p *= random.random()
+        if p < L:
+            return k
+        k += 1
+
+
+#=====================================================================
+## RetroSPEX simulator
+#
+class Simulator():
+    '''RetroSPEX controller on the master side of a pty.'''
+    #
+    banner = 'RetroSPEX_Rev-8 (simulator)'
+    #
+    def __init__(self, spectrum=None, latency=1.0, jitter=0.5
+                ,stepsPerSec=2000, stepsNm=50, emNm=500.0, exNm=488.0
+                ,refRate=1.0e5, darkRate=20.0, verbose=False):
+        self.latency  = latency / 1000      # (s) command => response
+        self.jitter   = jitter / 1000       # (s) +/- uniform
+        self.stepRate = stepsPerSec
+        self.stepsNm  = stepsNm
+        self.emStart  = emNm                # nm at EM step 0
+        self.exStart  = exNm                # nm at EX step 0
+        self.refRate  = refRate             # counts/s reference channel
+        self.darkRate = darkRate            # counts/s with no signal
+        self.verbose  = verbose
+        if spectrum:
+            self.specX, self.specY, self.specEx = readSpectrum(spectrum)
+        else:
+            self.specX, self.specY, self.specEx = [0.0, 1.0], [0.0, 0.0], exNm
+        #
+        self.master = self.slave = None
+        self.inBuf  = bytearray()
+        self.out    = []            # heap of (due, seq, bytes)
+        self.seq    = 0
+        self.lastDue = 0.0          # responses leave in order
+        self.connected = False
+        self.nextBanner = 0.0
+        self.reset()
+        self.commands = 0           # counters for reports
+        self.points   = 0
+        self.drop     = {}          # 'M': replies to go before one is lost
+        self.dropping = False       # ... the reply being made now is lost
+        self.dropped  = 0
+    #
+    def reset(self):
+        '''Power up / 'i' warm initialize state.'''
+        self.led      = 0
+        self.dac      = [0, 0]
+        self.adc      = [0, 0]
+        self.intMs    = 0
+        self.counters = [0, 0, 0]
+        self.enabled  = set()
+        self.exSteps  = 0
+        self.emSteps  = 0
+        self.moveDone = {'X': 0.0, 'M': 0.0}    # (s) time a move finishes
+        self.gain     = 0
+        self.invert   = 0
+        self.verbosity = 0
+    #
+    def open(self):
+        '''Open the pty, return the port name for SCANIT.'''
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)
+        os.set_blocking(self.master, False)
+        return os.ttyname(self.slave)
+    #
+    def close(self):
+        for fd in (self.master, self.slave):
+            if fd is not None:
+                os.close(fd)
+        self.master = self.slave = None
+    #
+    #-------- positions
+    #
+    def emNm(self):
+        return self.emStart + self.emSteps / self.stepsNm
+    #
+    def exNm(self):
+        return self.exStart + self.exSteps / self.stepsNm
+    #
+    def signalRate(self):
+        '''Counts/s at the current monochrometer positions.'''
+        em = interpolate(self.specX, self.specY, self.emNm())
+        ex = math.exp(-((self.exNm() - self.specEx) / 40.0)**2)
+        return em * ex + self.darkRate
+    #
+    #-------- output
+    #
+    def send(self, txt, delay=0.0, ordered=True):
+        '''Queue 'txt' (line) to go out after 'delay' + latency (+jitter).'''
+        if self.dropping:               # lost on the way (see 'drop')
+            self.dropping = False
+            self.dropped += 1
+            return
+        now = time.perf_counter()
+        due = now + delay + self.latency + random.uniform(-1,1) * self.jitter
+        if ordered:
+            due = max(due, self.lastDue)        # FIFO with earlier replies
+            self.lastDue = due
+        heapq.heappush(self.out, (due, self.seq, (txt + '\r\n').encode()))
+        self.seq += 1
+    #
+    def button(self, signum=None, frame=None):
+        self.send('# 1', ordered=False)
+        self.send('# 0', 0.2, ordered=False)
+    #
+    #-------- input
+    #
+    def command(self, txt):
+        '''Execute one command line.'''
+        self.commands += 1
+        if self.verbose:
+            print('sim: {!r}'.format(txt))
+        t = txt.split()
+        if not t:
+            return
+        c = t[0]
+        n = self.drop.get(c)            # the command works, its reply is lost
+        if n is not None:
+            if n <= 0:
+                del self.drop[c]
+                self.dropping = True
+            else:
+                self.drop[c] = n - 1
+        try:
+            if c in ('L','E','G','n','v') and len(t) == 2:
+                n = int(t[1])
+                if c == 'L':
+                    self.led = n
+                elif c == 'E':
+                    self.enabled.add(n)
+                    self.counters[n] = 0
+                elif c == 'G':
+                    self.gain = n
+                elif c == 'n':
+                    self.invert = n
+                else:
+                    self.verbosity = n
+                self.send(txt)
+            elif c == 'D' and len(t) == 3:
+                self.dac[int(t[1])] = int(t[2],16)
+                self.send(txt)
+            elif c == 'H' and len(t) == 1:
+                self.adc = [int(v * 0.8192) for v in self.dac]
+                self.send('! 01', 0.005)
+            elif c == 'A' and len(t) == 1:
+                self.send('A {:04X} {:04X}'.format(self.adc[1], self.adc[0]))
+            elif c == 'T' and len(t) == 2:
+                self.intMs = int(t[1],16)
+                self.send(txt)
+            elif c == '>' and len(t) == 1:
+                self.integrate()
+            elif c == 'P' and len(t) == 2:
+                n = int(t[1])
+                self.send('P {} {:012X}'.format(n, self.counters[n] & 0xFFFFFFFFFFFF))
+            elif c in ('X','M') and len(t) == 2:
+                self.move(c, int(t[1],16), txt)
+            elif c in ('i','f') and len(t) == 1:
+                self.reset()
+                self.send(c)
+            elif c == 'b':
+                self.send('B 0')
+            elif c == 'p':
+                self.send('p {:02X}'.format(self.invert))
+            elif c == '?':
+                for line in HELP.strip().splitlines():
+                    self.send(line)
+            else:
+                self.send('e')          # not understood (i.e. '*')
+        except (ValueError, IndexError):
+            self.send('e')
+    #
+    def integrate(self):
+        '''">": count for intMs, then '! 02'.'''
+        sec = self.intMs / 1000
+        now = time.perf_counter()
+        start = max(now, self.moveDone['X'], self.moveDone['M'])
+        if 0 in self.enabled:
+            self.counters[0] += poisson(self.signalRate() * sec)
+        if 1 in self.enabled:
+            self.counters[1] += poisson(self.refRate * sec)
+        if 2 in self.enabled:
+            self.counters[2] += poisson(self.darkRate * sec)
+        self.points += 1
+        self.send('! 02', start - now + sec, ordered=False)
+    #
+    def move(self, axis, steps, txt):
+        '''"X"/"M": move at stepRate, echo when the move is done.'''
+        now = time.perf_counter()
+        start = max(now, self.moveDone[axis])
+        done = start + abs(steps) / self.stepRate
+        self.moveDone[axis] = done
+        if axis == 'X':
+            self.exSteps += steps
+        else:
+            self.emSteps += steps
+        self.send(txt, done - now, ordered=False)
+    #
+    def input(self, data):
+        if not self.connected:
+            if b'\n' in data:               # SCANIT found us
+                self.connected = True
+            data = data[data.find(b'\n')+1:]
+        self.inBuf += data
+        while b'\n' in self.inBuf:
+            end = self.inBuf.index(b'\n')
+            line = self.inBuf[:end].decode('ascii', 'replace').strip('\r')
+            del self.inBuf[:end+1]
+            self.command(line)
+    #
+    #-------- main loop
+    #
+    def step(self, timeout=0.1):
+        '''Wait (up to 'timeout') for input or output due, handle it.'''
+        now = time.perf_counter()
+        if not self.connected and now >= self.nextBanner:
+            os.write(self.master, (self.banner + '\r\n').encode())
+            self.nextBanner = now + 0.1
+        wait = timeout
+        if self.out:
+            wait = min(wait, max(0.0, self.out[0][0] - now))
+        if not self.connected:
+            wait = min(wait, max(0.0, self.nextBanner - now))
+        r,w,x = select.select([self.master], [], [], wait)
+        if r:
+            try:
+                data = os.read(self.master, 4096)
+            except (BlockingIOError, OSError):
+                data = b''
+            if data:
+                self.input(data)
+        now = time.perf_counter()
+        while self.out and self.out[0][0] <= now:
+            os.write(self.master, heapq.heappop(self.out)[2])
+    #
+    def run(self, stop=lambda: False):
+        while not stop():
+            self.step()
+
+
+HELP = '''
+RetroSPEX simulator
+L n  D n FFFF  A  E n  T 7FFFFFFF  >  P n  X s7FFFFFFF  M s7FFFFFFF
+G n  n n  H  i  f  b  p  v n
+'''
+
+
+#=====================================================================
+## command line
+#
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser(description='RetroSPEX simulator (pty)')
+    ap.add_argument('--spectrum', default='SCANS/1P153_12.TXT'
+                   ,help='scan data file giving the EM counts')
+    ap.add_argument('--latency', type=float, default=1.0
+                   ,help='(ms) command to response')
+    ap.add_argument('--jitter', type=float, default=0.5
+                   ,help='(ms) +/- on the latency')
+    ap.add_argument('--steps-per-sec', type=int, default=2000
+                   ,help='stepper motor speed')
+    ap.add_argument('--steps-nm', type=float, default=50
+                   ,help='stepper motor steps per nm (EX and EM)')
+    ap.add_argument('--em', type=float, default=500.0
+                   ,help='(nm) EMission position at power up')
+    ap.add_argument('--ex', type=float, default=488.0
+                   ,help='(nm) EXcitation position at power up')
+    ap.add_argument('--verbose', action='store_true')
+    args = ap.parse_args()
+    #
+    sim = Simulator(args.spectrum, args.latency, args.jitter
+                   ,args.steps_per_sec, args.steps_nm, args.em, args.ex
+                   ,verbose=args.verbose)
+    port = sim.open()
+    signal.signal(signal.SIGUSR1, sim.button)
+    print('RetroSPEX simulator on: {}   (pid {})'.format(port, os.getpid()))
+    sys.stdout.flush()
+    try:
+        sim.run()
+    except KeyboardInterrupt:
+        print('\nsim: {} commands, {} points'.format(sim.commands, sim.points))
+    sim.close()
@@ -0,0 +1,929 @@
+#! /usr/bin/python
+#
+# SCANIT_BENCH - measure the RetroSPEX serial path without the GUI
+#
+# LICENSE:
+# This work is licensed under the Creative Commons Zero License
+# Creative Commons CC0.
+# To view a copy of this license, visit
+# http://directory.fsf.org/wiki/License:CC0
+# or send a letter to:
+# Creative Commons, PO Box 1866, Mountain View, CA 94042, USA.
+#
+# Author: James Luscher, jluscher@gmail.com
+#
+#  usage:   python3 scanit_bench.py reader [--lines N]
+#           python3 scanit_bench.py writer [--cmds N]
+#           python3 scanit_bench.py parser [--lines N]
+#           python3 scanit_bench.py scan [--points N] [--int-ms MS]
+#           python3 scanit_bench.py exscan [--steps-nm 12.5]
+#           python3 scanit_bench.py counts [--samples N ...]
+#           python3 scanit_bench.py program [--int-ms MS]
+#           python3 scanit_bench.py engine [--steps-nm 12.5]   (scanit's own)
+#           python3 scanit_bench.py scan --log session.log   (records it)
+#           python3 scanit_bench.py replay --log session.log [--speed 0]
+#
+import sys, os, time, select, threading, heapq, argparse, asyncio
+import tty, tempfile, math, contextlib, gc, re, ast
+from fractions import Fraction
+import serial
+#
+from retrospex import splitLines, SerialIO, decodeLine, RSPdecode, RetroSPEX
+from retrospex import CountBlock, TrafficLog, ReplayPort, readTrafficLog, TX
+from retrospex import stepTable, stepMoves, compileScan, cmdMove, cmdTimer
+from retrospex_sim import Simulator, interpolate, readSpectrum
+
+
+#=====================================================================
+## Benchmark plumbing
+#
+class MiniLoop():
+    '''Just enough of the Tk event loop (after() and file handlers)
+    to run the serial input routines the way SCANIT does.'''
+    def __init__(self):
+        self.timers = []        # heap of (due, seq, function)
+        self.files  = {}        # fd => function
+        self.seq    = 0
+        self.cancelled = set()  # seq of timers cancelled
+    #
+    def after(self, ms, fn):
+        heapq.heappush(self.timers, (time.perf_counter() + ms/1000, self.seq, fn))
+        self.seq += 1
+        return self.seq - 1
+    #
+    def after_idle(self, fn):
+        return self.after(0, fn)
+    #
+    def after_cancel(self, seq):
+        self.cancelled.add(seq)
+    #
+    def createfilehandler(self, fd, fn):
+        self.files[fd] = fn
+    #
+    def run(self, done):
+        '''Dispatch timers and file events until done() is True.'''
+        while not done():
+            now = time.perf_counter()
+            while self.timers and self.timers[0][0] <= now:
+                due, seq, fn = heapq.heappop(self.timers)
+                if seq in self.cancelled:
+                    self.cancelled.discard(seq)
+                else:
+                    fn()
+            wait = self.timers[0][0] - now if self.timers else 0.1
+            wait = max(0.0, wait)
+            if self.files:
+                r,w,x = select.select(list(self.files), [], [], wait)
+                for fd in r:
+                    self.files[fd]()
+            else:
+                time.sleep(wait)
+
+#----
+class MemPort():
+    '''serial.Serial(timeout=0) look-alike that serves 'data' from memory.'''
+    def __init__(self, data):
+        self.data = memoryview(data)
+        self.pos  = 0
+    #
+    def read(self, n=1):
+        b = self.data[self.pos:self.pos+n].tobytes()
+        self.pos += len(b)
+        return b
+
+#----
+class FdPort():
+    '''serial.Serial(timeout=0) look-alike on a (pty) file descriptor.'''
+    def __init__(self, fd):
+        self.fd = fd
+        os.set_blocking(fd, False)
+    #
+    def fileno(self):
+        return self.fd
+    #
+    def read(self, n=1):
+        try:
+            return os.read(self.fd, n)
+        except BlockingIOError:
+            return b''
+
+#----
+def percentile(data, pct):
+    data = sorted(data)
+    if not data:
+        return 0.0
+    return data[min(len(data)-1, int(len(data) * pct / 100))]
+
+
+#=====================================================================
+## readSerial()  -  per-byte loop [v037] versus chunked reader
+#
+class OldReader():
+    '''readSerial() and parseSerial() scheduling as in scanit v037:
+    one byte per read(), 20 ms polling, after(20) per line.'''
+    def __init__(self, port, loop, onLine):
+        self.port, self.loop, self.onLine = port, loop, onLine
+        self.buf   = ''
+        self.lines = []
+    #
+    def parse(self):
+        if len(self.lines) > 0:
+            self.onLine(self.lines.pop(0))
+    #
+    def read(self, poll=True):
+        while True:
+            c = self.port.read()
+            if c == b'':
+                if poll:
+                    self.loop.after(20, self.read)
+                return
+            c = chr( ord(c)%128 )
+            if c == '\r':
+                continue
+            if c == '\n':
+                self.lines.append(self.buf)
+                self.buf = ''
+                if poll:
+                    self.loop.after(20, self.parse)
+                else:
+                    self.parse()
+            else:
+                self.buf += c
+    #
+    def start(self):
+        self.read()
+
+#----
+class NewReader():
+    '''readSerial() as in scanit: drain the port, splitLines(),
+    parse every whole line at once; Tk file handler wakes it up.'''
+    def __init__(self, port, loop, onLine):
+        self.port, self.loop, self.onLine = port, loop, onLine
+        self.buf   = bytearray()
+        self.lines = []
+    #
+    def read(self):
+        while True:
+            chunk = self.port.read(4096)
+            if not chunk:
+                break
+            self.lines.extend(splitLines(self.buf, chunk))
+            while len(self.lines) > 0:
+                self.onLine(self.lines.pop(0))
+    #
+    def start(self):
+        self.loop.createfilehandler(self.port.fileno(), self.read)
+
+#----
+def readerStream(nLines):
+    '''Typical RetroSPEX input: counter dumps, echoes and alerts.'''
+    pattern = [b'P 0 0000000%05X\r\n', b'L 1\r\n', b'P 1 0000000%05X\r\n'
+              ,b'! 02\r\n', b'A BCD4 5E6A\r\n']
+    out = bytearray()
+    for i in range(nLines):
+        p = pattern[i % len(pattern)]
+        out += p % (i & 0xFFFFF) if b'%' in p else p
+    return bytes(out)
+
+#----
+def benchReaderThroughput(nLines):
+    data = readerStream(nLines)
+    results = {}
+    for name in ('v037', 'chunked'):
+        count = [0]
+        def onLine(line):
+            count[0] += 1
+        port = MemPort(data)
+        t0 = time.perf_counter()
+        if name == 'v037':
+            OldReader(port, None, onLine).read(poll=False)
+        else:
+            NewReader(port, None, onLine).read()
+        dt = time.perf_counter() - t0
+        results[name] = len(data) / dt
+        print('{:>8}: {:12,.0f} bytes/s  {:10,.0f} lines/s  ({} lines)'.format(
+              name, len(data)/dt, count[0]/dt, count[0]))
+    print('{:>8}: x{:.1f}'.format('speedup', results['chunked']/results['v037']))
+    return results
+
+#----
+def benchReaderLatency(nLines, burst=10, gapMs=20):
+    '''Lines carry their send time (us); latency is measured when the
+    line reaches the "parseSerial()" stage.'''
+    for name in ('v037', 'chunked'):
+        master, slave = os.openpty()
+        tty.setraw(slave)
+        port = FdPort(slave)
+        loop = MiniLoop()
+        lat = []
+        def onLine(line):
+            if line.startswith('P '):
+                sent = int(line.split()[2], 16)
+                now = time.perf_counter_ns()//1000 & 0xFFFFFFFFFFFF
+                lat.append((now - sent) / 1000.0)
+        def writer():
+            for i in range(0, nLines, burst):
+                out = bytearray()
+                for j in range(burst):
+                    t = time.perf_counter_ns()//1000 & 0xFFFFFFFFFFFF
+                    out += b'P 0 %012X\r\n' % t
+                os.write(master, out)
+                time.sleep(gapMs/1000)
+        if name == 'v037':
+            reader = OldReader(port, loop, onLine)
+        else:
+            reader = NewReader(port, loop, onLine)
+        reader.start()
+        w = threading.Thread(target=writer, daemon=True)
+        w.start()
+        deadline = time.perf_counter() + 30 + nLines * gapMs / burst / 1000
+        loop.run(lambda: len(lat) >= nLines or time.perf_counter() > deadline)
+        w.join()
+        os.close(master)
+        os.close(slave)
+        print('{:>8}: line latency  median {:7.2f} ms  p99 {:7.2f} ms'
+              '  max {:7.2f} ms  ({} lines)'.format(name, percentile(lat, 50)
+              ,percentile(lat, 99), max(lat) if lat else 0.0, len(lat)))
+
+#----
+def benchReader(args):
+    print('readSerial() throughput (in memory):')
+    benchReaderThroughput(args.lines)
+    print('readSerial() line latency (pty, 10 line bursts every 20 ms):')
+    benchReaderLatency(min(args.lines, 2000), burst=10, gapMs=20)
+
+
+#=====================================================================
+## xmitSerial()  -  per-byte writes [v037] versus the ring buffer
+#
+class SinkPort():
+    '''serial.Serial(write_timeout=0) look-alike: accepts up to 'accept'
+    bytes per write() (what the tty has room for) and counts the calls.'''
+    def __init__(self, accept=256):
+        self.accept = accept
+        self.writes = 0
+        self.nBytes = 0
+    #
+    def write(self, data):
+        n = min(len(data), self.accept)
+        self.writes += 1
+        self.nBytes += n
+        return n
+
+#----
+def writerProgram(nCmds):
+    '''Commands as queued by a scan: move, clear, integrate, dump.'''
+    pattern = ['M +00000032', 'E 0', '>', 'P 0']
+    return [pattern[i % len(pattern)] + '\n' for i in range(nCmds)]
+
+#----
+def oldXmit(port, cmds):
+    '''serBufLoad() / xmitSerial() as in scanit v037.'''
+    serOutBuffer = "".encode()
+    for text in cmds:
+        serOutBuffer = serOutBuffer + text.encode()
+    while len(serOutBuffer) > 0:
+        c = serOutBuffer[0:1]
+        nSent = port.write( c )
+        if nSent == 1:
+            serOutBuffer = serOutBuffer[1:]
+
+#----
+def ringXmit(port, cmds):
+    '''serBufLoad() / SerialIO.send() as in scanit now.'''
+    io = SerialIO(port)
+    serOutBuffer = bytearray()
+    for text in cmds:
+        serOutBuffer += text.encode()
+    io.write(serOutBuffer)
+    io.send()
+    return io
+
+#----
+def benchWriter(args):
+    cmds = writerProgram(args.cmds)
+    print('xmitSerial(): {} commands queued at once ({} bytes)'.format(
+          len(cmds), sum(len(c) for c in cmds)))
+    rate = {}
+    for name, xmit in (('v037', oldXmit), ('ring', ringXmit)):
+        port = SinkPort()
+        t0 = time.perf_counter()
+        io = xmit(port, cmds)
+        dt = time.perf_counter() - t0
+        rate[name] = port.nBytes / dt
+        print('{:>8}: {:12,.0f} bytes/s  {:8} write() calls  {:8.3f} ms'.format(
+              name, port.nBytes/dt, port.writes, dt*1000))
+        if io:
+            print('{:>8}  SerialIO {}'.format('', io.txReport()))
+    print('{:>8}: x{:.1f}'.format('speedup', rate['ring']/rate['v037']))
+
+
+#=====================================================================
+## parseSerial()  -  decode cost per line, by reply type
+#
+parserLines = [ 'L 1', 'D 1 E666', 'A BCD4 5E6A', 'T 000003E8', '! 02'
+              , 'P 0 00000001F4A3', 'M +00000032', '# 1', 'e', 'RetroSPEX_Rev-8' ]
+
+#----
+def parserCost(lines, n):
+    '''(us) per decodeLine() + dispatch for each line in 'lines'.'''
+    action = {'e': len, '#': len}       # stand-ins for parseError, ...
+    cost = []
+    for txt in lines:
+        batch = [txt] * n
+        t0 = time.perf_counter()
+        for t in batch:
+            rsp = decodeLine(t.strip())
+            action.get(rsp.code, len)(rsp)
+        cost.append((time.perf_counter() - t0) / n * 1e6)
+    return cost
+
+#----
+def benchParser(args):
+    n = max(1000, args.lines // len(parserLines))
+    print('parseSerial(): us per line ({} each)'.format(n))
+    print('{:>16}  {}'.format('table size', '  '.join('{:>6}'.format(t[:6])
+          for t in parserLines)))
+    spare = [chr(c) for c in range(0x21, 0x7F) if chr(c) not in RSPdecode]
+    added = 0
+    for more in (0, 20, 60):
+        while added < more:             # more reply types in the table
+            RSPdecode[spare[added]] = lambda txt: (txt,)
+            added += 1
+        cost = parserCost(parserLines, n)
+        print('{:>16}  {}'.format(len(RSPdecode), '  '.join('{:6.2f}'.format(c)
+              for c in cost)))
+    for c in spare[:added]:
+        del RSPdecode[c]
+
+
+#=====================================================================
+## 'P n' counter dumps  -  per line int(x,16) versus CountBlock (numpy)
+#
+def countLines(n):
+    return ['P {} {:012X}'.format(i & 1, (i * 2654435761) & 0xFFFFFFFFFFFF)
+            for i in range(n)]
+
+#----
+def benchCounts(args):
+    print("'P n' decoding: samples/s")
+    for n in args.samples:
+        lines = countLines(n)
+        t0 = time.perf_counter()
+        perLine = [decodeLine(t).args[1] for t in lines]
+        tLine = time.perf_counter() - t0
+        #
+        t0 = time.perf_counter()
+        block = CountBlock()
+        block.extend(lines)
+        tAdd = time.perf_counter() - t0
+        t0 = time.perf_counter()
+        chan, count, valid = block.decode()
+        tDecode = time.perf_counter() - t0
+        assert valid.all() and count.tolist() == perLine
+        print('{:>9,} samples:  per line {:12,.0f}   block {:12,.0f}'
+              '   (decode only {:14,.0f})  x{:.1f}'.format(n, n/tLine
+              ,n/(tAdd+tDecode), n/tDecode, tLine/(tAdd+tDecode)))
+
+
+#=====================================================================
+## Scan programs  -  compile time and size, per point cost of sending
+#
+def onTheFly(axis, steps, intMs, ref):
+    '''The commands of a scan formatted as it goes (as before compileScan).'''
+    out = [(cmdTimer(intMs) + '\n').encode()]
+    at = 0
+    for s in steps:
+        if s != at:
+            out.append((cmdMove(axis, s - at) + '\n').encode())
+            at = s
+        for n in range(2 if ref else 1):
+            out.append(('E {}'.format(n) + '\n').encode())
+        out.append(('>' + '\n').encode())
+        for n in range(2 if ref else 1):
+            out.append(('P {}'.format(n) + '\n').encode())
+    return out
+
+#----
+def programQueue(ns, prog):
+    '''(s) scanit's scanQueuePoint() and the crQappend() of the dumps, for
+    every point of 'prog', queued only (serOutReady False).'''
+    ns['serOutReady'] = False
+    ns['scanProg'], ns['scanPre'], ns['scanPost'] = prog, [], []
+    ns['scanLoad'](prog)
+    ns['scanNext'], ns['adaptOn'] = 0, False
+    t0 = time.perf_counter()
+    for i in range(len(prog.pre)):
+        ns['scanQueuePoint']()
+        for e in ns['scanPost'][i]:
+            ns['crQappend'](e)
+        for q in ns['crQ']:
+            q.clear()
+    return time.perf_counter() - t0
+
+#----
+def programLoop(ns, xs):
+    '''(s) an EX scan of the points 'xs' through scanit's engine, every
+    command answered at once (no I/O): queue, send, parse, 'nxt'.'''
+    ns['serOutReady'] = True
+    ns['serIO'] = SerialIO(SinkPort())      # (not started: bytes pile up)
+    for var, v in (('varLiveEXpos', '200'), ('varLiveEMpos', '500')
+                  ,('varEXwaveStart', str(xs[0])), ('varEXwaveEnd', str(xs[-1]))
+                  ,('varEXinc', str(xs[1] - xs[0])), ('varEXstepsNm', '12.5')
+                  ,('varEMwaveStart', '500'), ('varEMstepsNm', '12.5')
+                  ,('varTMinc', '0.01'), ('varAdaptErr', '0'), ('varRefine', '0')):
+        ns[var].set(v)
+    t0 = time.perf_counter()
+    with open(os.devnull, 'w') as null, contextlib.redirect_stdout(null):
+        ns['scannerState'] = ns['STATEscan']
+        ns['scanStart'](ns['EXscan'])
+        while ns['crQfly']:
+            cmd = ns['crQfly'][0][0]
+            if cmd == '>':
+                rsp = '! 02'
+            elif cmd[0] == 'P':
+                rsp = cmd + ' 000000001000'
+            else:
+                rsp = cmd                   # echo
+            ns['serInLines'].append(rsp)
+            ns['parseSerial']()
+    assert ns['scanMode'] is None and len(ns['scanDataX']) == len(xs)
+    return time.perf_counter() - t0
+
+#----
+def benchProgram(args):
+    '''Compile time and size of EX scans, and per point: scanit queueing
+    the compiled entries, a whole engine pass and formatting on the fly.'''
+    print('scan programs (EX, 12.5 steps/nm, reference on): compile, size,'
+          ' per point cost')
+    os.environ['HOME'] = tempfile.mkdtemp()     # scan files go there
+    for inc in ('1', '0.5', '0.1'):
+        xs, steps = stepTable(200, 1000, inc, '12.5', 200)
+        t0 = time.perf_counter()
+        prog = compileScan('X', xs, steps, args.int_ms, True)
+        tCompile = time.perf_counter() - t0
+        ns = loadEngine()
+        ns['refOn'], ns['jjltest'] = True, True     # (scanit's defaults)
+        tQueue = programQueue(ns, prog)
+        tLoop = programLoop(ns, xs)
+        t0 = time.perf_counter()
+        fly = onTheFly('X', steps, args.int_ms, True)
+        tFly = time.perf_counter() - t0
+        assert fly == [t.wire for t in prog.steps()]
+        n = len(xs)
+        print('{:>6} points: compiled in {:6.2f} ms, {:6} commands, {:7}'
+              ' bytes, estimate {:7.1f} s;  per point: queued {:.2f} us,'
+              ' engine {:.2f} us, formatted {:.2f} us'.format(n, tCompile*1000
+              ,len(prog), prog.size, prog.seconds, tQueue/n*1e6, tLoop/n*1e6
+              ,tFly/n*1e6))
+
+
+#=====================================================================
+## EM scan  -  acquisition throughput against the simulator
+#
+def startSimulator(**kw):
+    '''Simulator on a pty, running in a (daemon) thread; returns (sim, port).'''
+    sim = Simulator(**kw)
+    port = sim.open()
+    threading.Thread(target=sim.run, daemon=True).start()
+    return sim, port
+
+#----
+async def monoScan(port, axis, moves, intMs, stepsPerSec, log=None
+                  ,pipelined=False):
+    '''Scan monochrometer 'axis' ('X'/'M'): moves[i] steps before point i,
+    then clear, count, dump; one command at a time, or 'pipelined': the
+    next move (and clear) goes out with the dumps, as scanit's scan engine
+    does.  Returns (counts, seconds).'''
+    spex = await RetroSPEX.open(port)
+    if log:
+        spex.io.log = TrafficLog(log, port=port, firmware=spex.firmware)
+    spex.stepsPerSec = stepsPerSec
+    move = spex.moveEX if axis == 'X' else spex.moveEM
+    await spex.setTimer(intMs)
+    counts = []
+    t0 = time.perf_counter()
+    if pipelined:
+        if moves[0]:
+            await move(moves[0])
+        await asyncio.gather(spex.enable(0), spex.enable(1))
+    for i in range(len(moves)):
+        if not pipelined:
+            if moves[i]:
+                await move(moves[i])
+            await spex.enable(0)
+            await spex.enable(1)
+        await spex.integrate()
+        if not pipelined:
+            counts.append((await spex.dump(0), await spex.dump(1)))
+            continue
+        work = [spex.dump(0), spex.dump(1)]
+        if i < len(moves) - 1:
+            if moves[i+1]:
+                work.append(move(moves[i+1]))
+            work += [spex.enable(0), spex.enable(1)]
+        c = await asyncio.gather(*work)
+        counts.append((c[0], c[1]))
+    dt = time.perf_counter() - t0
+    spex.close()
+    return counts, dt
+
+#----
+def benchScan(args):
+    stepsNm, stepsPerSec = 50, 20000
+    stepsPt = int(200 * stepsNm / max(1, args.points - 1))
+    ideal = args.points * args.int_ms / 1000 \
+          + (args.points-1) * stepsPt / stepsPerSec
+    for name,pipelined in [('scan', False), ('pipelined', True)]:
+        sim, port = startSimulator(spectrum=args.spectrum, latency=args.latency
+                                  ,stepsPerSec=stepsPerSec, stepsNm=stepsNm)
+        if not pipelined:
+            print('EM scan on simulator {}: {} points, {} ms integration,'
+                  ' {} steps/point, {} ms latency'.format(port, args.points
+                  ,args.int_ms, stepsPt, args.latency))
+        moves = [0] + [stepsPt] * (args.points-1)
+        counts, dt = asyncio.run(monoScan(port, 'M', moves, args.int_ms
+                                         ,stepsPerSec
+                                         ,None if pipelined else args.log
+                                         ,pipelined))
+        print('{:>9}: {:8.1f} points/s  {:7.2f} ms/point  {:3.0f}% of the limit'
+              ' (counting + moving {:.2f} ms/point)'.format(name
+              ,args.points/dt, dt/args.points*1000, 100*ideal/dt
+              ,ideal/args.points*1000))
+        print('{:>9}: {:7.2f} ms/point  ({} commands)'.format('overhead'
+              ,(dt-ideal)/args.points*1000, sim.commands))
+    # the counts should follow the spectrum (within Poisson noise)
+    sec = args.int_ms / 1000
+    dev = []
+    for i,(c,ref) in enumerate(counts):
+        nm = 500.0 + i * stepsPt / stepsNm
+        expect = (interpolate(sim.specX, sim.specY, nm) + sim.darkRate) * sec
+        dev.append(abs(c - expect) / max(1.0, expect)**0.5)
+    print('{:>9}: {:.2f} sigma mean deviation from the spectrum'.format(
+          'counts', sum(dev)/len(dev)))
+    peak = max(range(len(counts)), key=lambda i: counts[i][0])
+    print('{:>9}: {:.1f} nm  ({} counts)'.format('peak'
+          ,500.0 + peak * stepsPt / stepsNm, counts[peak][0]))
+
+#----
+def benchEXscan(args):
+    '''EX scan 400~600 nm by 1 nm, --steps-nm (default 12.5, not a whole
+    number of steps per nm): moves from the exact step table against
+    moves of a rounded increment added up, where the error accumulates.'''
+    stepsPerSec, origin = 20000, 488.0      # simulator EX is at 488 nm
+    nms, steps = stepTable(400, 600, 1, args.steps_nm, origin)
+    inc = int(float(args.steps_nm) + 0.5)   # per 1 nm, rounded once
+    tables = [ ('table', stepMoves(steps))
+             , ('added', [steps[0]] + [inc] * (len(nms)-1)) ]
+    print('EX scan on simulator: {} points {}~{} nm, {} steps/nm, {} ms'
+          ' integration, {} ms latency'.format(len(nms), nms[0], nms[-1]
+          ,args.steps_nm, args.int_ms, args.latency))
+    for name,moves in tables:
+        sim, port = startSimulator(spectrum=args.spectrum, latency=args.latency
+                                  ,stepsPerSec=stepsPerSec
+                                  ,stepsNm=float(args.steps_nm), exNm=origin)
+        counts, dt = asyncio.run(monoScan(port, 'X', moves, args.int_ms
+                                         ,stepsPerSec, None, True))
+        ideal = len(nms) * args.int_ms / 1000 \
+              + sum(abs(m) for m in moves) / stepsPerSec
+        peak = max(range(len(counts)), key=lambda i: counts[i][0])
+        print('{:>9}: {:8.1f} points/s  {:3.0f}% of the limit;  ends at {:.2f}'
+              ' nm ({:+.2f});  peak {} nm (simulator {} nm)'.format(name
+              ,len(nms)/dt, 100*ideal/dt
+              ,sim.exNm(), sim.exNm() - nms[-1], nms[peak], sim.specEx))
+
+
+#=====================================================================
+## Scan engine  -  scanit's own crQ, resync and scan code, headless
+#
+# The sections of scanit_v037.py named in ENGINEsections run as they are,
+# on a MiniLoop in place of Tk, connected to the simulator.  The globals
+# they use (ENGINEglobals) are read from scanit's own assignments, then
+# ENGINEbench overrides the few that differ here.  Only the GUI around them
+# is stood in for (BenchVar for the Tk variables, no plot).
+# Each case checks its result: 'engine' exits 1 if any case failed.
+#
+ENGINEsections = ( 'Utility functions', 'command/response Queue'
+                 , 'Resynchronization', 'Scan engine' )
+ENGINEglobals = ( 'jjltest', 'comtest', 'crqtest', 'serialPort', 'portName'
+                , 'serOutReady', 'serOutBuffer', 'serInLines', 'serIO'
+                , 'serIOwake', 'serIOpollMs', 'serOutBudget', 'serOutIdle'
+                , 'xmitCalls', 'xmitBytes', 'xmitStart', 'scanDataX'
+                , 'scanDataY', 'EXscan', 'EMscan', 'TMscan', 'scanName'
+                , 'STATEstop', 'STATEscan', 'STATEpause', 'scannerState'
+                , 'MINnm', 'MAXnm', 'thisSys', 'firmwareVer', 'refOn' )
+ENGINEbench = { 'jjltest': False        # quiet
+              , 'thisSys': 'bench'      # no Tk file handler: polled
+              , 'serIOpollMs': 2        # ... by the MiniLoop
+              , 'EOL': '\n'             # (set per OS, inside an 'if')
+              , 'portName': 'SIM', 'serOutReady': True }   # connected
+
+class BenchVar():
+    '''Tk StringVar stand-in.'''
+    def __init__(self, value=''):
+        self.value = value
+    def get(self):
+        return self.value
+    def set(self, value):
+        self.value = value
+
+class BenchBox():
+    '''tkinter.messagebox stand-in: dialogs are printed.'''
+    @staticmethod
+    def showerror(title, msg):
+        print('{:>9}: [{}] {}'.format('dialog', title, msg))
+
+#----
+def loadEngine(fName=os.path.join(os.path.dirname(os.path.abspath(__file__))
+                                 ,'scanit_v037.py')):
+    '''scanit's imports (no GUI), its settings (ENGINEglobals) and
+    ENGINEsections, run in a namespace with the GUI stood in for; returns
+    the namespace (dict).'''
+    lines = open(fName).read().split('\n')
+    imports = [l for l in lines[:60] if l.startswith(('import ', 'from '))
+               and 'tkinter' not in l and 'matplotlib' not in l]
+    heads = [i for i,l in enumerate(lines) if l.startswith('## ')] + [len(lines)]
+    code = []
+    for title in ENGINEsections:
+        found = [i for i in heads[:-1] if lines[i][3:].startswith(title)]
+        assert len(found) == 1, '{}: {} "## {}" sections'.format(
+                                fName, len(found), title)
+        i = found[0]
+        code += lines[i:heads[heads.index(i)+1]]
+    ns = {}
+    exec('\n'.join(imports), ns)
+    for name in ENGINEglobals:          # scanit's own values, in its order
+        found = [l for l in lines if re.match(name+r'\s*=[^=]', l)]
+        assert len(found) == 1, '{}: {} "{} =" lines'.format(
+                                fName, len(found), name)
+        value = ast.parse(found[0]).body[0].value
+        ns[name] = eval(compile(ast.Expression(value), fName, 'eval'), ns)
+    ns.update(ENGINEbench)
+    ns.update({ 'cmdLine': argparse.Namespace(record=None), 'mBox': BenchBox
+              , 'siWin': MiniLoop(), 'updatePlot': lambda: None
+              , 'runScfB00': {}, 'scanStartIcon': None })
+    for name in ( 'varLiveEXpos', 'varLiveEMpos', 'varEXwaveStart'
+                , 'varEXwaveEnd', 'varEXinc', 'varEXstepsNm', 'varEMwaveStart'
+                , 'varEMwaveEnd', 'varEMinc', 'varEMstepsNm', 'varTMinc'
+                , 'varTMwaveEnd', 'varTMwavePause', 'varAdaptErr'
+                , 'varAdaptMin', 'varAdaptMax', 'varRefine', 'varPCTdone'
+                , 'varLiveSignal', 'varLiveReference', 'varSpecimenDetails'
+                , 'varScanDataFileName' ):
+        assert any(re.match(name+r'\s*=[^=]', l) for l in lines), \
+               '{}: no "{} =" line'.format(fName, name)
+        ns[name] = BenchVar()
+    exec(compile('\n'.join(code), fName, 'exec'), ns)
+    ns['writePositions'] = lambda: None     # not the real positions.txt
+    return ns
+
+#----
+def engineConnect(ns, port):
+    '''Open the simulator's port the way portScan() does, start the I/O.'''
+    sp = serial.Serial(port=port, baudrate=115200, timeout=0
+                      ,rtscts=1, dsrdtr=True, write_timeout=0)
+    got = b''
+    t0 = time.perf_counter()
+    while b'RetroSPEX' not in got and time.perf_counter() - t0 < 5:
+        got += sp.read(256)
+        time.sleep(0.01)
+    sp.write(b'\n')
+    ns['serialPort'] = sp
+    ns['startSerialIO']()
+
+#----
+def engineRun(ns, start, limit=60.0):
+    '''Run start() (scanStart/tmStart) to the end of the scan; seconds.'''
+    ns['scannerState'] = ns['STATEscan']
+    gc.collect()                        # (not in the middle of the scan)
+    t0 = time.perf_counter()
+    if start() is False:
+        return None
+    ns['siWin'].run(lambda: ns['scanMode'] is None
+                    or time.perf_counter() - t0 > limit)
+    return time.perf_counter() - t0
+
+#----
+def engineDeviation(ns, sim, intSec, worst=False):
+    '''Mean (or 'worst') deviation (sigma) of the EM scan data from the
+    spectrum.'''
+    dev = []
+    for x,y in zip(ns['scanDataX'], ns['scanDataY']):
+        rate = interpolate(sim.specX, sim.specY, x) + sim.darkRate
+        if ns['scanPerSec']:
+            dev.append(0.0)             # checked through the times
+        else:
+            dev.append(abs(y - rate*intSec) / max(1.0, rate*intSec)**0.5)
+    if worst:
+        return max(dev, default=0.0)
+    return sum(dev) / max(1, len(dev))
+
+#----
+def benchEngine(args):
+    '''EX, EM, adaptive and TM scans through scanit's engine, with replies
+    lost on the way (a '>', a dump, a move, a '>' in a TM scan) and an
+    error while a '>' is still waiting to go out.'''
+    stepsNm, stepsPerSec = float(args.steps_nm), 20000
+    os.environ['HOME'] = tempfile.mkdtemp()     # scan files go there
+    results = []
+    def case(name, ok, txt):
+        results.append(ok)
+        print('{} {:>9}: {}'.format('PASS' if ok else 'FAIL', name, txt))
+    def setup(drop=None, **settings):
+        sim, port = startSimulator(spectrum=args.spectrum, latency=args.latency
+                                  ,stepsPerSec=stepsPerSec, stepsNm=stepsNm)
+        sim.drop = drop or {}
+        ns = loadEngine()
+        ns['crQstepsPerSec'] = stepsPerSec
+        values = dict( varLiveEXpos='488', varLiveEMpos='500'
+                     , varEXwaveStart='400', varEXwaveEnd='600', varEXinc='1'
+                     , varEMwaveStart='500', varEMwaveEnd='700', varEMinc='1'
+                     , varEXstepsNm=args.steps_nm, varEMstepsNm=args.steps_nm
+                     , varTMinc=str(args.int_ms/1000), varTMwaveEnd='2'
+                     , varTMwavePause='0', varAdaptErr='0', varAdaptMin='0.005'
+                     , varAdaptMax='0.2', varRefine='0' )
+        values.update(settings)
+        for k,v in values.items():
+            ns[k].set(v)
+        engineConnect(ns, port)
+        return sim, ns
+    intSec = args.int_ms / 1000
+    #
+    sim, ns = setup()
+    dt = engineRun(ns, lambda: ns['scanStart'](ns['EMscan']))
+    n, X = len(ns['scanDataX']), ns['scanDataX']
+    dev = engineDeviation(ns, sim, intSec)
+    case('em', n == 201 and X == sorted(X) and abs(sim.emNm() - 700) < 1e-9
+         and dev < 2, '{} points in {:.2f} s, ends at {:.2f} nm, {:.2f} sigma'
+         ' from the spectrum'.format(n, dt, sim.emNm(), dev))
+    #
+    sim, ns = setup()
+    dt = engineRun(ns, lambda: ns['scanStart'](ns['EXscan']))
+    n = len(ns['scanDataX'])
+    case('ex', n == 201 and abs(sim.exNm() - 600) < 1e-9
+         and abs(sim.emNm() - 500) < 1e-9, '{} points in {:.2f} s, EX ends at'
+         ' {:.2f} nm, EM at {:.2f} nm'.format(n, dt, sim.exNm(), sim.emNm()))
+    #
+    sim, ns = setup()                   # ends between whole nm, 3 times
+    off = []
+    for start, end, inc in (('500', '599.9', '0.3'), ('600', '649.9', '0.7')
+                           ,('650', '700', '1')):
+        for var, v in (('varEMwaveStart', start), ('varEMwaveEnd', end)
+                      ,('varEMinc', inc)):
+            ns[var].set(v)
+        engineRun(ns, lambda: ns['scanStart'](ns['EMscan']))
+        want = math.floor(Fraction(str(ns['scanDataX'][-1])) * Fraction(
+               args.steps_nm) + Fraction(1,2))
+        off.append(round(sim.emNm() * stepsNm) - want)
+    case('repeat', off == [0, 0, 0], 'EM scans ending at 599.9, 649.7 and'
+         ' 700 nm: {} steps off'.format(off))
+    #
+    sim, ns = setup(drop={'>': 30})
+    dt = engineRun(ns, lambda: ns['scanStart'](ns['EMscan']))
+    n = len(ns['scanDataX'])
+    dev = engineDeviation(ns, sim, intSec)
+    case("lost '>'", n == 201 and ns['scanRecounts'] == 1 and dev < 2
+         and sim.dropped == 1, '{} points in {:.2f} s, {} counted again,'
+         ' {:.2f} sigma'.format(n, dt, ns['scanRecounts'], dev))
+    #
+    sim, ns = setup(drop={'P': 60})
+    dt = engineRun(ns, lambda: ns['scanStart'](ns['EMscan']))
+    n = len(ns['scanDataX'])
+    dev = engineDeviation(ns, sim, intSec, worst=True)
+    case('lost dump', n == 201 and dev < 5 and sim.dropped == 1, '{} points'
+         ' in {:.2f} s, worst point {:.2f} sigma from the spectrum'.format(n
+         ,dt, dev))
+    #
+    sim, ns = setup()
+    load, sent = ns['serBufLoad'], []
+    def loadErr(text):                  # 'e' with the 40th '>' still unsent
+        load(text)
+        if text[:1] in ('>', b'>'):
+            sent.append(text)
+            if len(sent) == 40:
+                ns['serInLines'].append('e')
+                ns['parseSerial']()
+    ns['serBufLoad'] = loadErr
+    dt = engineRun(ns, lambda: ns['scanStart'](ns['EMscan']))
+    n = len(ns['scanDataX'])
+    case('unsent', n == 201 and sim.points == 201 and not ns['resyncLost']
+         and not ns['serOutBuffer'], "{} points in {:.2f} s, {} '>' counted"
+         ", {} commands lost".format(n, dt, sim.points, len(ns['resyncLost'])))
+    #
+    sim, ns = setup(drop={'M': 50})
+    dt = engineRun(ns, lambda: ns['scanStart'](ns['EMscan']))
+    n = len(ns['scanDataX'])
+    dev = engineDeviation(ns, sim, intSec)
+    ended = ns['scanMode'] is None and bool(ns['scanAborted'])
+    again = engineRun(ns, lambda: ns['scanStart'](ns['EMscan']))
+    case('lost move', ended and 0 < n < 201 and dev < 2 and again is not None
+         and ns['scanMode'] is None, 'ended after {} points ({:.2f} s, {:.2f}'
+         ' sigma), the next scan ran: {} points'.format(n, dt, dev
+         ,len(ns['scanDataX'])))
+    #
+    sim, ns = setup(varAdaptErr='3', varRefine='5')
+    dt = engineRun(ns, lambda: ns['scanStart'](ns['EMscan']))
+    X, P, T = ns['scanDataX'], ns['scanDataP'], ns['adaptTimes']
+    need = ns['adaptNeed']
+    short = [t for t,y in zip(T, ns['scanDataY']) if y*t < need*0.99
+             and t < ns['adaptMaxMs']/1000]
+    xs, ys, ex = readSpectrum(ns['varScanDataFileName'].get())
+    case('adaptive', X == sorted(X) and len(set(X)) == len(X) and 2 in P
+         and not short and len(xs) == len(X), '{} of 201 points ({} refined)'
+         ' in {:.2f} s, {:.3f}~{:.3f} s each, file {} points'.format(len(X)
+         ,P.count(2), dt, min(T), max(T), len(xs)))
+    #
+    sim, ns = setup(drop={'>': 8}, varTMinc='0.05')
+    dt = engineRun(ns, ns['tmStart'])
+    X = ns['scanDataX']
+    gaps = [b - a for a,b in zip(X, X[1:])]
+    ns['varTMinc'].set('0.02')          # no time left to count: refused
+    short = ns['tmStart']() is False and ns['scanMode'] is None
+    case("TM lost '>'", ns['scanMode'] is None and len(X) > 10 and min(gaps) > 0
+         and 1 <= ns['tmMissed'] < 20 and short, '{} samples in {:.2f} s, {}'
+         ' slots skipped, median gap {:.3f} s; 0.02 s refused: {}'.format(len(X)
+         ,dt, ns['tmMissed'], percentile(gaps, 50), short))
+    #
+    print('{} of {} cases passed'.format(sum(results), len(results)))
+    if not all(results):
+        sys.exit(1)
+
+
+#=====================================================================
+## Replay  -  a recorded session back through SerialIO and the parser
+#
+def benchReplay(args):
+    if not args.log:
+        sys.exit('replay: --log FILE (a traffic log) is needed')
+    meta, frames = readTrafficLog(args.log)
+    nTx = sum(len(d) for t,dr,d in frames if dr == TX)
+    nRx = sum(len(d) for t,dr,d in frames if dr != TX)
+    print('{}: {} frames, {} bytes TX, {} bytes RX, {:.2f} s recorded'
+          ' ({}, {})'.format(args.log, len(frames), nTx, nRx
+          ,frames[-1][0] if frames else 0.0, meta.get('port')
+          ,meta.get('firmware')))
+    port = ReplayPort(args.log, args.speed)
+    done = threading.Event()
+    io = SerialIO(port, notify=done.set, readTimeout=0.01)
+    codes = {}
+    nLines = 0
+    tParse = 0.0
+    t0 = time.perf_counter()
+    io.start()
+    while not (port.done() and not io.rxLines):
+        done.wait(0.1)
+        done.clear()
+        lines = io.takeLines()
+        t1 = time.perf_counter()
+        for txt in lines:
+            rsp = decodeLine(txt.strip())
+            codes[rsp.code] = codes.get(rsp.code, 0) + 1
+        tParse += time.perf_counter() - t1
+        nLines += len(lines)
+    dt = time.perf_counter() - t0
+    io.stop()
+    io.join(1.0)
+    print('{:>8}: {} lines in {:.3f} s (speed {}), parse {:.2f} us/line'.format(
+          'replay', nLines, dt, args.speed, tParse/max(1,nLines)*1e6))
+    print('{:>8}: {}'.format('replies', '  '.join('{} {}'.format(c, codes[c])
+          for c in sorted(codes))))
+
+
+#=====================================================================
+## command line
+#
+benchmarks = { 'reader': benchReader
+             , 'writer': benchWriter
+             , 'parser': benchParser
+             , 'scan'  : benchScan
+             , 'exscan': benchEXscan
+             , 'counts': benchCounts
+             , 'program': benchProgram
+             , 'engine': benchEngine
+             , 'replay': benchReplay
+             }
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser(description='SCANIT serial path benchmarks')
+    ap.add_argument('bench', choices=sorted(benchmarks))
+    ap.add_argument('--lines', type=int, default=100000
+                   ,help='number of input lines (reader, parser)')
+    ap.add_argument('--cmds', type=int, default=4000
+                   ,help='number of queued commands (writer)')
+    ap.add_argument('--points', type=int, default=201
+                   ,help='number of scan points (scan)')
+    ap.add_argument('--int-ms', type=int, default=10
+                   ,help='(ms) integration time per point (scan, exscan)')
+    ap.add_argument('--latency', type=float, default=1.0
+                   ,help='(ms) simulator response latency (scan)')
+    ap.add_argument('--samples', type=int, nargs='+', default=[100000, 1000000]
+                   ,help="numbers of 'P n' lines (counts)")
+    ap.add_argument('--log', metavar='FILE'
+                   ,help='traffic log to record (scan) or to play back (replay)')
+    ap.add_argument('--speed', type=float, default=0.0
+                   ,help='replay speed, 1 = as recorded, 0 = no waiting (replay)')
+    ap.add_argument('--steps-nm', default='12.5'
+                   ,help='EX motor steps per nm (exscan)')
+    ap.add_argument('--spectrum', default='SCANS/1P153_12.TXT'
+                   ,help='spectrum for the simulator (scan)')
+    args = ap.parse_args()
+    benchmarks[args.bench](args)
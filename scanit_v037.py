@@ -12,8 +12,10 @@
 #
 # Author: James Luscher, jluscher@gmail.com
 #
-import sys, string, time
-import serial
+import sys, os, string, time, json, argparse, math
+from fractions import Fraction
+from collections import deque
+from bisect import bisect
 #
 from pathlib import Path
 #
@@ -35,6 +37,11 @@ from matplotlib.figure import Figure
 
 import numpy 
 from numpy import searchsorted
+#
+from retrospex import SerialIO, rspMatch, decodeLine, serialById, probePorts
+from retrospex import LatencyHistogram, TrafficLog, ReplayPort, TimerWheel
+from retrospex import cmdTimer, ALERTtimer, stepTable, compileScan
+from retrospex import featureIntervals, COUNTmax
 
 
 siTitle = 'SCANIT for RetroSPEX [v037]'   # Program name and version
@@ -101,14 +108,23 @@ RSPnorm  = ['?','r','s','p','B','A','P']
 serialPort = None           # we always start before any port is found
 portName   = 'OFFLINE'      # ... and any connection established
 serOutReady = False         # RetroSPEX has been Initialized
-crQbusy     = False         # RetroSPEX is executing a command (busy)
-crQcmd      = ''            # ... command being executed
-crQrsp      = ''            # ... response being awaited
-crQnxt      = None          # ... function to execute upon response.
+crQbusy     = False         # RetroSPEX is executing command(s) (busy)
+crQcmd      = ''            # ... command last executed
+crQrsp      = ''            # ... response received for it
+crQnxt      = None          # ... function executed upon response.
+crQreply    = None          # ... response decoded (retrospex.Reply)
 #
-serInBuffer = ""            # 'string' type (character input storage)
-serOutBuffer = "".encode()  # 'byte' type
+serOutBuffer = bytearray()  # 'bytes' type (handed to serIO to send)
 serInLines   = []           # list of complete input lines
+#
+serIO       = None          # I/O thread, owns serialPort once it is found
+serIOwake   = None          # pipe (read,write): serIO wakes up Tk on input
+serIOpollMs = 10            # ... or Tk polls, where no file handler (win32)
+serOutBudget = 512          # (bytes) hand over at once when this much waits
+serOutIdle  = None          # after_idle() id: hand over pending bytes
+xmitCalls   = 0             # hand overs to serIO (each a single write)
+xmitBytes   = 0             # ... bytes in them
+xmitStart   = None          # (s) time of the first hand over
 
 
 #=====================================================================
@@ -150,6 +166,16 @@ varEXinc = StringVar()   # Setting EX Inc   Wavelength (nm)
 varEMinc = StringVar()   # Setting EM Inc   Wavelength (nm)
 varTMinc = StringVar()   # Setting TM Inc   time (s)
 #
+# Adaptive integration (EX/EM scans):  each point counts until its relative
+# Poisson error (1/sqrt(counts)) reaches varAdaptErr, within min/max time
+varAdaptErr = StringVar()   # target relative error (%), 0 => off (varTMinc)
+varAdaptMin = StringVar()   # shortest integration time (s)
+varAdaptMax = StringVar()   # longest integration time (s)
+#
+# Adaptive sampling (EX/EM scans):  a coarse pass every varRefine increments,
+# then the fine increment only where the coarse data has features
+varRefine = StringVar()     # coarse pass increment (x Inc), 0 or 1 => off
+#
 #==============
 #  Site  Established Settings:   
 #  recovered from configuration data ('settings.txt')
@@ -288,13 +314,31 @@ print('This System: {}'.format(thisSys))
 if thisSys == 'linux':
     portList = ['/dev/ttyACM0','/dev/ttyACM1', '/dev/ttyACM2', 'OFFLINE']
 elif thisSys == 'win32':
-    portList = list('COM'+str(x) for x in range(99,0,-1)).append('OFFLINE')
+    portList = list('COM'+str(x) for x in range(99,0,-1)) + ['OFFLINE']
     # ports = ['COM99', 'COM98', ... 'COM2', 'COM1', 'COM0', 'OFFLINE']
 else:
     msg_ = 'ERROR','Operating System not recognized: {}'
     messagebox.showifo(msg_.format(thisSys))
     sys.exit(0)
 #
+# command line:  ports named are tried first
+#   i.e.  python3 scanit_v037.py /dev/pts/3   (retrospex_sim.py)
+#         python3 scanit_v037.py --record session.log
+#         python3 scanit_v037.py --replay session.log --speed 0
+argp = argparse.ArgumentParser(description='SCANIT - RetroSPEX spectrometer')
+argp.add_argument('ports', nargs='*'
+                 ,help='serial port(s) to try first')
+argp.add_argument('--record', metavar='FILE'
+                 ,help='record serial traffic (TX/RX) to FILE')
+argp.add_argument('--replay', metavar='FILE'
+                 ,help='play back a recorded session instead of a port')
+argp.add_argument('--speed', type=float, default=1.0
+                 ,help='replay speed (1 = as recorded, 0 = no waiting)')
+cmdLine = argp.parse_args()
+portList = cmdLine.ports + portList
+portScanSec = 3.0       # (s) longest search for RetroSPEX (all ports at once)
+portCache = 'port.txt'  # last port RetroSPEX was found on (tried first)
+#
 if thisSys == 'linux':
     #monoFont = font.Font(family='Ubuntu Mono', size=10)
     monoFont = font.Font(family='Ubuntu Mono', size=16)
@@ -352,6 +396,10 @@ def setScannerState(state):
     global blinkSpeed, blinkOnTime, blinkOffTime, scannerState
     scannerState = state
     blinkOnTime, blinkOffTime  =   blinkSpeed[state]
+    if blinkAfter:
+        blinkSchedule()     # current phase ends on the new duty cycle
+    if scanMode == TMscan:
+        tmState()           # pause, resume or stop the TM scan
     return
 
 #----------------------------------------
@@ -539,162 +587,204 @@ def setPlotTitle():
     ax.set_title( title )
     return
     
-parseError = False
+#----
+def parseError(rsp):
+    '''"e": error from RetroSPEX (or the expected reply to '*').'''
+    # was 'e' expected ??
+    i = crQmatch(rsp.txt)
+    if i >= 0:          # this is an expected 'error' (synchronizing)
+        crQdone(i, rsp)     # execute 'nxt' function
+        return
+    # unexpected error: out of step with RetroSPEX, recover
+    i = crQfailed()
+    if i < 0:
+        resyncStart('error: "{}" (no command)'.format(rsp.txt))
+    else:
+        resyncStart('error after "{}"'.format(crQfly[i][0]), i)
+    return
 
 #----
-def parseSerial():
-    '''
-    '''
-    global serInLines, parseError
-    global crQ, crQbusy, crQcmd, crQrsp, crQnxt
-    if len(serInLines) > 0 :
-        #
-        txt = serInLines.pop(0).strip() # grab input line
-        # print('parseSerial(): "{}"'.format(txt))
-        #
-        ## = Error message
-        if txt == 'e':  # ERROR message from RetroSPEX
-            # was 'e' expected ??
-            if crQrsp == 'e':    # this is an expected 'error' (synchronizing)
-                crQnxt()            # execute 'nxt' function
-                parseError = False  # clear Error flag
-                crQbusy = False     # command executed, allow next command
-            else:   # unexpected error
-                if parseError:      # don't resend command more than once
-                    parseError = False
-                    crQbusy = False     # command IGNORED, allow next command
-                else:
-                    parseError = True   # repeat sent command one time
-                    print('parseSerial(): error: "{}"'.format(txt))
-                    print('parseSerial(): resend cmd: "{}"'.format(crQcmd))
-                    serBufLoad(crQcmd + EOL)  # ... put command into 'send queue'
-        #
-        ## = COMPLETE ECHO OF ISSUED COMMAND (i.e.  "L 0", "L 1", "T #", ...)
-        elif txt == crQrsp:    # response to previous command ?
-            #
-            if crqtest:
-                print('parseSerial(): rsp: "{}"'.format(crQrsp))
-                print('parseSerial(): execute nxt: {}'.format(crQnxt))
-            crQnxt()            # execute 'nxt' function
-            crQbusy = False     # command executed, allow next command
-        #
-        ## = ADC => returned voltage
-        elif txt.startswith('A ') and crQcmd == 'A':    # Read Voltage
-            #
-            crQrsp = txt        # 'txt' response is in correct format
-            if crqtest:
-                print('parseSerial(): rsp: "{}"'.format(crQrsp))
-                print('parseSerial(): execute nxt: {}'.format(crQnxt))
-            crQnxt()            # execute 'nxt' function
-            crQbusy = False     # command executed, allow next command
-        #
-        ## = FRONT PANEL BUTTON => PUSH ( '# 1' ) / RELEASE ( '# 0' )
-        elif txt.startswith('# '):  # Front Panel Button action
-            #
-            # NOTE: UNSOLICITED COMMAND => NOT A RESPONSE TO COMMAND ISSUED
-            #
-            print('parseSerial(): BUTTON: "{}"'.format(txt))
-            panelButton(txt)       # 'txt' = button's message
-        #
-        ## = UNRECOGNIZED RESPONSE
-        else:
-            #
-            if crqtest:
-                print('parseSerial(): unknown: "{}"'.format(txt))
-                print('parseSerial(): LINE - ignored <for now>')
-            crQbusy = False     # command executed, allow next command
+def parseButton(rsp):
+    '''"# 1" / "# 0": FRONT PANEL BUTTON => PUSH / RELEASE'''
+    #
+    # NOTE: UNSOLICITED COMMAND => NOT A RESPONSE TO COMMAND ISSUED
     #
+    print('parseSerial(): BUTTON: "{}"'.format(rsp.txt))
+    panelButton(rsp.txt)       # 'txt' = button's message
     return
 
-# BONtime = 0
-# BONlist = []
+#----
+def parseResponse(rsp):
+    '''Response to a command in flight: echo ("L 0", "T #", ...), 'A'
+    voltages, 'P' counts or a '!' (done) alert.'''
+    i = crQmatch(rsp.txt)
+    if i >= 0 and rsp.args is None:     # fits, but garbled: command failed
+        resyncStart('garbled "{}" for "{}"'.format(rsp.txt, crQfly[i][0]), i)
+    elif i >= 0:
+        crQdone(i, rsp)     # execute 'nxt', allow next command(s)
+    #
+    ## = UNRECOGNIZED RESPONSE
+    elif crqtest:
+        print('parseSerial(): unknown: "{}"'.format(rsp.txt))
+        print('parseSerial(): LINE - ignored <for now>')
+    return
+
+#
+# What to do with each line, by first character (see retrospex.decodeLine)
+# RSPalert:  '!' may complete a command ('H', '>'), '#' never does.
+# RSPnorm, COMchr0 echoes and anything else:  parseResponse()
+RSPaction = { 'e' : parseError
+            , '#' : parseButton
+            }
+#
+parseLines = 0      # lines parsed
+parseTime  = 0.0    # ... (s) total time spent parsing them
+
+#----
+def parseSerial():
+    '''Act on all waiting input lines from RetroSPEX (one pass):
+    responses to commands in flight (see crQfly), errors and
+    unsolicited button messages.'''
+    global serInLines, parseLines, parseTime
+    lines = serInLines
+    serInLines = []
+    t0 = time.perf_counter()
+    for txt in lines:
+        try:
+            rsp = decodeLine(txt.strip())   # Reply: code, args, txt
+            # print('parseSerial(): "{}"'.format(rsp))
+            if resyncing:
+                resyncLine(rsp)             # recovering: not for crQ
+            else:
+                RSPaction.get(rsp.code, parseResponse)(rsp)
+        except Exception as e:      # one bad line must not cost the rest
+            print('parseSerial(): "{}": {!r}'.format(txt.strip(), e))
+            crQsend()               # ... nor stall the queue
+    parseLines += len(lines)
+    parseTime  += time.perf_counter() - t0
+    return
+
+#----
+def parseReport():
+    '''Average time spent on each input line (includes 'nxt' functions).'''
+    if parseLines == 0:
+        return 'parseSerial(): no lines'
+    return 'parseSerial(): {} lines, {:.1f} us/line'.format(parseLines
+           ,parseTime / parseLines * 1e6)
 
 #----
 def readSerial():
-    global serInBuffer, serInLines, crQ, blinkOnTime
-#     global BONtime, BONlist # diagnose lengthening of blink on time
-    full = True
-    while full:
-        c = serialPort.read()   # attempt to read a 'byte' from Serial
-        #
-        # was anything read ?
-        if c == b'':
-            if comtest:
-                print('^',end='')
-            full = False                # no serial data available now
-            siWin.after(20, readSerial) # check serial again soon
-            return
-        else:
-            c = chr( ord(c)%128 )       # 'bytes' (7-bit) to 'string' type
-        
-        # check if character is a delimeter
-        if c == '\r':
-            continue # don't want returns. ignore it
-        
-        if c == '\n':
-            # the buffer contains an entire line - less the 'newline'
-            # proccess the line now.
-            if crqtest:
-                print('LINE: {}'.format(serInBuffer))
-#             if serInBuffer.startswith('L 1'):
-#                 Btime = int((time.time() - BONtime)*1000)
-#                 BONlist.append(Btime)
-#                 if len(BONlist) > 2000:
-#                     f=open('testTimes.txt','w')
-#                     f.write(str(BONlist))
-#                     f.close()
-#                     print('BONlist(): Closed')
-#                     sys.exit(0)
-#                 print('Btime: {}ms  len(crQ): {}  blinkOnTime: {}'.format(Btime, len(crQ), blinkOnTime))
-            serInLines.append(serInBuffer)  # add to list of input lines
-            serInBuffer = ''                # empty the buffer
-            #siWin.update_idletasks()
-            siWin.after(20, parseSerial)     # respond to input line
-        else:
-            serInBuffer += c # add to the buffer
-    #siWin.update_idletasks()
-    siWin.after(20, readSerial) # check serial again soon
+    '''Take (in one batch) every line the I/O thread has received
+    and hand them to parseSerial().'''
+    global serInLines
+    if serIOwake:
+        try:
+            os.read(serIOwake[0], 4096)     # clear the wake-up bytes
+        except BlockingIOError:
+            pass
+    if serIO.error:
+        print('readSerial(): {}'.format(serIO.error))
+        mBox.showerror('Communication Failure','Lost connection to RetroSPEX')
+        sys.exit(0)
+    #
+    lines = serIO.takeLines()
+    if comtest and not lines:
+        print('^',end='')
+    if crqtest:
+        for line in lines:
+            print('LINE: {}'.format(line))
+    serInLines.extend(lines)            # add to list of input lines
+    parseSerial()                       # respond to all input lines
+    return
+
+#----
+def readSerialPoll():
+    '''Polled input, for systems without Tk file handlers (win32).'''
+    readSerial()
+    siWin.after(serIOpollMs, readSerialPoll) # check for input again soon
+    return
+
+#----
+def serIOnotify():
+    '''Called by the I/O thread (NOT Tk!) when input lines are waiting.'''
+    try:
+        os.write(serIOwake[1], b'!')    # Tk file handler => readSerial()
+    except BlockingIOError:
+        pass                            # ... Tk has plenty of wake-ups
+    return
+
+#----
+def startSerialIO():
+    '''Hand serialPort to the I/O thread and monitor its input (once).
+    On linux the thread wakes Tk through a pipe as soon as lines arrive,
+    otherwise Tk polls every 'serIOpollMs'.'''
+    global serIO, serIOwake
+    if serIO:
+        return                      # already running
+    if thisSys == 'linux':
+        serIOwake = os.pipe()
+        os.set_blocking(serIOwake[0], False)
+        os.set_blocking(serIOwake[1], False)
+        siWin.tk.createfilehandler(serIOwake[0], READABLE
+                                  ,lambda fd, mask: readSerial())
+        serIO = SerialIO(serialPort, notify=serIOnotify)
+    else:
+        serIO = SerialIO(serialPort)
+        siWin.after(serIOpollMs, readSerialPoll)
+    if cmdLine.record:
+        serIO.log = TrafficLog(cmdLine.record, port=portName, firmware=firmwareVer)
+    serIO.start()
     return
 
 
 #----
 def xmitSerial():
-    global serOutBuffer,serialPort,serOutReady
+    '''Hand the transmit buffer over to the I/O thread for sending.'''
+    global serOutBuffer, serOutIdle, xmitCalls, xmitBytes, xmitStart
+    if serOutIdle:
+        siWin.after_cancel(serOutIdle)
+        serOutIdle = None
     if comtest:
         print('.',end='')
-#     if serOutReady:
-#         print('.',end='')
-    while serOutReady and len(serOutBuffer) > 0:    # Anything to send out?
-        # send byte
-        c = serOutBuffer[0:1]
-        # print('xmitSerial(): send byte {}'.format(c))
-        try:
-            nSent = serialPort.write( c )
-        except:
-            mBox.showerror('Communication Failure','Lost connection to RetroSPEX')
-            sys.exit(0)
-        # print('nSent: {}'.format(nSent))
-        if nSent != OKser:  # show transmit error
-            if comtest:
-                patrn = 'xmitSerial({}),ERROR: status => {}, retry.'
-                print(patrn.format(c,repr(nSent)))
-        else:   # GOOD send
-            if comtest:
-                patrn = 'xmitSerial({}), SENT: status => {}.'
-                print(patrn.format(c,repr(nSent)))
-            # remove sent character from the buffer
-            serOutBuffer = serOutBuffer[1:] 
+    if serOutReady and len(serOutBuffer) > 0:    # Anything to send out?
+        if xmitStart is None:
+            xmitStart = time.perf_counter()
+        xmitCalls += 1
+        xmitBytes += len(serOutBuffer)
+        serIO.write(serOutBuffer)       # serIO's ring buffer takes it all
+        serOutBuffer = bytearray()
     return
 
+#----
+def xmitReport():
+    '''Hand overs (and port writes) per second, bytes per write.'''
+    if not xmitCalls:
+        return 'xmitSerial(): nothing sent'
+    dt = max(1e-6, time.perf_counter() - xmitStart)
+    msg = 'xmitSerial(): {} hand overs ({:.1f}/s, {:.1f} bytes each)'.format(
+          xmitCalls, xmitCalls/dt, xmitBytes/xmitCalls)
+    if serIO and serIO.txWrites:
+        msg += ', port: {:.1f} writes/s, {:.1f} bytes/write'.format(
+               serIO.txWrites/dt, serIO.txBytes/serIO.txWrites)
+    return msg
+
 #----
 def serBufLoad(text):
-    global serOutBuffer
+    '''Add 'text' (str, or bytes already encoded) to the transmit buffer.
+    Everything queued during one pass of the Tk event loop goes out
+    together (after_idle), or at once when 'serOutBudget' bytes are waiting.'''
+    global serOutBuffer, serOutIdle
     #
     # convert 'string' characters to 'bytes' for output
-    serOutBuffer = serOutBuffer + text.encode() # add to transmit buffer
+    if isinstance(text, str):
+        text = text.encode()
+    serOutBuffer += text            # add to transmit buffer
     if crqtest:
         print('serBufLoad(text): serOutBuffer: {}'.format(serOutBuffer))
-    xmitSerial()
+    if len(serOutBuffer) >= serOutBudget:
+        xmitSerial()
+    elif serOutIdle is None:
+        serOutIdle = siWin.after_idle(xmitSerial)
     return
 
     
@@ -772,45 +862,623 @@ def dataFileREAD():
 #
 ## command/response Queue
 #
-crQ = []            # PATTERN OF "entry": [cmd,resp,nxt]
+crQ = [deque(), deque(), deque()]   # lanes, by priority (see crQlane)
+                    # PATTERN OF "entry": [cmd,resp,nxt]
                     # where; cmd = "D 0 0000", rsp = "D 0 0000", nxt = <func>
-                   
+                    # rsp may use '#' for any value, i.e. "A # #"
+                    # (crQappend() adds: time queued, timeouts so far)
+crQfly = []         # commands sent, awaiting response (oldest first):
+                    #    [cmd,resp,nxt,tries,tQueued,tSent,deadline]
+crQwindow = 4       # most commands 'in flight' at once  (1 => one at a time)
+#
+# Ordering constraints:  a command is not sent while a command that it may
+# not overlap is in flight (checked both ways).  '*' => overlaps nothing.
+crQnoOverlap = { '>' : '>PETXM'     # counting: no dump/clear/timer/motion
+               , 'X' : 'XM'         # one monochrometer move at a time
+               , 'M' : 'XM'
+               , 'H' : 'HAD'        # HV conversion: no read or DAC change
+               , '*' : '*'          # synchronizing: alone
+               , 'i' : '*'          # resets: alone
+               , 'f' : '*'
+               }
+# ... and not while one of these, for the same register, is in flight:
+crQnoOverlapReg = { 'P' : 'E'       # a dump before the clear behind it
+                  , 'E' : 'P'
+                  }
+#
+# Priority lanes:  the first lane with a command that may go now is sent
+# from; a command waiting longer than its lane's 'crQstarve' goes first.
+LANEscan    = 0     # acquisition: moves, timer, counting, dumps, resets
+LANEcontrol = 1     # control: HV DACs, gain, inversion
+LANEhouse   = 2     # housekeeping: LED blink, HV monitoring
+crQlanes = { 'X':LANEscan, 'M':LANEscan, 'T':LANEscan, 'E':LANEscan
+           , '>':LANEscan, 'P':LANEscan, '*':LANEscan, 'i':LANEscan
+           , 'f':LANEscan
+           , 'D':LANEcontrol, 'G':LANEcontrol, 'n':LANEcontrol
+           , 'L':LANEhouse, 'H':LANEhouse, 'A':LANEhouse
+           }
+crQstarve  = [0.0, 0.25, 0.5]   # (s) longest wait before jumping the lanes
+crQhouseMax = 1     # housekeeping commands in flight at once (at most)
+crQcoalesce = 'LHA' # housekeeping: a newer command replaces a queued one
+crQlaneSent = [0, 0, 0]     # commands sent, by lane
+crQwire     = {}            # cmd => bytes (with EOL) encoded beforehand
+crQcoalesced = 0            # ... replaced before being sent
+
+#
+# Queue timing, by command letter (histograms, see retrospex):
+#   'wait'  queued => sent     (time spent in crQ)
+#   'wire'  sent => parsed     (RetroSPEX + serial link + parseSerial)
+#   'total' queued => parsed
+crQstats = {}       # 'L': {'wait':<hist>, 'wire':<hist>, 'total':<hist>}
+crQstatsFile = 'linkstats.json'     # crQdump() output
+
+#----
+def crQtiming(entry):
+    '''Add the times of a completed command to crQstats.'''
+    now  = time.perf_counter()
+    wait = entry[5] - entry[4]
+    wire = now - entry[5]
+    st = crQstats.get(entry[0][0])
+    if st is None:
+        st = crQstats[entry[0][0]] = { 'wait' : LatencyHistogram()
+                                     , 'wire' : LatencyHistogram()
+                                     , 'total': LatencyHistogram() }
+    st['wait'].record(wait)
+    st['wire'].record(wire)
+    st['total'].record(now - entry[4])
+    if crqtest:
+        patrn = 'crQtiming(): "{}" queued {:.1f} ms, on the wire {:.1f} ms'
+        print(patrn.format(entry[0], wait*1000, wire*1000))
+    return
+
+#----
+def crQreport():
+    '''Queue wait versus wire time for each command (ms).'''
+    lines = ['cmd   count   queued:  p50    p99    max'
+             '    wire:  p50    p99    max']
+    for c in sorted(crQstats):
+        wait, wire = crQstats[c]['wait'], crQstats[c]['wire']
+        lines.append(' {}  {:7}          {:6.1f} {:6.1f} {:6.1f}'
+                     '         {:6.1f} {:6.1f} {:6.1f}'.format(c, wire.count
+                     , wait.percentile(50)*1000, wait.percentile(99)*1000
+                     , wait.max/1000, wire.percentile(50)*1000
+                     , wire.percentile(99)*1000, wire.max/1000))
+    lines.append('lanes (scan/control/house): sent {}, coalesced {}'.format(
+                 '/'.join(str(n) for n in crQlaneSent), crQcoalesced))
+    lines.append('blink: {} L commands, {} transitions collapsed'.format(
+                 blinkSent, blinkCollapsed))
+    lines.append(shadowReport())
+    lines.append('deadlines: {} missed, {} pending'.format(crQexpiries
+                 ,crQwheel.count))
+    lines.append(resyncReport())
+    lines.append(scanReport())
+    return '\n'.join(lines)
+
+#----
+def crQdump(fName=None):
+    '''Write crQstats (and link totals) as json to 'fName'.'''
+    data = { 'time'    : time.strftime('%Y-%m-%d %H:%M:%S')
+           , 'port'    : portName
+           , 'firmware': firmwareVer
+           , 'window'  : crQwindow
+           , 'lanes'   : { 'sent': crQlaneSent, 'coalesced': crQcoalesced }
+           , 'shadow_saved': shadowSaved
+           , 'resync': { 'times': resyncTimes.toDict(), 'lost': resyncLost }
+           , 'commands': { c: { k: h.toDict() for k,h in crQstats[c].items() }
+                           for c in sorted(crQstats) }
+           , 'parse'   : { 'lines': parseLines, 'seconds': parseTime }
+           }
+    if serIO:
+        data['tx'] = { 'bytes': serIO.txBytes, 'writes': serIO.txWrites
+                     , 'bytes_per_sec': serIO.txRate()
+                     , 'handovers': xmitCalls, 'handover_bytes': xmitBytes
+                     , 'queue_bytes': serIO.txDepth()
+                     , 'queue_max': serIO.txDepthMax
+                     , 'stalls': serIO.txStalls, 'stall_sec': serIO.txStalled }
+    fo = open(fName or crQstatsFile,'w')
+    json.dump(data, fo, indent=1)
+    fo.close()
+    return
+
+#----
+def crQmayOverlap(cmd):
+    '''True if "cmd" may be sent while the crQfly commands execute.'''
+    mine = crQnoOverlap.get(cmd[0], '')
+    reg  = crQnoOverlapReg.get(cmd[0], '')
+    for f in crQfly:
+        theirs = crQnoOverlap.get(f[0][0], '')
+        if mine == '*' or theirs == '*' or f[0][0] in mine or cmd[0] in theirs:
+            return False
+        if f[0][0] in reg and f[0][2:] == cmd[2:]:
+            return False
+    return True
+
+#----
+def crQmatch(txt):
+    '''Index of the oldest command in flight that "txt" responds to, or -1.'''
+    for i,f in enumerate(crQfly):
+        if rspMatch(f[1], txt):
+            return i
+    return -1
+
+#----
+def crQfailed():
+    '''Index of the command an unexpected 'e' belongs to (or -1): the
+    oldest in flight that is not waiting for a '!' (done) alert.'''
+    for i,f in enumerate(crQfly):
+        if not f[1].startswith('!'):
+            return i
+    return len(crQfly) - 1
+
+#----
+def crQdone(i, rsp):
+    '''"rsp" (Reply) is the response to crQfly[i], execute its 'nxt'.'''
+    global crQbusy, crQcmd, crQrsp, crQnxt, crQreply
+    entry = crQfly.pop(i)
+    crQwheel.cancel(entry[6])
+    crQtiming(entry)
+    shadowConfirm(entry[0])
+    resyncBlamed.pop(entry[0], None)
+    crQcmd = entry[0]       # ... command executed
+    crQrsp = rsp.txt        # ... 'txt' response is in correct format
+    crQreply = rsp          # ... and its decoded fields
+    crQnxt = entry[2]       # ... function to execute upon response.
+    crQbusy = len(crQfly) > 0
+    if crqtest:
+        print('parseSerial(): rsp: "{}"'.format(crQrsp))
+        print('parseSerial(): execute nxt: {}'.format(crQnxt))
+    crQnxt()            # execute 'nxt' function
+    crQsend()           # room in the window for the next command(s)
+    return
+
+#
+# Shadow of RetroSPEX registers:  the last command acknowledged for each
+# (see shadowKey).  A command repeating it, with no other write to that
+# register queued or in flight, is not sent; its 'nxt' runs at once.
+# 'E n' (enable, clear counter) stays valid only until a '>' is counted.
+shadow = {}             # 'T': 'T 000003E8',  'D 1': 'D 1 E666', ...
+shadowSaved = {}        # round trips saved (this scan), by command letter
+
+#----
+def shadowKey(cmd):
+    '''Register written by "cmd" ('T','G','n','D n','E n'), else None.'''
+    if cmd[0] in 'TGn':
+        return cmd[0]
+    if cmd[0] in 'DE' and len(cmd) > 2:
+        return cmd[0:3]
+    return None
+
+#----
+def crQpending(test):
+    '''True if a command queued or in flight passes 'test(cmd)'.'''
+    for q in crQ:
+        for e in q:
+            if test(e[0]):
+                return True
+    for f in crQfly + resyncFly:
+        if test(f[0]):
+            return True
+    return False
+
+#----
+def shadowElide(entry):
+    '''True (and 'nxt' done) if "entry" would not change RetroSPEX.'''
+    global crQcmd, crQrsp, crQnxt, crQreply
+    cmd = entry[0]
+    key = shadowKey(cmd)
+    if key is None or shadow.get(key) != cmd:
+        return False
+    if crQpending(lambda c: shadowKey(c) == key):
+        return False            # another value is on its way
+    if key[0] == 'E' and crQpending(lambda c: c[0] == '>'):
+        return False            # counter will not stay clear
+    shadowSaved[cmd[0]] = shadowSaved.get(cmd[0], 0) + 1
+    if crqtest:
+        print('shadowElide(): "{}" already set'.format(cmd))
+    crQcmd = cmd            # as if RetroSPEX had echoed it
+    crQrsp = cmd
+    crQreply = decodeLine(cmd)
+    crQnxt = entry[2]
+    crQnxt()
+    return True
+
+#----
+def shadowConfirm(cmd):
+    '''"cmd" has been acknowledged: update the shadow registers.'''
+    key = shadowKey(cmd)
+    if key:
+        shadow[key] = cmd
+    elif cmd[0] in 'if':        # resets
+        shadow.clear()
+    elif cmd[0] == '>':         # counters are no longer clear
+        for key in [k for k in shadow if k[0] == 'E']:
+            del shadow[key]
+    return
+
+#----
+def shadowReport():
+    if not shadowSaved:
+        return 'shadow: no round trips saved'
+    return 'shadow: round trips saved: {}'.format(', '.join('{} {}'.format(c
+           ,shadowSaved[c]) for c in sorted(shadowSaved)))
+
+#----
+def crQlane(cmd):
+    '''Priority lane for "cmd" (by command letter, default: control).'''
+    return crQlanes.get(cmd[0], LANEcontrol)
+
+#----
+def crQpick():
+    '''Lane whose oldest command is to be sent next, or -1 if none may
+    go now (window full, overlap, housekeeping limit, resync, OFFLINE:
+    commands only wait in the queue).'''
+    if not serOutReady or resyncing or len(crQfly) >= crQwindow:
+        return -1
+    now = time.perf_counter()
+    starved = [l for l,q in enumerate(crQ)
+               if len(q) > 0 and l != LANEscan and now - q[0][3] > crQstarve[l]]
+    house = sum(1 for f in crQfly if crQlane(f[0]) == LANEhouse)
+    for l in starved + list(range(len(crQ))):
+        if len(crQ[l]) == 0 or not crQmayOverlap(crQ[l][0][0]):
+            continue
+        if l == LANEhouse and house >= crQhouseMax:
+            continue
+        return l
+    return -1
+
 #----
 def crQsend():
-    '''If no command is active, start sending one to RetroSPEX.'''
-    global crQ, serOutReady, crQbusy, crQcmd, crQrsp, crQnxt
-    global BONtime  # diagnose blink ON time
-    if not crQbusy and len(crQ) > 0:
-        crQbusy = True          # now, busy doing the command below:
-        crQlist = crQ.pop(0)        # hold command list: [ cmd, rsp, nxt ]
-        crQcmd      = crQlist[0]    # ... command being executed
-        if crQcmd == "L 1":  # blink ON
-            BONtime = time.time()
-        crQrsp      = crQlist[1]    # ... response being awaited
-        crQnxt      = crQlist[2]    # ... function to execute upon response.
-        serBufLoad(crQcmd + EOL)    # ... put command into 'send queue'
-    else:
-        siWin.after(200, crQsend)        # check again later on
+    '''Send commands to RetroSPEX while the window has room (crQwindow)
+    and the next command may overlap those in flight, highest priority
+    lane first (see crQpick).
+    Called when a command is queued and when a response is parsed
+    (no polling): a command held back now goes when the one blocking
+    it has finished.'''
+    global crQ, crQbusy, crQintMs
+    lane = crQpick()
+    while lane >= 0:
+        crQlist = crQ[lane].popleft()   # hold command list: [ cmd, rsp, nxt, tQueued, tries ]
+        crQlaneSent[lane] += 1
+        if crQlist[0][0] == 'T':
+            crQintMs = int(crQlist[0][2:],16)   # for '>' timeouts
+        # in flight (no resend yet)
+        crQfly.append( crQlist[0:3] + [crQlist[4], crQlist[3], time.perf_counter(), None] )
+        crQdeadline(crQfly[-1])
+        serBufLoad(crQwire.get(crQlist[0]) or crQlist[0] + EOL) # 'send queue'
+        lane = crQpick()
+    crQbusy = len(crQfly) > 0
     return
 
     
-def crQappend(entry):
-    '''Put "entry" into the crQ.
+def crQappend(entry, lane=None):
+    '''Put "entry" into the crQ ('lane', default by command letter).
+    A housekeeping command replaces one of its kind still waiting.
     Trigger sending to RetroSPEX.'''
-    global crQ,serOutReady
-    #
-    crQ.append(entry)   # append this command to Queue
-    if jjltest and entry[0][0] != 'L':
-        print('crQappend(entry): {!r}'.format(entry))
+    global crQ,serOutReady,crQcoalesced
+    #
+    if shadowElide(entry):
+        return          # RetroSPEX already has this setting
+    if lane is None:
+        lane = crQlane(entry[0])
+    q = crQ[lane]
+    for queued in q:
+        if lane == LANEhouse and entry[0][0] in crQcoalesce \
+                             and queued[0][0] == entry[0][0]:
+            queued[0:3] = entry[0:3]    # newest wins, keeps its place
+            crQcoalesced += 1
+            break
+    else:
+        q.append( entry[0:3] + [time.perf_counter(), 0] )   # append this command to Queue
     # display new queue contents
     if crqtest:
+        print('crQappend(entry): {!r}'.format(entry))
         print('crQappend(entry): crQ:')
-        for i in crQ:
-            print('\t{}'.format(i))
+        for l,q in enumerate(crQ):
+            for i in q:
+                print('\t{} {}'.format(l, i))
     crQsend()           # insure command sending is active
     return
 
 
+#
+## Resynchronization  -  after an unexpected 'e' or a response timeout
+#
+# Sending stops and the bytes not yet written to the port are dropped
+# (serOutBuffer, serIO).  Commands in flight that never reached the port
+# go back to the front of their lanes, as do idempotent ones that did
+# (others are reported lost); input is discarded until the link is quiet;
+# '*' must be answered by 'e' followed by quiet.  Then the shadow
+# registers are replayed and the queue resumes.  No waiting in here:
+# every step is an after() timer or an input line.
+#
+crQtimeout  = 1.0       # (s) response time allowed beyond the work itself
+crQstepsPerSec = 1000   # stepper speed, for 'X'/'M' timeouts
+crQintMs    = 0         # integration time last sent ('T'), for '>'
+crQidempotent = 'LDTGnEAHP'     # safe to send again
+#
+resyncing   = False     # recovering: crQ stopped, input goes to resyncLine
+resyncState = ''        # 'drain' (serIO dropping), 'flush' (waiting for
+                        # quiet) or 'sync' ('*' sent)
+resyncReason = ''
+resyncTry   = 0         # handshakes that went unanswered
+resyncTries = 5         # ... before giving up (the queue is flushed)
+resyncGaveUp = False    # the last recovery failed: RetroSPEX not answering
+resyncQuietMs = 50      # input quiet this long => flushed / in step
+resyncWaitMs  = 250     # first wait for 'e' (doubles each retry)
+resyncAfter = None      # after() id of the pending step
+resyncT0    = 0.0       # (s) start of recovery
+resyncFlushT0 = 0.0     # (s) start of this flush
+resyncGotE  = False
+resyncShadow = {}       # registers to replay
+resyncFly   = []        # crQfly when recovery began (sorted out by resyncDrain)
+resyncFailed = -1       # ... index of the command blamed
+resyncUnsent = 0        # ... bytes of them that never reached the port
+resyncBlamed = {}       # cmd => recoveries it caused (dropped on the 2nd)
+resyncLost  = []        # commands that could not be repeated
+crQonLost   = {}        # '>': hook(entry)  -  a command resync could not repeat
+crQtimeouts = {}        # '>': fn(cmd) => (s)  -  replaces crQcmdTimeout() rules
+resyncTimes = LatencyHistogram()    # recovery times
+
+#----
+def crQcmdTimeout(cmd):
+    '''(s) longest wait for the response to "cmd".'''
+    fn = crQtimeouts.get(cmd[0])
+    if fn:
+        return fn(cmd)
+    if cmd[0] == '>':
+        return crQintMs/1000 + crQtimeout
+    if cmd[0] in 'XM':
+        return abs(int(cmd[2:].replace(' ',''),16)) / crQstepsPerSec + crQtimeout
+    return crQtimeout
+
+#
+# Every command in flight has a deadline (crQcmdTimeout) in one timer
+# wheel; a single after() chain advances it while deadlines are pending.
+crQwheel    = TimerWheel(0.010)
+crQtickMs   = 10        # wheel advanced this often (while armed)
+crQticking  = False
+crQretries  = 1         # timeouts of an idempotent command resent ...
+                        # ... before resynchronizing
+crQonTimeout = {}       # 'X': hook(entry)  -  replaces crQexpired() rules
+crQexpiries = 0         # deadlines missed
+
+#----
+def crQdeadline(entry):
+    '''(Re)arm the deadline of crQfly "entry", from now.'''
+    global crQticking
+    crQwheel.cancel(entry[6])
+    entry[6] = crQwheel.add(time.perf_counter() + crQcmdTimeout(entry[0]), entry)
+    if not crQticking:
+        crQticking = True
+        siWin.after(crQtickMs, crQtick)
+    return
+
+#----
+def crQtick():
+    '''Advance the timer wheel, act on expired commands.'''
+    global crQticking
+    for entry in crQwheel.advance():
+        if any(f is entry for f in crQfly):
+            crQexpired(entry)
+    if crQwheel.count > 0:
+        siWin.after(crQtickMs, crQtick)
+    else:
+        crQticking = False
+    return
+
+#----
+def crQexpired(entry):
+    '''No response to "entry" in time.  Its crQonTimeout hook decides;
+    otherwise an idempotent command goes back to the front of its lane to
+    be sent again (crQretries), through crQsend so the ordering rules still
+    hold (a 'P n' never after its 'E n'), and anything else starts a resync.'''
+    global crQexpiries
+    crQexpiries += 1
+    hook = crQonTimeout.get(entry[0][0])
+    if hook:
+        hook(entry)
+    elif resyncing:
+        return
+    elif entry[0][0] in crQidempotent and entry[3] < crQretries:
+        print('crQexpired(): timeout, resend cmd: "{}"'.format(entry[0]))
+        i = [j for j,f in enumerate(crQfly) if f is entry][0]
+        del crQfly[i]
+        crQ[crQlane(entry[0])].appendleft( entry[0:3] + [entry[4], entry[3] + 1] )
+        crQsend()
+    else:
+        i = [j for j,f in enumerate(crQfly) if f is entry][0]
+        resyncStart('timeout: "{}"'.format(entry[0]), i)
+    return
+
+#----
+def resyncStart(reason, failed=-1):
+    '''Begin recovery ('failed' = index in crQfly of the command blamed):
+    stop sending, drop what has not gone out yet (see resyncDrain).'''
+    global resyncing, resyncReason, resyncTry, resyncT0, resyncShadow, crQbusy
+    global resyncState, resyncFailed, resyncUnsent, serOutBuffer, serOutIdle
+    global resyncGaveUp
+    if resyncing:
+        return
+    print('resync: {}'.format(reason))
+    resyncing = True
+    resyncGaveUp = False
+    resyncReason = reason
+    resyncTry = 0
+    resyncT0 = time.perf_counter()
+    resyncShadow = { k:v for k,v in shadow.items() if k[0] != 'E' }
+    shadow.clear()      # RetroSPEX state no longer known
+    #
+    if serOutIdle:
+        siWin.after_cancel(serOutIdle)
+        serOutIdle = None
+    resyncUnsent = len(serOutBuffer)
+    serOutBuffer = bytearray()
+    if serIO:
+        serIO.discard()             # ... and its ring (in the I/O thread)
+    for f in crQfly:
+        crQwheel.cancel(f[6])
+    resyncFly[:] = crQfly
+    resyncFailed = failed
+    crQfly.clear()
+    crQbusy = False
+    resyncState = 'drain'
+    resyncDrain()
+    return
+
+#----
+def resyncDrain():
+    '''Once serIO has dropped its unsent bytes: the commands in flight that
+    never reached the port go back in the queue as they were; of those
+    that did, idempotent ones are repeated and the rest reported lost.'''
+    global resyncUnsent
+    if serIO and serIO.txDropAsk:
+        if time.perf_counter() - resyncT0 < resyncWaitMs/1000:
+            resyncArm(crQtickMs, resyncDrain)
+            return
+        print('resync: output not dropped, taken as sent')
+    elif serIO:
+        resyncUnsent += serIO.txDropped
+    #
+    lost = []
+    unsent = resyncUnsent
+    for i in range(len(resyncFly)-1, -1, -1):   # newest first => keeps order
+        f = resyncFly[i]
+        wire = len(crQwire.get(f[0]) or (f[0] + EOL).encode())
+        if unsent >= wire:          # still in the buffers: never sent
+            unsent -= wire
+            crQ[crQlane(f[0])].appendleft( f[0:3] + [f[4], f[3]] )
+            continue
+        unsent = 0                  # this one and all before it went out
+        if i == resyncFailed:
+            resyncBlamed[f[0]] = resyncBlamed.get(f[0], 0) + 1
+        if f[0][0] in crQidempotent and resyncBlamed.get(f[0], 0) < 2:
+            crQ[crQlane(f[0])].appendleft( f[0:3] + [f[4], 0] )
+        else:
+            resyncLost.append(f[0])
+            lost.insert(0, f)
+            print('resync: dropped cmd: "{}"'.format(f[0]))
+    resyncFly.clear()
+    for f in lost:      # its 'nxt' never runs: its owner decides what now
+        hook = crQonLost.get(f[0][0])
+        if hook:
+            hook(f)
+    resyncFlush()
+    return
+
+#----
+def resyncArm(ms, fn):
+    global resyncAfter
+    if resyncAfter:
+        siWin.after_cancel(resyncAfter)
+    resyncAfter = siWin.after(ms, fn)
+    return
+
+#----
+def resyncFlush():
+    '''Discard input until the link has been quiet for resyncQuietMs.'''
+    global resyncState, resyncFlushT0
+    resyncState = 'flush'
+    resyncFlushT0 = time.perf_counter()
+    resyncArm(resyncQuietMs, resyncSync)
+    return
+
+#----
+def resyncSync():
+    '''Send '*' (always answered with 'e').'''
+    global resyncState, resyncGotE
+    resyncState = 'sync'
+    resyncGotE = False
+    serBufLoad('*' + EOL)
+    resyncArm(resyncWaitMs * 2**resyncTry, resyncRetry)
+    return
+
+#----
+def resyncLine(rsp):
+    '''Input line while recovering.'''
+    global resyncGotE
+    if crqtest:
+        print('resyncLine(): "{}" ({})'.format(rsp.txt, resyncState))
+    if rsp.code == '#':
+        parseButton(rsp)        # button messages are never stale
+        return
+    if resyncState == 'drain':
+        return
+    if resyncState == 'flush':
+        # still talking: flush again (for no longer than one 'e' wait)
+        if time.perf_counter() - resyncFlushT0 < resyncWaitMs/1000:
+            resyncArm(resyncQuietMs, resyncSync)
+        return
+    if resyncGotE:              # a line after the 'e': not in step, again
+        print('resync: "{}" after the \'e\''.format(rsp.txt))
+        resyncRetry()
+        return
+    if rsp.code == 'e':         # in step, once nothing follows the 'e'
+        resyncGotE = True
+        resyncArm(resyncQuietMs, resyncDone)
+    return
+
+#----
+def resyncRetry():
+    '''No 'e' for '*' in time, or more after it: back off and try again
+    (or give up).'''
+    global resyncTry
+    resyncTry += 1
+    if resyncTry <= resyncTries:
+        print('resync: retry {}'.format(resyncTry))
+        resyncFlush()
+        return
+    resyncGiveUp()
+    return
+
+#----
+def resyncGiveUp():
+    '''RetroSPEX is not answering: flush the queue (its commands are lost,
+    their crQonLost hooks run), tell the user.  The shadow stays empty,
+    so every setting is sent again; the next error or timeout tries again.'''
+    global resyncing, resyncAfter, resyncGaveUp
+    resyncAfter = None
+    resyncing = False
+    resyncGaveUp = True
+    resyncShadow.clear()
+    flushed = [e for q in crQ for e in q]
+    for q in crQ:
+        q.clear()
+    resyncLost.extend(e[0] for e in flushed)
+    print('resync: FAILED after {} tries ({}), {} queued commands flushed'
+          .format(resyncTries, resyncReason, len(flushed)))
+    for e in flushed:
+        hook = crQonLost.get(e[0][0])
+        if hook:
+            hook(e)
+    mBox.showerror('Communication Failure'
+                  ,'RetroSPEX is not answering ({})'.format(resyncReason))
+    crQsend()
+    return
+
+#----
+def resyncDone():
+    '''In step again: replay the registers, resume the queue.'''
+    global resyncing, resyncAfter
+    resyncAfter = None
+    resyncing = False
+    for key in sorted(resyncShadow, reverse=True):   # ahead of the rest
+        cmd = resyncShadow[key]
+        crQ[crQlane(cmd)].appendleft( [cmd, cmd, nop, time.perf_counter(), 0] )
+    dt = time.perf_counter() - resyncT0
+    resyncTimes.record(dt)
+    print('resync: recovered in {:.1f} ms, {} retries, {} registers replayed'
+          ' ({})'.format(dt*1000, resyncTry, len(resyncShadow), resyncReason))
+    crQsend()
+    return
+
+def resyncReport():
+    if not resyncTimes.count:
+        return 'resync: none'
+    return 'resync: {} recoveries, p50 {:.1f} ms, max {:.1f} ms, {} lost'.format(
+           resyncTimes.count, resyncTimes.percentile(50)*1000
+           ,resyncTimes.max/1000, len(resyncLost))
+
+
 #----
 def crQnext(cmd):
     '''Response to sent command has been recieved,
@@ -820,31 +1488,105 @@ def crQnext(cmd):
     print("crQnext(): TODO add 'chain' to next command in crQ")
     return
 
-#dbgOnTime = 0
+#
+# LED blink engine:  'blinkWant' (desired LED state) follows the blink
+# cycle on the monotonic clock, each phase timed from the start of the
+# last one (not from the echo), so a slow link does not stretch the cycle.
+# At most one 'L' is queued or in flight; if the LED is wanted back in the
+# state RetroSPEX confirmed before that 'L' was sent, the 'L' is withdrawn.
+blinkWant   = 0         # LED state the blink cycle wants  (0/1)
+blinkHave   = None      # ... confirmed by RetroSPEX ('L n' echo)
+blinkPending = None     # ... of the 'L' command queued or in flight
+blinkPhase  = 0.0       # (s, monotonic) start of the current ON/OFF phase
+blinkAfter  = None      # siWin.after() id of the next transition
+blinkSent   = 0         # 'L' commands sent
+blinkCollapsed = 0      # ... transitions that needed no 'L' command
+
 #----
-def blinkOnDelay():
-    '''Set time to leave LED ON'''
-    siWin.after(blinkOnTime, cmdL_BlinkOFF)   # delay for ON time
+def blinkSchedule():
+    '''(Re)arm the timer for the end of the current blink phase.'''
+    global blinkAfter
+    if blinkAfter:
+        siWin.after_cancel(blinkAfter)
+    ms = blinkOnTime if blinkWant else blinkOffTime
+    wait = blinkPhase + ms/1000 - time.monotonic()
+    blinkAfter = siWin.after(max(0, int(wait*1000 + 0.5)), blinkTick)
     return
 
 #----
-def blinkOffDelay():
-    '''Set time to leave LED OFF'''
-    siWin.after(blinkOffTime, cmdL_BlinkON)   # delay for OFF time
+def blinkTick():
+    '''End of a blink phase: the LED is wanted in the other state.'''
+    global blinkWant, blinkPhase, blinkAfter
+    blinkAfter = None
+    now = time.monotonic()
+    ms = blinkOnTime if blinkWant else blinkOffTime
+    blinkPhase = max(blinkPhase + ms/1000, now - 0.010)  # late? start anew
+    blinkWant = 1 - blinkWant
+    blinkSchedule()
+    blinkSync()
     return
-    
+
+#----
+def blinkSync():
+    '''Bring the LED to 'blinkWant' with (at most) one 'L' command.'''
+    global blinkPending, blinkSent, blinkCollapsed
+    if blinkPending is not None and not any(e[0][0] == 'L'
+                                  for e in list(crQ[LANEhouse]) + crQfly):
+        blinkPending = None             # lost (dropped after an 'e')
+    if blinkPending is None:            # nothing outstanding
+        if blinkWant != blinkHave:
+            cmd = 'L {}'.format(blinkWant)
+            crQappend( [cmd, cmd, blinkEcho] )   # add to crQ for sending
+            blinkPending = blinkWant
+            blinkSent += 1
+        return
+    if blinkPending == blinkWant:       # already on its way
+        return
+    for queued in crQ[LANEhouse]:       # still waiting to be sent?
+        if queued[0][0] == 'L':
+            blinkCollapsed += 1
+            if blinkWant == blinkHave:  # back where we were: withdraw it
+                crQ[LANEhouse].remove(queued)
+                blinkPending = None
+                blinkSent -= 1
+            else:                       # newest state replaces it
+                cmd = 'L {}'.format(blinkWant)
+                queued[0:2] = [cmd, cmd]
+                blinkPending = blinkWant
+            return
+    # in flight: blinkEcho() calls again
+    return
+
+#----
+def blinkEcho():
+    ''''L n' echo: the LED state is confirmed.'''
+    global blinkHave, blinkPending
+    blinkHave = int(crQcmd.split()[1])
+    blinkPending = None
+    blinkSync()
+    return
+
 #----
 def cmdL_BlinkON():
-    '''Turn LED on for this portion of 'blink cycle'.'''
+    '''Start the 'blink cycle' with the LED on.'''
+    global blinkWant, blinkPhase
     #
-    crQappend( ['L 1', 'L 1', blinkOnDelay] )   # add to crQ for sending 
+    blinkWant  = 1
+    blinkPhase = time.monotonic()
+    blinkSchedule()
+    blinkSync()
     return
 
 #----
 def cmdL_BlinkOFF():
-    '''Turn LED off for this portion of 'blink cycle'.'''
-    #
-    crQappend( ['L 0', 'L 0', blinkOffDelay] )   # add to crQ for sending 
+    '''Stop the 'blink cycle' with the LED off.'''
+    global blinkWant, blinkAfter
+    #
+    if blinkAfter:
+        siWin.after_cancel(blinkAfter)
+        blinkAfter = None
+    blinkWant = 0
+    blinkSync()
     return
 
 #----
@@ -968,6 +1710,809 @@ def updatePhotonCountMode():
     return
 
 
+#
+## Scan engine  -  acquisition driven by crQ responses (no waiting)
+#
+# EX/EM scan, per point:  [move] 'E 0' ['E 1'] '>'.  On '! 02' the dumps
+# 'P 0' ['P 1'] are queued, and right behind them the next point: its move
+# goes out while the dumps are still in flight (crQnoOverlap only holds a
+# move back from '>'; its clears wait for the dumps, crQnoOverlapReg), so
+# the monochrometer moves while the counts are decoded and plotted.  The limit is integration + motion per point.
+# Motor positions come from a table made at the start (retrospex.stepTable,
+# exact arithmetic): moves are the differences, nothing drifts.  The whole
+# scan is compiled then (retrospex.compileScan): crQ entries, wire bytes
+# and a duration estimate; per point the engine only queues entries.
+# Every point is approached moving up: a move down goes scanBacklashNm
+# further and comes back (anti-backlash).
+#
+# Adaptive sampling (varRefine > 1):  pass 1 takes every varRefine'th point
+# of the fine table.  Where its data rises, bends or peaks (featureIntervals)
+# pass 2 fills in the fine points between, in one upward sweep after a
+# single move back, compiled onto the end of the program.  Each point is
+# put in its place (by X) in scanDataX/Y as it comes, scanDataP says which
+# pass measured it.
+#
+# A scan command that a resync could not repeat (crQonLost):  a lost '>'
+# counts its point again (cleared first); after a lost move the position
+# is not known, after a lost dump the point is gone:  the scan ends there,
+# with the points complete so far.  So it does when the resync gives up.
+scanMode    = None      # EXscan/EMscan/TMscan while a scan runs, else None
+scanRef     = False     # refOn when the scan started: 'P 1' dumped too
+scanAxis    = 'M'       # monochrometer scanned: 'X' (EX) or 'M' (EM)
+scanLive    = None      # ... its position display (varLiveEXpos/EMpos)
+scanX       = []        # X of each point: wavelength (nm), or time (s) for TM
+scanSteps   = []        # ... motor position (steps from scanBase)
+scanFineX   = []        # the fine table (every Inc): wavelengths (nm)
+scanFineSteps = []      # ... motor positions
+scanCoarse  = []        # fine table index of each pass 1 point (refining)
+scanRefineK = 1         # pass 1 takes every scanRefineK'th point (1 => off)
+scanRefineLevel = 0.05  # features: changes over this part of the range
+scanBacklashNm = 10     # (nm) past the point on the way down, then up
+scanPass    = 1         # pass being measured
+scanAt      = 0         # index in scanDataX/Y of the last point stored
+scanBase    = 0         # (nm, Fraction) monochrometer position at scan start
+scanStepsNm = 1         # motor steps per nm  (Fraction)
+scanPos     = 0         # (steps from scanBase) after the moves echoed
+scanParkTo  = None      # EM position after the park (EX scan), see monoSteps
+monoSteps   = {}        # 'X'/'M': (stepsNm, steps from 0 nm) where the scans
+                        # left it, exact; the display shows it in whole nm
+scanProg    = None      # compiled scan (retrospex.ScanProgram)
+scanPre     = []        # crQ entries of each point: move, clear, count
+scanPost    = []        # ... its dumps
+scanQueueSec = 0.0      # (s) spent queueing program entries
+scanNext    = 0         # index of the next point to queue
+scanDumped  = 0         # points whose counts are in scanDataY
+scanIntMs   = 0         # integration time (ms)
+scanT0      = 0.0       # (s) scan started
+scanLimit   = 0.0       # (s) integration + motion of the points queued
+scanPlotMs  = 250       # plot redrawn at most this often while scanning
+scanPlotAfter = None    # after() id of the pending redraw
+scanDataR   = []        # reference counts (scanRef), same points as scanDataY
+scanDataP   = []        # pass that measured each point (1, 2 refining)
+scanDumps   = 0         # 'P n' dumps of the scan
+scanSaturated = 0       # ... counters found at their 48-bit limit
+scanRecounts = 0        # points counted again after a lost '>'
+scanRecountMax = 3      # ... at most, then the scan ends
+scanAborted = ''        # why the scan ended early (lost command)
+scanPerSec  = False     # scanDataY (and R) in counts per second (adaptive)
+scanLast    = ''        # report of the last scan
+#
+# Adaptive integration (varAdaptErr > 0):  a point counts until its relative
+# Poisson error 1/sqrt(N) reaches the target, i.e. N >= 1/err**2 counts.
+# The first 'T' of each point is predicted from the rate of the point
+# before; when short, 'T' + '>' again (no 'E': the counts add up) for the
+# counts still missing, at the rate just measured.  Bright points finish at
+# the shortest time, dim ones stop at the longest.  Counts are stored per
+# second, the time of each point in adaptTimes (and the data file header).
+adaptOn     = False     # this scan is adaptive
+adaptNeed   = 0.0       # counts for the target error
+adaptMinMs  = 10        # (ms) shortest integration time
+adaptMaxMs  = 2000      # (ms) longest integration time
+adaptMargin = 1.1       # predicted times stretched this much (rate noise)
+adaptMs     = 0         # (ms) counted so far at this point
+adaptLastMs = 0         # (ms) of the 'T' sent last
+adaptNextMs = 0         # (ms) first 'T' of the next point
+adaptCount  = 0         # signal counts of the point accepted
+adaptTimes  = []        # (s) integration time of each point
+adaptFixed  = 0.0       # (s) fixed time that would reach the target everywhere
+adaptShort  = 0         # points stopped at the longest time, short of counts
+
+#----
+def scanStart(mode):
+    '''Start an EX or EM scan from the settings; False if it may not start.
+    An EX scan first parks the EM monochrometer at its Start wavelength.'''
+    global scanMode, scanAxis, scanLive, scanX, scanSteps, scanBase
+    global scanStepsNm, scanPos, scanNext, scanDumped, scanIntMs
+    global scanT0, scanLimit, scanProg, scanPre, scanPost, scanQueueSec
+    global scanPerSec, adaptOn, adaptNeed, adaptMinMs, adaptMaxMs
+    global adaptNextMs, adaptFixed, adaptShort
+    global scanFineX, scanFineSteps, scanCoarse, scanRefineK, scanPass, scanRef
+    global scanRecounts, scanAborted, scanSaturated, scanParkTo, scanDumps
+    if mode == EXscan:
+        scanAxis, scanLive = 'X', varLiveEXpos
+        wave = (varEXwaveStart, varEXwaveEnd, varEXinc, varEXstepsNm)
+    else:
+        scanAxis, scanLive = 'M', varLiveEMpos
+        wave = (varEMwaveStart, varEMwaveEnd, varEMinc, varEMstepsNm)
+    live = [getVarInt(varLiveEXpos), getVarInt(varLiveEMpos)]
+    if serIO is None or min(live) < MINnm or max(live) > MAXnm:
+        mBox.showerror('{} scan'.format(scanName[mode]), 'No RetroSPEX'
+                       ' connected, or the monochrometer positions are not'
+                       ' calibrated.')
+        return False
+    scanStepsNm = Fraction(wave[3].get())
+    scanBase = Fraction(monoAt(scanAxis, scanLive, scanStepsNm)) / scanStepsNm
+    scanFineX, scanFineSteps = stepTable(wave[0].get(), wave[1].get()
+                                         ,wave[2].get(), wave[3].get(), scanBase)
+    scanRefineK = max(1, int(getVarFloat(varRefine)))
+    scanCoarse = list(range(0, len(scanFineX), scanRefineK))
+    if scanCoarse[-1] != len(scanFineX) - 1:
+        scanCoarse.append(len(scanFineX) - 1)   # the End is always measured
+    scanX = [scanFineX[j] for j in scanCoarse]
+    scanSteps = [scanFineSteps[j] for j in scanCoarse]
+    scanPass = 1
+    scanIntMs = int(abs(getVarFloat(varTMinc)) * 1000 + 0.5)
+    adaptOn = getVarFloat(varAdaptErr) > 0
+    if adaptOn:                 # 'T' per point, not one for the scan
+        adaptNeed  = (100 / getVarFloat(varAdaptErr)) ** 2
+        adaptMinMs = max(1, int(getVarFloat(varAdaptMin) * 1000 + 0.5))
+        adaptMaxMs = max(adaptMinMs, int(getVarFloat(varAdaptMax) * 1000 + 0.5))
+        adaptNextMs, adaptFixed, adaptShort = adaptMinMs, 0.0, 0
+        adaptTimes.clear()
+        scanIntMs = 0
+    scanPerSec = adaptOn
+    scanRef = refOn             # the Ref button may change during the scan
+    scanRecounts, scanAborted, scanSaturated, scanDumps = 0, '', 0, 0
+    park = 0
+    if mode == EXscan:
+        emStepsNm = Fraction(varEMstepsNm.get())
+        emAt = monoAt('M', varLiveEMpos, emStepsNm)
+        park = stepTable(varEMwaveStart.get(), varEMwaveStart.get(), 1
+                         ,emStepsNm, Fraction(emAt) / emStepsNm)[1][0]
+        scanParkTo = (emStepsNm, emAt + park)
+    scanProg = compileScan(scanAxis, scanX, scanSteps, scanIntMs, scanRef, park
+                           ,crQstepsPerSec, eol=EOL.encode()
+                           ,backlash=scanBacklash(), floor=scanFloor())
+    scanPre, scanPost = [], []
+    crQwire.clear()
+    scanLoad(scanProg)
+    scanPos, scanNext, scanDumped, scanQueueSec = 0, 0, 0, 0.0
+    scanLimit = abs(park) / crQstepsPerSec
+    scanDataX.clear()
+    scanDataY.clear()
+    scanDataR.clear()
+    scanDataP.clear()
+    varPCTdone.set(0)
+    scanMode = mode
+    scanT0 = time.perf_counter()
+    for t in scanProg.head:
+        if not (adaptOn and t.op == 'T'):
+            crQappend( [t.cmd, t.rsp, scanNxt(t.op)] )
+    scanQueuePoint()
+    if jjltest:
+        print('scanStart(): {} points {}~{} nm (of {}), {} steps/nm, {} from'
+              ' {} nm'.format(len(scanX), scanX[0], scanX[-1], len(scanFineX)
+              ,float(scanStepsNm), scanName[mode], float(scanBase)))
+        print(scanProgReport())
+    return True
+
+#----
+def monoAt(axis, live, stepsNm):
+    '''(steps from 0 nm) position of monochrometer 'axis' ('X'/'M'): where
+    the last scan left it (monoSteps), unless its display 'live' shows
+    otherwise (set by hand, other steps/nm); then from the display.'''
+    at = monoSteps.get(axis)
+    if at and at[0] == stepsNm and monoNm(at) == getVarInt(live):
+        return at[1]
+    return math.floor(getVarInt(live) * stepsNm + Fraction(1,2))
+
+def monoNm(at):
+    '''Whole nm (for display) of position 'at' (stepsNm, steps).'''
+    return int(round(Fraction(at[1]) / at[0]))
+
+#----
+def scanBacklash():
+    '''(steps) anti-backlash overshoot of the scanned monochrometer.'''
+    return int(scanBacklashNm * scanStepsNm + Fraction(1,2))
+
+def scanFloor():
+    '''(steps from scanBase) lowest position allowed, MINnm.'''
+    return math.ceil((MINnm - scanBase) * scanStepsNm)
+
+#----
+def scanNxt(op):
+    '''crQ 'nxt' function for compiled Steps of kind 'op'.'''
+    if op == 'count' and adaptOn:
+        return adaptCounted
+    return { 'T': nop, 'park': scanParked, 'move': scanMoved, 'clear': nop
+           , 'count': scanCounted, 'dump0': scanSignal
+           , 'dump1': scanReference }[op]
+
+#----
+def scanLoad(prog):
+    '''Add the points of compiled 'prog' to scanPre/scanPost, its bytes to
+    crQwire.'''
+    scanPre.extend([[t.cmd, t.rsp, scanNxt(t.op)] for t in pre]
+                   for pre in prog.pre)
+    scanPost.extend([[t.cmd, t.rsp, scanNxt(t.op)] for t in post]
+                    for post in prog.post)
+    crQwire.update((t.cmd, t.wire) for t in prog.steps())
+    return
+
+#----
+def scanParked():
+    ''''M' echo: EM monochrometer at its Start wavelength (EX scan).'''
+    monoSteps['M'] = scanParkTo
+    varLiveEMpos.set(str(monoNm(scanParkTo)))
+    return
+
+#----
+def scanQueuePoint():
+    '''Queue the compiled commands of point 'scanNext': move, clear, count.'''
+    global scanNext, scanLimit, scanQueueSec, adaptMs
+    t0 = time.perf_counter()
+    if adaptOn:
+        adaptMs = 0
+        adaptTimer(adaptNextMs)
+    for e in scanPre[scanNext]:
+        crQappend(e)
+    scanLimit += scanProg.limit[scanNext]
+    scanNext += 1
+    scanQueueSec += time.perf_counter() - t0
+    return
+
+#----
+def scanMoved():
+    ''''X'/'M' echo: the monochrometer has arrived.'''
+    global scanPos
+    scanPos += crQreply.args[0]
+    monoSteps[scanAxis] = (scanStepsNm, int(scanBase * scanStepsNm) + scanPos)
+    scanLive.set(str(monoNm(monoSteps[scanAxis])))
+    return
+
+#----
+def scanCounted():
+    ''''! 02': dump the counters, queue the next point behind the dumps.'''
+    global scanQueueSec
+    t0 = time.perf_counter()
+    for e in scanPost[scanNext-1]:
+        crQappend(e)
+    scanQueueSec += time.perf_counter() - t0
+    if scanNext < len(scanX) and scannerState != STATEstop:
+        scanQueuePoint()
+    return
+
+#----
+def scanSignal():
+    ''''P 0' dump: the point's counts.'''
+    count = scanDump()
+    scanStore(count)
+    varLiveSignal.set(str(count))
+    if not scanRef:
+        scanPointDone()
+    return
+
+#----
+def scanReference():
+    ''''P 1' dump: the point's reference counts.'''
+    count = scanDump()
+    scanDataR.insert(scanAt, count)
+    varLiveReference.set(str(count))
+    scanPointDone()
+    return
+
+#----
+def scanDump():
+    '''Count of the 'P n' dump just answered (decodeLine: int(x,16), one
+    line at a time); a counter at its 48-bit limit (overflowed) is
+    reported.'''
+    global scanSaturated, scanDumps
+    chan, count = crQreply.args
+    scanDumps += 1
+    if count == COUNTmax:
+        scanSaturated += 1
+        print('scan: counter {} saturated (point {})'.format(chan
+              ,len(scanDataY)))
+    return count
+
+#----
+def scanStore(y):
+    '''Put the point just measured, signal 'y', in its place (by X) in
+    scanDataX/Y; scanAt is where.'''
+    global scanAt
+    x = scanX[len(scanDataY)]           # scanX: the points in measured order
+    scanAt = bisect(scanDataX, x)
+    scanDataX.insert(scanAt, x)
+    scanDataY.insert(scanAt, y)
+    scanDataP.insert(scanAt, scanPass)
+    return
+
+#----
+def scanPointDone():
+    global scanDumped
+    scanDumped += 1
+    if scanMode == TMscan:
+        varPCTdone.set(min(100, int(100 * scanDataX[-1] / max(tmEnd, 1e-6))))
+        finished = tmFinished
+    else:
+        varPCTdone.set(int(100 * scanDumped / len(scanX)))
+        finished = scanNext == len(scanX) or scannerState == STATEstop
+    if scanDumped == scanNext and finished:
+        if scanPass == 1 and scanRefineK > 1 and scannerState != STATEstop \
+           and scanMode != TMscan and scanRefine():
+            return                      # pass 2 under way
+        scanDone()
+    else:
+        scanPlot()
+    return
+
+#----
+def scanRefine():
+    '''Pass 1 done:  queue pass 2, the fine points in the intervals with
+    features.  False if there are none.'''
+    global scanPass, scanX, scanSteps
+    if scanPerSec:                      # Poisson: counts/s => sqrt(N)/t
+        sigma = [math.sqrt(max(y, 0) / t) for y,t in zip(scanDataY, adaptTimes)]
+    else:
+        sigma = [math.sqrt(max(y, 0)) for y in scanDataY]
+    fine = [j for i in featureIntervals(scanDataY, sigma, scanRefineLevel)
+              for j in range(scanCoarse[i] + 1, scanCoarse[i+1])]
+    if not fine:
+        return False
+    xs = [scanFineX[j] for j in fine]
+    steps = [scanFineSteps[j] for j in fine]
+    prog = compileScan(scanAxis, xs, steps, scanIntMs, scanRef, 0
+                      ,crQstepsPerSec, eol=EOL.encode(), at=scanSteps[-1]
+                      ,backlash=scanBacklash(), floor=scanFloor())
+    scanProg.extend(prog)
+    scanLoad(prog)
+    scanX, scanSteps = scanX + xs, scanSteps + steps
+    scanPass = 2
+    if jjltest:
+        print('scanRefine(): {} fine points, {:.1f}~{:.1f} nm'.format(len(xs)
+              ,float(xs[0]), float(xs[-1])))
+    scanQueuePoint()
+    return True
+
+#----
+def scanPlot():
+    '''Redraw the plot soon (at most every scanPlotMs while scanning).'''
+    global scanPlotAfter
+    if scanPlotAfter is None:
+        scanPlotAfter = siWin.after(scanPlotMs, scanPlotNow)
+    return
+
+def scanPlotNow():
+    global scanPlotAfter
+    scanPlotAfter = None
+    updatePlot()
+    return
+
+#----
+def scanDone():
+    '''Last point dumped (or scan stopped): report, redraw, save position.'''
+    global scanMode, scanLast, scanPlotAfter
+    dt = time.perf_counter() - scanT0
+    n = scanDumped
+    if scanMode == TMscan:
+        scanLast = tmReport()
+    else:
+        scanLast = ('{} scan: {} points in {:.2f} s, {:.1f} points/s; limit'
+                    ' {:.1f} points/s (integration + motion), {:.0f}%'.format(
+                    scanName[scanMode], n, dt, n / dt, n / max(scanLimit, 1e-6)
+                    ,100 * scanLimit / dt))
+        scanLast += '\n' + scanProgReport(dt)
+        if scanRecounts or scanAborted:
+            scanLast += '\n{} points counted again{}'.format(scanRecounts
+                        ,'; ENDED EARLY: ' + scanAborted if scanAborted else '')
+        if adaptOn:
+            scanLast += '\n' + adaptReport()
+        if scanRefineK > 1:
+            scanLast += '\n' + refineReport()
+        if n:
+            scanDataWrite()
+    if scanSaturated:
+        scanLast += '\n{} of {} counter dumps SATURATED (48-bit limit)'.format(
+                    scanSaturated, scanDumps)
+    print(scanLast)
+    if scanPlotAfter:
+        siWin.after_cancel(scanPlotAfter)
+        scanPlotAfter = None
+    updatePlot()
+    writePositions()        # where the monochrometer was left
+    crQtimeouts.pop('>', None)
+    scanMode = None
+    setScannerState(STATEstop)
+    runScfB00['image'] = scanStartIcon
+    return
+
+def scanReport():
+    return scanLast or 'scan: none'
+
+def scanProgReport(dt=None):
+    '''Program size and compile time; with 'dt' (s, the scan's duration)
+    the time taken over the estimate, per point.'''
+    p = scanProg
+    txt = ('program: {} commands, {} bytes, compiled in {:.2f} ms; estimate'
+           ' {:.2f} s'.format(len(p), p.size, p.compileSec*1000, p.seconds))
+    if dt is not None and scanDumped:
+        done = p.seconds * scanDumped / len(p.xs) + sum(adaptTimes)
+        txt += ('; took {:.2f} s, {:+.2f} ms/point over the estimate, queueing'
+                ' {:.1f} us/point'.format(dt, (dt - done)/scanDumped
+                *1000, scanQueueSec/scanDumped*1e6))
+    return txt
+
+#----
+def scanLost(entry):
+    '''crQonLost hook: scan command "entry" was dropped by a resync.'''
+    global scanRecounts
+    if scanMode is None:
+        return
+    if resyncGaveUp:
+        scanAbort('RetroSPEX not answering')
+        return
+    if entry[0] == '>' and scanMode == TMscan:
+        tmLost()
+        return
+    if entry[0] == '>' and scanRecounts < scanRecountMax:
+        scanRecounts += 1
+        scanRecount()
+        return
+    scanAbort('lost "{}"'.format(entry[0]))
+    return
+
+#----
+def scanRecount():
+    '''Count point scanNext-1 again:  clear, '>' (it is in position).'''
+    global adaptMs
+    if adaptOn:
+        adaptMs = 0
+        adaptTimer(adaptNextMs)
+    for e in scanPre[scanNext-1]:
+        if e[2] is not scanMoved:
+            crQappend(e)
+    return
+
+#----
+def scanAbort(reason):
+    '''End the scan now, keeping the points complete so far.'''
+    global scanNext, scanAborted
+    print('scan: {} - scan ended'.format(reason))
+    scanAborted = reason
+    mine = ( scanMoved, scanParked, scanCounted, scanSignal, scanReference
+           , adaptCounted, adaptSignal, adaptReference, tmCounted )
+    for q in crQ:                       # the rest of the scan, unsent
+        keep = [e for e in q if e[2] not in mine]
+        q.clear()
+        q.extend(keep)
+    if scanRef and len(scanDataR) < len(scanDataY):
+        for data in (scanDataX, scanDataY, scanDataP):
+            del data[scanAt]            # signal without its reference
+    scanNext = scanDumped
+    if scanMode == TMscan:
+        del scanX[scanDumped:]
+        if tmAfter:
+            siWin.after_cancel(tmAfter)
+        tmStop()
+    else:
+        scanDone()
+    return
+
+#----
+def adaptTimer(ms):
+    '''Queue 'T' for the next count of 'ms' (adaptive).'''
+    global adaptLastMs
+    adaptLastMs = ms
+    cmd = cmdTimer(ms)
+    crQappend( [cmd, cmd, nop] )
+    return
+
+#----
+def adaptCounted():
+    ''''! 02' (adaptive): dump the signal counter, to see if it is enough.'''
+    global adaptMs, scanLimit
+    adaptMs += adaptLastMs
+    scanLimit += adaptLastMs / 1000
+    crQappend( ['P 0', 'P 0 #', adaptSignal] )
+    return
+
+#----
+def adaptSignal():
+    ''''P 0' dump (adaptive): count on for the counts missing, or accept.'''
+    global adaptCount
+    count = scanDump()
+    varLiveSignal.set(str(count))
+    if count < adaptNeed and adaptMs < adaptMaxMs and scannerState != STATEstop:
+        if count:
+            ms = (adaptNeed - count) * adaptMs / count * adaptMargin
+        else:
+            ms = adaptMaxMs             # nothing yet: up to the longest
+        adaptTimer(min(adaptMaxMs - adaptMs, max(1, int(ms + 0.999))))
+        crQappend( ['>', ALERTtimer, adaptCounted] )
+        return
+    adaptCount = count
+    if scanRef:
+        crQappend( ['P 1', 'P 1 #', adaptReference] )
+    else:
+        adaptPoint(None)
+    return
+
+#----
+def adaptReference():
+    ''''P 1' dump (adaptive): the point's reference counts.'''
+    count = scanDump()
+    varLiveReference.set(str(count))
+    adaptPoint(count)
+    return
+
+#----
+def adaptPoint(ref):
+    '''Point accepted:  store counts per second, predict the time of the
+    next point from this one's rate and queue it.'''
+    global adaptNextMs, adaptFixed, adaptShort
+    t = adaptMs / 1000
+    scanStore(adaptCount / t)
+    if ref is not None:
+        scanDataR.insert(scanAt, ref / t)
+    adaptTimes.insert(scanAt, t)
+    if adaptCount < adaptNeed:
+        adaptShort += 1
+    if adaptCount:
+        ms = adaptNeed / adaptCount * adaptMs
+    else:
+        ms = adaptMaxMs
+    adaptFixed = max(adaptFixed, min(adaptMaxMs, ms) / 1000)
+    adaptNextMs = min(adaptMaxMs, max(adaptMinMs, int(ms * adaptMargin + 0.5)))
+    if scanNext < len(scanX) and scannerState != STATEstop:
+        scanQueuePoint()
+    scanPointDone()
+    return
+
+def adaptReport():
+    n = len(adaptTimes)
+    if not n:
+        return 'adaptive: no points'
+    total = sum(adaptTimes)
+    return ('adaptive: {}% error ({:.0f} counts), {:.3f}~{:.3f} s per point,'
+            ' {:.2f} s counting, {} points short; one fixed time for that'
+            ' everywhere: {:.3f} s/point, {:.2f} s ({:.1f}x)'.format(
+            varAdaptErr.get(), adaptNeed, min(adaptTimes), max(adaptTimes)
+            ,total, adaptShort, adaptFixed, adaptFixed * n
+            ,adaptFixed * n / max(total, 1e-6)))
+
+def refineReport():
+    n2 = scanDataP.count(2)
+    return ('adaptive sampling: {} coarse points (every {}), {} fine; {} of'
+            ' the {} fine table points ({:.0f}%)'.format(len(scanDataP) - n2
+            ,scanRefineK, n2, len(scanDataP), len(scanFineX)
+            ,100 * len(scanDataP) / len(scanFineX)))
+
+#----
+def scanDataWrite():
+    '''Save the EX/EM scan data, "classic format", in ~/SCANS/ (named by
+    the time and scan mode); adaptive scans add the time of every point.'''
+    mode = scanName[scanMode]
+    dataDir = os.path.expanduser('~/SCANS')
+    fName = os.path.join(dataDir, '{}_{}.TXT'.format(
+                          time.strftime('%Y-%m-%d_%H%M%S'), mode))
+    if scanMode == EXscan:      # the other monochrometer: where it is
+        kind, other, otherNm = 'Excitation', 'Emiss', varLiveEMpos.get()
+    else:
+        kind, other, otherNm = 'Emission', 'Excit', varLiveEXpos.get()
+    inc = getVarFloat(varEXinc if scanMode == EXscan else varEMinc)
+    if adaptOn:                 # "1.0e-02 ~ 5.0e-01": the times used
+        intSec = '{:e} ~ {:e}'.format(min(adaptTimes), max(adaptTimes))
+    else:
+        intSec = '{:e}'.format(scanIntMs / 1000)
+    hdr = [ os.path.basename(fName)
+          , varSpecimenDetails.get()
+          , kind + ' Scan'
+          , 'Number of Scans 1'
+          , 'Start {:e} Nanometers, End {:e} Nanometers'.format(scanDataX[0]
+                                                              ,scanDataX[-1])
+          , 'Increment {:e} Nanometers, Integration Time {} Seconds'
+            .format(inc, intSec)
+          , '{} Mono {:e} Nanometers'.format(other, float(otherNm))
+          ]
+    if scanRefineK > 1:
+        hdr.append('Adaptive Sampling: Coarse Increment {:e} Nanometers'
+                   .format(inc * scanRefineK))
+        for i in range(0, len(scanDataP), 40):
+            hdr.append('Point Pass ' + ' '.join(str(p)
+                                           for p in scanDataP[i:i+40]))
+    if adaptOn:
+        hdr += [ 'Adaptive Integration: Error {} %, Time {:e} ~ {:e} Seconds'
+                 .format(varAdaptErr.get(), adaptMinMs/1000, adaptMaxMs/1000)
+               , 'Counts Per Second' ]
+        for i in range(0, len(adaptTimes), 10):
+            hdr.append('Point Times ' + ' '.join('{:e}'.format(t)
+                                            for t in adaptTimes[i:i+10]))
+    data = ['{:e}\t{:e}'.format(x, y) for x,y in zip(scanDataX, scanDataY)]
+    try:
+        os.makedirs(dataDir, exist_ok=True)
+        with open(fName, 'w') as fo:
+            fo.write('\n'.join(hdr + ['.' * 79] + data + ['_' * 79]) + '\n')
+    except OSError as e:
+        mBox.showerror('Save scan data', 'Not saved: {}'.format(e))
+        return
+    varScanDataFileName.set(fName)
+    if jjltest:
+        print('scanDataWrite(): {}'.format(fName))
+    return
+
+#
+# TM scan:  '>' at fixed deadlines on the monotonic clock, slot k at
+# tmT0 + k*tmPeriod.  Each after() delay is worked out afresh from the
+# clock, so Tk's lateness never adds up.  The dumps and the next 'E n'
+# follow each '! 02', leaving only the '>' to wait for its slot.  A sample
+# is stamped at the middle of its count (from the '! 02' arrival), not at
+# its slot.  Pausing (front panel button, or the Pause time) skips slots
+# but keeps the grid, so an hour-long run does not drift.  A '>' lost in a
+# resync skips its slot (tmLost).
+tmPeriod    = 1.0       # (s) sample period (varTMinc)
+tmEnd       = 0.0       # (s) scan length (varTMwaveEnd)
+tmPauseAt   = 0.0       # (s) pause here, once (varTMwavePause; 0 = never)
+tmGuardMs   = 20        # (ms) of each period left for '! 02', dumps, clear
+tmIntMs     = 0         # integration time (ms)
+tmT0        = 0.0       # (s, monotonic) slot 0
+tmSlot      = 0         # slot of the next '>'
+tmSlots     = deque()   # (s, monotonic) slot of each '>' counting
+tmAfter     = None      # after() id of the next slot
+tmPausedAt  = None      # (s, monotonic) pause began  (while paused)
+tmPaused    = 0.0       # (s) total time paused
+tmAutoPaused = False    # Pause time reached
+tmFinished  = False     # no more slots (End reached, or stopped)
+tmMissed    = 0         # slots skipped: the count before was not done
+tmLate      = LatencyHistogram()    # '>' queued this long after its slot
+tmOffset    = LatencyHistogram()    # middle of count after middle of slot
+
+#----
+def tmStart():
+    '''Start a TM scan from the settings; False if it may not start.'''
+    global tmPeriod, tmEnd, tmPauseAt, tmIntMs, tmT0, tmSlot, tmPausedAt
+    global tmPaused, tmAutoPaused, tmFinished, tmMissed, tmLate, tmOffset
+    global scanMode, scanX, scanNext, scanDumped, scanT0, scanPerSec, adaptOn
+    global scanPass, scanRefineK, scanRef, scanSaturated, scanDumps
+    if serIO is None:
+        mBox.showerror('TM scan', 'No RetroSPEX connected.')
+        return False
+    if int(getVarFloat(varTMinc) * 1000 + 0.5) <= tmGuardMs:
+        mBox.showerror('TM scan', 'Inc must be longer than {} ms: that much of'
+                       ' every period is needed to dump and clear the'
+                       ' counters.'.format(tmGuardMs))
+        return False
+    tmPeriod  = getVarFloat(varTMinc)
+    tmEnd     = getVarFloat(varTMwaveEnd)
+    tmPauseAt = getVarFloat(varTMwavePause)
+    tmIntMs   = int(tmPeriod * 1000 + 0.5) - tmGuardMs
+    tmSlots.clear()
+    tmPausedAt, tmPaused, tmAutoPaused, tmFinished = None, 0.0, False, False
+    tmMissed, tmLate, tmOffset = 0, LatencyHistogram(), LatencyHistogram()
+    scanX, scanNext, scanDumped = [], 0, 0
+    scanPerSec, adaptOn, scanPass, scanRefineK = False, False, 1, 1
+    scanRef = refOn
+    scanSaturated, scanDumps = 0, 0
+    adaptTimes.clear()
+    scanDataX.clear()
+    scanDataY.clear()
+    scanDataR.clear()
+    scanDataP.clear()
+    varPCTdone.set(0)
+    scanMode = TMscan
+    crQtimeouts['>'] = tmCountTimeout
+    cmd = cmdTimer(tmIntMs)
+    crQappend( [cmd, cmd, nop] )
+    tmClear()
+    scanT0 = time.perf_counter()
+    tmT0 = time.monotonic() + tmGuardMs/1000    # 'T' and 'E n' go first
+    tmSlot = 0
+    tmSchedule()
+    if jjltest:
+        print('tmStart(): every {} s for {} s, {} ms counts, pause at {} s'
+              .format(tmPeriod, tmEnd, tmIntMs, tmPauseAt))
+    return True
+
+#----
+def tmClear():
+    '''Clear (and enable) the counters for the next sample.'''
+    crQappend( ['E 0', 'E 0', nop] )
+    if scanRef:
+        crQappend( ['E 1', 'E 1', nop] )
+    return
+
+#----
+def tmSchedule():
+    '''Arm the timer for slot 'tmSlot' (the delay from the clock, every time).'''
+    global tmAfter
+    wait = tmT0 + tmSlot * tmPeriod - time.monotonic()
+    tmAfter = siWin.after(max(0, int(wait * 1000 + 0.999)), tmTick)
+    return
+
+#----
+def tmTick():
+    '''Slot 'tmSlot' is due: start its count, arm the next slot.'''
+    global tmAfter, tmSlot, tmMissed, tmAutoPaused, scanNext
+    tmAfter = None
+    now = time.monotonic()
+    due = tmT0 + tmSlot * tmPeriod
+    if tmSlot * tmPeriod > tmEnd + 1e-9:        # past the End time
+        tmStop()
+        return
+    if tmPauseAt > 0 and not tmAutoPaused and tmSlot * tmPeriod >= tmPauseAt:
+        tmAutoPaused = True
+        setScannerState(STATEpause)             # the button resumes
+        return
+    if resyncing or crQpending(lambda c: c == '>'):     # last count not
+        tmMissed += 1                           # done yet, or recovering
+    else:
+        tmLate.record(max(0.0, now - due))
+        tmSlots.append(due)
+        crQappend( ['>', ALERTtimer, tmCounted] )
+        scanNext += 1
+    tmSlot = max(tmSlot + 1, tmSlotAfter(now))
+    tmSchedule()
+    return
+
+def tmCountTimeout(cmd):
+    ''''>' deadline (crQtimeouts): a period and the guard, so a lost count
+    costs a slot or two, not a second of them.'''
+    return tmPeriod + tmGuardMs/1000
+
+def tmSlotAfter(t):
+    '''First slot starting at (or after) monotonic time 't'.'''
+    return max(0, int(-((tmT0 - t) // tmPeriod)))
+
+#----
+def tmCounted():
+    ''''! 02': stamp the sample, dump, clear the counters for the next.'''
+    t = time.monotonic() - tmIntMs/2000         # middle of the count
+    tmOffset.record(max(0.0, t - tmSlots.popleft() - tmIntMs/2000))
+    scanX.append(round(t - tmT0, 4))
+    crQappend( ['P 0', 'P 0 #', scanSignal] )
+    if scanRef:
+        crQappend( ['P 1', 'P 1 #', scanReference] )
+    if not tmFinished:
+        tmClear()
+    return
+
+#----
+def tmLost():
+    ''''>' lost (resync):  that slot is skipped, the counters cleared again.'''
+    global scanNext, tmMissed
+    tmSlots.popleft()
+    scanNext -= 1
+    tmMissed += 1
+    if tmFinished:
+        if scanDumped == scanNext:
+            scanDone()
+        return
+    tmClear()
+    return
+
+#----
+def tmState():
+    '''scannerState changed during a TM scan: pause, resume or stop.'''
+    global tmAfter, tmPausedAt, tmPaused, tmSlot
+    now = time.monotonic()
+    if scannerState == STATEscan:
+        if tmPausedAt is not None:
+            tmPaused += now - tmPausedAt
+            tmPausedAt = None
+            tmSlot = max(tmSlot, tmSlotAfter(now))  # same grid as before
+            tmSchedule()
+        return
+    if tmAfter:
+        siWin.after_cancel(tmAfter)
+        tmAfter = None
+    if scannerState == STATEpause:
+        if tmPausedAt is None:
+            tmPausedAt = now
+    else:
+        tmStop()
+    return
+
+#----
+def tmStop():
+    '''No more slots: done once the last sample is dumped.'''
+    global tmFinished, tmPausedAt
+    tmFinished = True
+    tmPausedAt = None
+    if scanDumped == scanNext and scanMode == TMscan:
+        scanDone()
+    return
+
+def tmReport():
+    return ('TM scan: {} samples every {} s, {} slots skipped, paused {:.1f} s;'
+            ' late (ms) p50 {:.2f} p99 {:.2f} max {:.2f}; sample offset (ms)'
+            ' p50 {:.2f} p99 {:.2f} max {:.2f}'.format(scanDumped, tmPeriod
+            ,tmMissed, tmPaused, tmLate.percentile(50)*1000
+            ,tmLate.percentile(99)*1000, tmLate.max/1000
+            ,tmOffset.percentile(50)*1000, tmOffset.percentile(99)*1000
+            ,tmOffset.max/1000))
+
+crQonLost.update((c, scanLost) for c in 'XM>PET')   # scan commands
+
+
 
 ## Serial - ensure non-blocking
 #    --  NOTE: rtscts=1  hardware handshake for 'ready' with data
@@ -976,92 +2521,82 @@ def updatePhotonCountMode():
 # baudrate for RetroSPEX is 115200 (ArduinoDue max)
 #
 # look for serial port
-def portTry(name):
-    '''Test 'name' to see if it goes to RetroSPEX.'''
-    global serialPort, firmwareVer, serInBuffer, serInLines, serOutReady
-    #TODO add timeout for testing a found serial port in portTry()
-    print("TODO add timeout for testing a found serial port in portTry()")
-    if comtest:
-        print('\tportTry(name): {}'.format(name))
+#----
+def readPortCache():
+    '''Recover last port found and its firmware from "port.txt" file.'''
+    name, ver = '', ''
+    try:        # "PORT: /dev/ttyACM0"  and  "FIRMWARE: RetroSPEX_Rev-8"
+        for s in open(portCache).read().splitlines():
+            t = s.split(None, 1)
+            if len(t) == 2 and t[0] == 'PORT:':
+                name = t[1]
+            elif len(t) == 2 and t[0] == 'FIRMWARE:':
+                ver = t[1]
+    except OSError:
+        pass
+    return name, ver
+
+#----
+def writePortCache():
+    '''Write port found and its firmware to "port.txt" file.'''
+    data = 'PORT: {}\nFIRMWARE: {}\n'.format(portName, firmwareVer)
     try:
-        serialPort = serial.Serial(port=name 
-                                ,baudrate=115200
-                                ,timeout=0
-                                ,rtscts=1
-                                ,dsrdtr=True
-                                ,writeTimeout=0) 
-#         #serialPort.open()  just opened !
-#         serialStatus = serialPort.isOpen()
-#         print('\nportTry({}): serialPort.isOpen = {}'.format(name,serialStatus))
-#         return serialStatus
-        if comtest:
-            print('\tOPEN...')
-    except:
-#         print('portTry(name): NOT portName: {}'.format(name))
-#         return False
-        if comtest:
-            print('\tCLOSED')
-        return False
-    #
-    buf = ''    # input buffer for port testing
-    for trial in range(10):
-        if comtest:
-            print('\t\ttrial={}'.format(trial))
-        for t in range (43):
-            i = b''
-            while i == b'':     # SKIP NULL CHARACTERS
-                i = serialPort.read()
-#                 if i == b'':
-#                     if comtest:
-#                         print('\t\t read(): NULL')
-            c = chr( ord(i)%128 )
-            if comtest:
-                print('\t\t ord(c):{}, chr( ord(c)%128 ):{}'.format(ord(i),c))
-            if c == '\n':
-                if buf.startswith('RetroSPEX'):     # This is RetroSPEX !!
-                    firmwareVer = buf[:]        # save for Version info.
-                    updateTitle()               # Title includes RetroSPEX Rev-#
-                    serInBuffer = ''
-                    serInLines = []
-                    serOutReady = True          # RetroSPEX is ready !
-                    serialPort.write( b'\n' )   # send a response byte
-                    readSerial()                # start monitoring input
-                    return True
-                else:
-                    buf = ''
-            else:
-                buf = buf + c
-            if comtest:
-                print('\t\t buf: {}'.format(buf))
-    return False
-        
+        fo = open(portCache,'w')
+        fo.write(data)
+        fo.close()
+    except OSError:
+        pass
+    return
 
-    
+#----
 def portScan():    
-    '''Search for serial USB port for Spectrometer, or "OFFLINE".'''
-    global serialPort, portList, portName, serInLines
-    #
-    for portName in portList :
-        if portName != 'OFFLINE':
-            if portTry(portName):   # a serialPort found
-                readSerial()        # start monitoring serial input
-                if jjltest:
-                    print('\nFOUND serialPort={}'.format(serialPort))
-                    print('FOUND portName: {}'.format(portName))
-                updateTitle()   # new "Port" name
-                return
-        else:   # end of list 'OFFLINE' reached, no port found
-            if True: #comtest:
-                print('Serial Port not found... Operating OFFLINE')
-                # show ports tried
-                for name in portList[0:-1]:
-                    print('tried: {}'.format(name))
-            #
-            # operating OFFLINE
-            updateTitle()   # new "Port" or "OFFLINE"
-            return
-    title = siTitle + ',     Port: {} on System: {}'
-    siWin.wm_title( title.format(portName, thisSys))
+    '''Search for serial USB port for Spectrometer, or "OFFLINE".
+    All candidates (last port found, /dev/serial/by-id, portList) are
+    tried at once, for no more than 'portScanSec' seconds.'''
+    global serialPort, portName, firmwareVer, serInLines, serOutReady
+    #
+    if cmdLine.replay:          # recorded session plays the part of RetroSPEX
+        serialPort = ReplayPort(cmdLine.replay, cmdLine.speed)
+        portName = 'REPLAY'
+        firmwareVer = serialPort.meta.get('firmware', '')
+        serInLines = []
+        serOutReady = True
+        startSerialIO()
+        print('Replaying {} (speed {})'.format(cmdLine.replay, cmdLine.speed))
+        updateTitle()
+        return
+    t0 = time.perf_counter()
+    lastPort, lastVer = readPortCache()
+    names = []
+    for name in [lastPort] + serialById() + portList:
+        if name and name != 'OFFLINE' and name not in names:
+            names.append(name)
+    if comtest:
+        print('\tportScan(): trying {}'.format(names))
+    found = probePorts(names, portScanSec)
+    dt = time.perf_counter() - t0
+    #
+    if found:
+        portName, serialPort, firmwareVer = found
+        serInLines = []
+        serOutReady = True          # RetroSPEX is ready !
+        serialPort.write( b'\n' )   # send a response byte
+        startSerialIO()             # I/O thread takes the port
+        print('RetroSPEX found on {} in {:.2f} s  ({})'.format(
+              portName, dt, firmwareVer))
+        if lastVer and lastVer != firmwareVer:
+            print('\tfirmware was: {}'.format(lastVer))
+        if jjltest:
+            print('\nFOUND serialPort={}'.format(serialPort))
+        writePortCache()
+    else:
+        portName = 'OFFLINE'
+        print('Serial Port not found in {:.2f} s... Operating OFFLINE'.format(dt))
+        # show ports tried
+        for name in names:
+            print('tried: {}'.format(name))
+    #
+    updateTitle()   # new "Port" or "OFFLINE", firmware
     return
     
 
@@ -1527,6 +3062,16 @@ def readSettings():
     varEMstepsNm.set('50')    
     #   "PhotonCountMode: Edge"  # Photon Counting on Pulse Edge (vs. Width)
     varPhotonCountMode.set('Edge') 
+    # ADAPTIVE INTEGRATION
+    #   "AdaptErr: 0"       # target relative error (%), 0 => off
+    varAdaptErr.set('0')
+    #   "AdaptMin: 0.01"    # shortest integration time (s)
+    varAdaptMin.set('0.01')
+    #   "AdaptMax: 2.0"     # longest integration time (s)
+    varAdaptMax.set('2.0')
+    # ADAPTIVE SAMPLING
+    #   "Refine: 0"         # coarse pass increment (x Inc), 0 => off
+    varRefine.set('0')
     #   
     #TODO (should be commented out once incorporated into RetroSPEX code)
     #   "PhotonInversionMode: Polarity"  # Photon Counting Signa Polarity (PMT & REF)
@@ -1575,6 +3120,14 @@ def readSettings():
                 varEMstepsNm.set(items[1])
             elif items[0] == "PhotonCountMode:":
                 varPhotonCountMode.set(items[1])
+            elif items[0] == "AdaptErr:":
+                varAdaptErr.set(items[1])
+            elif items[0] == "AdaptMin:":
+                varAdaptMin.set(items[1])
+            elif items[0] == "AdaptMax:":
+                varAdaptMax.set(items[1])
+            elif items[0] == "Refine:":
+                varRefine.set(items[1])
     except:
         pass    # no SITE SETTINGS WERE SAVED
         if jjltest:
@@ -1602,6 +3155,12 @@ def writeSettings():
                 , 'EMstepsNm: ' + varEMstepsNm.get()
                 , '# photon measurement method'
                 , 'PhotonCountMode: ' + varPhotonCountMode.get()
+                , '# adaptive integration'
+                , 'AdaptErr: ' + varAdaptErr.get()
+                , 'AdaptMin: ' + varAdaptMin.get()
+                , 'AdaptMax: ' + varAdaptMax.get()
+                , '# adaptive sampling'
+                , 'Refine: ' + varRefine.get()
                 ]
     #
     fo.write( '\n'.join(tempData) )
@@ -1772,6 +3331,47 @@ def editScannerSettings():
     edsetINVcR3.grid(row=0, column=3, padx=4, sticky=W)
     #
     #
+    # Adaptive Integration - per point integration time (EX/EM scans)
+    #
+    #     varAdaptErr  = StringVar()   # target relative error (%), 0 => off
+    #     varAdaptMin  = StringVar()   # shortest integration time (s)
+    #     varAdaptMax  = StringVar()   # longest integration time (s)
+    #
+    #-------
+    edsetAd = LabelFrame(edsetTop, text="Adaptive Integration."
+                        ,bg = TANBG, font=monoFont16
+                        ,borderwidth=6)
+    edsetAd.grid(row=4, padx=4, pady=4, sticky=EW)
+    #
+    for row,(txt,var) in enumerate([ ("Target error (%, 0=off):", varAdaptErr)
+                                   , ("Shortest time (s):", varAdaptMin)
+                                   , ("Longest time (s):", varAdaptMax) ]):
+        #-------
+        AdL = Label(edsetAd, text = txt, bg = TANBG, font=monoFont14)
+        AdL.grid(row=row, column=0, padx=4, sticky=W)
+        #-------
+        AdE = Entry(edsetAd, textvariable = var, font=monoFont14)
+        AdE.grid(row=row, column=1, padx=4, sticky=E)
+    #
+    #
+    # Adaptive Sampling - coarse pass, then fine increment at features
+    #
+    #     varRefine  = StringVar()   # coarse pass increment (x Inc), 0 => off
+    #
+    #-------
+    edsetRf = LabelFrame(edsetTop, text="Adaptive Sampling."
+                        ,bg = TANBG, font=monoFont16
+                        ,borderwidth=6)
+    edsetRf.grid(row=5, padx=4, pady=4, sticky=EW)
+    #-------
+    RfL = Label(edsetRf, text = "Coarse pass (x Inc, 0=off):", bg = TANBG
+               ,font=monoFont14)
+    RfL.grid(row=0, column=0, padx=4, sticky=W)
+    #-------
+    RfE = Entry(edsetRf, textvariable = varRefine, font=monoFont14)
+    RfE.grid(row=0, column=1, padx=4, sticky=E)
+    #
+    #
     # DONE  --  execute when editing is complete
     def edsetDone(x=None):
         global hvOn
@@ -1795,7 +3395,7 @@ def editScannerSettings():
     bDone = Button(edsetTop, text = 'DONE', bg = TANBG, borderwidth=4 
                 ,command = edsetDone
                 ,activebackground=ACTIVB, font=monoFont16)
-    bDone.grid(row=4,padx=4, pady=2, sticky=W)
+    bDone.grid(row=6,padx=4, pady=2, sticky=W)
     #
     edset.transient(siWin)
     edset.grab_set()
@@ -1864,6 +3464,7 @@ def monoCal():
     def monoCalDone(x=None):
         # Close window if both values are in 'normal' range
         if monoCheck(varLiveEXpos, eEX) and monoCheck(varLiveEMpos, eEM):
+            monoSteps.clear()   # calibrated: positions from the display
             writePositions()    # save Verified positions to file
             cal.destroy()
         return  # ignore
@@ -1946,6 +3547,19 @@ def PowerDown():
         print("TODO: if connected: ShutDown RetroSPEX controller settings")
         #
         #TODO log "run time" (bulb life? - i.e. need start time)
+        #
+        if serIO:
+            xmitSerial()    # hand over anything still waiting
+            if jjltest:
+                print('PowerDown(): {}'.format(serIO.txReport()))
+                print(xmitReport())
+                print(crQreport())
+                print(parseReport())
+                crQdump()
+            serIO.stop()    # I/O thread sends the rest, lets go of the port
+            serIO.join(serIO.drainSec + 1.0)    # ... (closes any traffic log)
+            if serIO.txUnsent:
+                print('PowerDown(): {} bytes not sent'.format(serIO.txUnsent))
     #
     #TODO log data such as monochrometer position on shutdown
     print("TODO: log data such as monochrometer position on shutdown")
@@ -1974,24 +3588,24 @@ def scanStartStop():
     global scannerState, STATEstop, STATEscan, STATEpause
     if scannerState != STATEstop:   # RUN or PAUSE => then STOP the scan !!
         if jjltest:
-            print('STOPPING A SCAN IMPLEMENTED YET ;-)')
-        setScannerState(STATEstop)
+            print('scanStartStop(): stopping, after the point in progress')
+        setScannerState(STATEstop)  # the scan engine finishes its point
         runScfB00['image'] = scanStartIcon
+    elif scanMode is not None:      # still finishing the last point
+        return
     else:   # START up a scan
         # perform sanity checks before starting scan
         sane = scanSanityCheck( warn = True )
-        if jjltest:
-            print('STARTING A SCAN NOT IMPLEMENTED YET ;-)')
-            sane = False
-            #
-            # PRETEND TO START SCANNING FOR TESTING
-            setScannerState(STATEscan)
-            runScfB00['image'] = scanStopIcon
+        if sane:
+            shadowSaved.clear()     # count saved round trips per scan
+            sm = varScanMode.get()
+            if sm in (EXscan, EMscan):
+                sane = scanStart(sm)
+            else:
+                sane = tmStart()
         if sane:
             setScannerState(STATEscan)
             runScfB00['image'] = scanStopIcon
-            #
-            pass    # start scanning !
         else:
             pass    # DON"T  start scanning !
     return
@@ -2111,6 +3725,55 @@ macroFileEdit.grid(row=1, column=0,sticky=NW)
 
 
 
+#====================================
+## Link Statistics  -  crQ timing by command (see crQtiming)
+#
+statsRefreshMs = 1000   # window update period
+#
+def linkStats():
+    '''Window showing command round trip times, updated while open.'''
+    #
+    stw = Toplevel()
+    stw.title('RetroSPEX Link Statistics')
+    #
+    stwTop = Frame(stw, bg = TANBG)
+    stwTop.grid()
+    #
+    txt = Text(stwTop, width=72, height=20, font=monoFont12)
+    txt.grid(row=0, column=0, columnspan=3, padx=4, pady=4)
+    #
+    def stwShow():
+        if not stw.winfo_exists():
+            return
+        lines = [crQreport(), '', parseReport()]
+        if serIO:
+            lines.append(serIO.txReport())
+        lines.append(xmitReport())
+        txt.delete('1.0', END)
+        txt.insert(END, '\n'.join(lines))
+        stw.after(statsRefreshMs, stwShow)
+        return
+    #
+    def stwReset():
+        crQstats.clear()
+        return
+    #
+    def stwSave():
+        crQdump()
+        print('linkStats(): saved to {}'.format(crQstatsFile))
+        return
+    #
+    for col,(label,fn) in enumerate([('RESET', stwReset), ('SAVE', stwSave)
+                                    ,('CLOSE', stw.destroy)]):
+        b = Button(stwTop, text=label, bg = TANBG, borderwidth=4, command=fn
+                  ,activebackground=ACTIVB, font=monoFont14)
+        b.grid(row=1, column=col, padx=4, pady=2)
+    #
+    stwShow()
+    return
+
+
+
 #====================================
 ## Scanner Frame
 #
@@ -2127,6 +3790,11 @@ settingsBtn = Button(ScannerFrame, image=settingsIcon, bg = TANBG
                     ,borderwidth = 0, command = editScannerSettings
                     ,activebackground=ACTIVB, font=monoFont14 )
 settingsBtn.grid()
+#-------
+statsBtn = Button(ScannerFrame, text='Stats', bg = TANBG
+                 ,borderwidth = 0, command = linkStats
+                 ,activebackground=ACTIVB, font=monoFont10 )
+statsBtn.grid()
  
 
 
@@ -2724,12 +4392,12 @@ def updatePlot():
     maxX = 1000
     sm = varScanMode.get()
     if sm == EXscan:
-        if jjltest:
-            print('Error: EXscan not implemented.')
+        if getVarInt(varEXwaveEnd) - getVarInt(varEXwaveStart) < 2:
+            startX = minX
+            endX   = maxX
         else:
-            mBox.showerror(message='Error: EXscan not implemented.')
-        startX = minX
-        endX = maxX
+            startX = getVarInt(varEXwaveStart)
+            endX = getVarInt(varEXwaveEnd)
     elif sm == EMscan:
         if getVarInt(varEMwaveEnd) - getVarInt(varEMwaveStart) < 2:
             startX = minX
@@ -2738,12 +4406,8 @@ def updatePlot():
             startX = getVarInt(varEMwaveStart)
             endX = getVarInt(varEMwaveEnd)
     elif sm == TMscan:
-        if jjltest:
-            print('Error: TMscan not implemented.')
-        else:
-            mBox.showerror(message='Error: TMscan not implemented.')
-        startX = minX
-        endX = maxX
+        startX = 0
+        endX = max(1.0, getVarFloat(varTMwaveEnd))
     else:
         mErr('Error: updatePlot() invalid varScanMode')
         sys.exit(0)
@@ -2767,7 +4431,11 @@ def updatePlot():
     ax.axis([startX, endX, 0, maxY ])
     #
     setPlotTitle()
-    ax.set_ylabel('counts')
+    ax.set_ylabel('counts/s' if scanPerSec else 'counts')
+    #
+    # plot scan data (acquired so far)
+    if len(scanDataX) > 0:
+        ax.plot(scanDataX, scanDataY, 'b')
     #
     # plot "background" waveform (IF one has been loaded)
     if len(backgroundDataX) > 1: